@@ -14,6 +14,7 @@ except Exception:
 
 import sys
 import os
+import time
 import inspect
 # override config module, hack
 from .config import config
@@ -26,7 +27,14 @@ sys.modules["blaster.config"] = config  # hack
 # gevent local with some default
 class __ReqCtx(local.local):
 	def __init__(self, **kwargs):
-		self.__dict__.update({"req": None, "timestamp": None, "cache": None})
+		self.__dict__.update({"req": None, "timestamp": None, "cache": None, "deadline": None})
+
+	# ms left before the current request's deadline(route timeout_ms),
+	# None if there is no deadline
+	def remaining_ms(self):
+		if(self.deadline is None):
+			return None
+		return max(0, int(1000 * (self.deadline - time.time())))
 
 
 req_ctx = __ReqCtx()
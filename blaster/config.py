@@ -99,6 +99,18 @@ if(gcloud_credential_file := environ.get("GOOGLE_APPLICATION_CREDENTIALS")):
 
 # BLASTER SPECIFIC CONFIGS, that can be overridden
 config.BLASTER_HTTP_TOOK_LONG_WARN_THRESHOLD = 5000
+# admission control, defaults for App.start, routes can set their own limits
+config.BLASTER_HTTP_MAX_CONNECTIONS = 100000  # greenlets handling connections
+config.BLASTER_HTTP_MAX_CONCURRENCY = 0  # requests handled at once, 0 => no limit
+config.BLASTER_HTTP_MAX_QUEUE = 1000  # requests waiting when at the limit
+config.BLASTER_HTTP_QUEUE_TIMEOUT_MS = 2000  # max wait in queue before 503
+config.BLASTER_HTTP_SHED_LATENCY_MS = 0  # 503 instead of queueing above this latency, 0 => off
+config.BLASTER_HTTP_RETRY_AFTER = 1  # seconds, sent with 503
+# keep-alive connections
+config.BLASTER_HTTP_IDLE_TIMEOUT = 40  # seconds between requests
+config.BLASTER_HTTP_HEADER_TIMEOUT = 10  # seconds to receive the request line and headers
+config.BLASTER_HTTP_MAX_IDLE_CONNECTIONS = 10000  # oldest idle connections are closed beyond this
+config.BLASTER_HTTP_DRAIN_TIMEOUT = 30  # seconds to wait for in-flight requests on stop
 
 # MONGO ORM SPECIFIC CONFIGS
 config.MONGO_WARN_MAX_RESULTS_RATE = 1000  # can scan at a max of 1000 / sec
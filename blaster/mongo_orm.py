@@ -25,6 +25,7 @@ from .config import IS_DEV, MONGO_WARN_MAX_RESULTS_RATE, \
 from gevent.threading import Thread
 from gevent import time
 from .logging import LOG_WARN, LOG_ERROR, LOG_DEBUG
+from . import req_ctx
 
 _loading_errors = {}
 
@@ -293,6 +294,14 @@ class MongoDict(dict):
 		return (dict, (self.copy(),))
 
 
+# server side limit for reads in a request with a deadline(route timeout_ms),
+# None => no limit
+def _max_time_ms():
+	if((remaining_ms := req_ctx.remaining_ms()) is None):
+		return None
+	return max(remaining_ms, 1)
+
+
 # utility function to cache and return a session for transaction
 def _with_session(collection, _transaction, exit_stack):
 	dbnode = collection._db_node_
@@ -596,7 +605,7 @@ class Model(object):
 	def reload_from_db(self):
 		cls = self.__class__
 		primary_shard_collection = cls.get_collection(getattr(self, cls._shard_key_ or "_id"))
-		_doc_in_db = primary_shard_collection.find_one({"_id": self._id})
+		_doc_in_db = primary_shard_collection.find_one({"_id": self._id}, max_time_ms=_max_time_ms())
 		if(not _doc_in_db):  # moved out of shard or pk changed
 			raise Exception(f"Document {self._id} pk:{self.pk()} not found")
 		# 2. update our local copy
@@ -846,7 +855,7 @@ class Model(object):
 						_update_query,
 						return_document=ReturnDocument.AFTER,
 						session=_with_session(primary_shard_collection, _transaction, stack),
-						**kwargs
+						**(kwargs if (max_time_ms := _max_time_ms()) is None else {"maxTimeMS": max_time_ms, **kwargs})
 					)
 
 					IS_DEV \
@@ -862,7 +871,7 @@ class Model(object):
 						# is this concurrent update by someone else?
 						_update_retry_count and time.sleep(0.03 * _update_retry_count + random.random() / 10)  # 100 ms randomized delay
 						# 1. fetch from db again
-						_doc_in_db = primary_shard_collection.find_one({"_id": self._id})
+						_doc_in_db = primary_shard_collection.find_one({"_id": self._id}, max_time_ms=_max_time_ms())
 						if(not _doc_in_db):  # moved out of shard or pk changed
 							raise Exception(f"Document {self._id} pk:{self.pk()} not found")
 
@@ -1110,6 +1119,8 @@ class Model(object):
 			kwargs = {}
 			if(offset):
 				kwargs["skip"] = offset
+			if((max_time_ms := _max_time_ms()) is not None):
+				kwargs["maxTimeMS"] = max_time_ms
 			return _collection.count_documents(_query, **kwargs)
 
 		class SortKey(object):
@@ -1220,6 +1231,8 @@ class Model(object):
 
 			projection = kwargs.get("projection")
 			ret = _collection.find(_query, **kwargs)
+			if("max_time_ms" not in kwargs and (max_time_ms := _max_time_ms()) is not None):
+				ret = ret.max_time_ms(max_time_ms)
 			if(offset):  # from global arg
 				ret = ret.skip(offset)
 			if(limit):
@@ -9,6 +9,7 @@ import psycopg2
 import psycopg2.pool
 import psycopg2.extras
 
+from . import req_ctx
 from .tools import cur_ms, all_subclasses
 from .logging import LOG_WARN
 from .config import IS_TEST
@@ -405,10 +406,20 @@ class DatabaseNode:
 	@contextmanager
 	def use_conn(self):
 		conn = self.get_conn()
+		# within a request that has a deadline(route timeout_ms), statements
+		# are cancelled by postgres once the remaining budget runs out
+		remaining_ms = req_ctx.remaining_ms()
 		try:
+			if remaining_ms is not None:
+				with conn.cursor() as cur:
+					cur.execute("SET LOCAL statement_timeout = %s", (max(remaining_ms, 1),))
 			yield conn
 		finally:
-			self.put_conn(conn)
+			try:
+				if remaining_ms is not None:
+					conn.rollback()  # SET LOCAL ends with the transaction, no-op if committed
+			finally:
+				self.put_conn(conn)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -4,6 +4,11 @@ Created on 22-Aug-2017
 @author: abhinav
 '''
 import os
+import io
+import gzip
+import email.utils
+import types
+import collections.abc
 import gevent
 import ujson as json
 import re
@@ -15,21 +20,37 @@ import inspect
 import socket
 from gevent.socket import socket as GeventSocket
 from gevent.server import StreamServer
-from requests_toolbelt.multipart import decoder
+from gevent.lock import Semaphore
+from gevent.event import Event
 
 from . import req_ctx
 from .tools import set_socket_fast_close_options, \
-	BufferedSocket, ltrim, _OBJ_END_
+	BufferedSocket, ltrim, deadline_timeout, SingleFlight, _OBJ_END_
 from .tools.sanitize_html import HtmlSanitizedDict, HtmlSanitizedList
+from .tools.multipart import MultipartParser, MultipartAttachment, get_boundary
 from .utils import events
+from .utils.metrics import http_metrics
+from .utils.response_cache import ResponseCache
 from .utils.data_utils import FILE_EXTENSION_TO_MIME_TYPE
 from .logging import LOG_ERROR, LOG_SERVER, LOG_WARN, LOG_DEBUG, log_ctx
 from .schema import Object, schema as schema_func
 from .websocket.server import WebSocketServerHandler
-from .config import IS_DEV, BLASTER_HTTP_TOOK_LONG_WARN_THRESHOLD
-
-
-HTTP_SOCKET_MAX_TIMEOUT = 40
+from .config import IS_DEV, BLASTER_HTTP_TOOK_LONG_WARN_THRESHOLD, \
+	BLASTER_HTTP_MAX_CONNECTIONS, BLASTER_HTTP_MAX_CONCURRENCY, BLASTER_HTTP_MAX_QUEUE, \
+	BLASTER_HTTP_QUEUE_TIMEOUT_MS, BLASTER_HTTP_SHED_LATENCY_MS, BLASTER_HTTP_RETRY_AFTER, \
+	BLASTER_HTTP_IDLE_TIMEOUT, BLASTER_HTTP_HEADER_TIMEOUT, BLASTER_HTTP_MAX_IDLE_CONNECTIONS, \
+	BLASTER_HTTP_DRAIN_TIMEOUT
+try:
+	import brotli
+except ImportError:
+	brotli = None
+try:
+	import orjson  # faster json encoding, bytes directly
+except ImportError:
+	orjson = None
+
+
+HTTP_SOCKET_MAX_TIMEOUT = 40  # socket timeout while reading the body and sending the response
 if(IS_DEV):
 	# dev specific config
 	from .config import DEV_FORCE_ACCESS_CONTROL_ALLOW_ORIGIN
@@ -53,29 +74,173 @@ REUSE_SOCKET_FOR_HTTP = object()
 
 # some random constants
 _1_KB_ = 1024
+_64_KB_ = 64 * _1_KB_
 _1_MB_ = 1024 * _1_KB_
 HTTP_MAX_REQUEST_BODY_SIZE = 2 * _1_MB_  # 1 mb
 HTTP_MAX_HEADERS_DATA_SIZE = 16 * _1_KB_  # 16kb
+HTTP_CHUNKED_RESPONSE_FLUSH_SIZE = _64_KB_
+# response bodies smaller than this are not compressed
+HTTP_COMPRESS_MIN_SIZE = _1_KB_
+HTTP_COMPRESS_LEVEL = 6  # gzip 1-9, brotli 0-11
+COMPRESSIBLE_CONTENT_TYPE_REGEX = re.compile(
+	r'^(text/|image/svg|application/(json|javascript|xml|[^;]*\+json|[^;]*\+xml))', re.I
+)
+# lists longer than this are encoded in batches(ujson), so the whole
+# json str and its encoded bytes are not in memory at once
+HTTP_JSON_STREAM_MIN_ITEMS = 1024
+HTTP_JSON_STREAM_BATCH_SIZE = 256
 
 
 def get_chunk_size_from_header(chunk_header):
-	ret = 0
-	i = 0
-	chunk_header_len = len(chunk_header)
-	A = ord('A')
-	Z = ord('Z')
-	_0 = ord('0')
-	_9 = ord('9')
-	while(i < chunk_header_len):
-		c = ord(chunk_header[i])
-		if(c >= A and c <= Z):
-			ret = ret * 16 + (10 + c - A)
-		elif(c >= _0 and c <= _9):
-			ret = ret * 16 + (c - _0)
-		else:
-			return ret
-		i += 1
-	return ret
+	# hex size, may be followed by ;chunk-extensions
+	try:
+		return int(chunk_header.split(b';', 1)[0].strip(), 16)
+	except (ValueError, AttributeError):
+		return 0
+
+
+def encode_headers(headers):
+	return b''.join(
+		"{}: {}\r\n".format(key, val).encode() for key, val in headers.items()
+	)
+
+
+# Date header changes once a second, cache the encoded header
+_date_header = [0, b'']  # [timestamp seconds, header bytes]
+
+
+def get_date_header():
+	if((now := int(time.time())) != _date_header[0]):
+		_date_header[0] = now
+		_date_header[1] = b'Date: ' + email.utils.formatdate(now, usegmt=True).encode() + b'\r\n'
+	return _date_header[1]
+
+
+# preferred encoding among the ones client accepts and we support
+def get_accepted_encoding(accept_encoding):
+	if(not accept_encoding):
+		return None
+	qvalues = {}  # encoding -> q
+	for token in accept_encoding.split(","):
+		encoding, *params = token.split(";")
+		q = 1.0
+		try:
+			for param in params:
+				param = param.replace(" ", "")
+				if(param.startswith("q=")):
+					q = float(param[2:] or 0)
+		except ValueError:
+			continue  # malformed q, skip the token
+		qvalues[encoding.strip().lower()] = q
+	# not listed => q of *, q=0 => not acceptable
+	wildcard_q = qvalues.get("*", 0)
+	gzip_q = qvalues.get("gzip", wildcard_q)
+	br_q = qvalues.get("br", wildcard_q) if brotli else 0
+	if(br_q > 0 and br_q >= gzip_q):
+		return "br"  # preferred on ties
+	if(gzip_q > 0):
+		return "gzip"
+	return None
+
+
+# schema.Object, orm models and anything else with to_dict
+def _json_default(obj):
+	if((to_dict := getattr(obj, "to_dict", None)) is not None):
+		return to_dict()
+	raise TypeError("{} is not JSON serializable".format(type(obj).__name__))
+
+
+def is_json_body(body):
+	return isinstance(body, (dict, list)) or (
+		body is not None and not isinstance(body, (str, bytes, bytearray, memoryview))
+		and hasattr(body, "to_dict")
+	)
+
+
+# json response body as bytes
+def json_encode(obj):
+	if(orjson is not None):
+		try:
+			return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+		except TypeError:
+			pass  # ints of 64 bits or more etc, ujson encodes them
+	if(isinstance(obj, list) and len(obj) >= HTTP_JSON_STREAM_MIN_ITEMS):
+		buf = bytearray(b'[')
+		for i in range(0, len(obj), HTTP_JSON_STREAM_BATCH_SIZE):
+			if(i):
+				buf += b','
+			buf += json.dumps(obj[i: i + HTTP_JSON_STREAM_BATCH_SIZE], default=_json_default)[1:-1].encode()
+		buf += b']'
+		return buf
+	return json.dumps(obj, default=_json_default).encode()
+
+
+def compress_body(body, encoding, level=HTTP_COMPRESS_LEVEL):
+	if(encoding == "br"):
+		return brotli.compress(bytes(body), quality=min(level, 11))
+	return gzip.compress(body, compresslevel=min(max(level, 1), 9), mtime=0)
+
+
+# handler result with the cookies it set, shared by coalesced requests
+def _call_with_cookies_set(req, func, args, kwargs):
+	return func(*args, **kwargs), req._cookies_to_set
+
+
+def is_streaming_body(body):
+	return isinstance(body, (types.GeneratorType, collections.abc.Iterator))\
+		and not isinstance(body, (str, bytes, bytearray, memoryview))
+
+
+# sends each item of the iterator as a chunk, sendall blocks the
+# greenlet until the peer reads, so slow clients hold back the generator
+def send_chunked_body(buffered_socket, body):
+	content_length = 0
+	try:
+		for data in body:
+			if(isinstance(data, str)):
+				data = data.encode()
+			if(not data):
+				continue
+			content_length += len(data)
+			buffered_socket.sendb(b'%x\r\n' % len(data), data, b'\r\n')
+			if(len(buffered_socket.sendbuf) >= HTTP_CHUNKED_RESPONSE_FLUSH_SIZE):
+				buffered_socket.flush()
+		buffered_socket.sendb(b'0\r\n\r\n')
+	finally:
+		if(hasattr(body, "close")):
+			body.close()
+	return content_length
+
+
+# reads the header block upto the empty line at once, returns it unparsed
+# returns None if the block is larger than max_headers_data_size or socket broke
+def read_http_headers(buffered_socket, max_headers_data_size):
+	if(buffered_socket.peek(2) == b'\r\n'):
+		buffered_socket.recvn(2)  # no headers
+		return ""
+	data = buffered_socket.readuntil(b'\r\n\r\n', max_headers_data_size, True)
+	if(data is None):
+		return None
+	return data.decode()
+
+
+# first occurrence of a repeated header wins, same as Request._header
+def parse_http_headers(data, headers):
+	for line in data.split("\r\n"):
+		header_name, sep, header_value = line.partition(":")
+		if(sep):
+			headers.setdefault(header_name.lower(), header_value.lstrip(" "))
+	return headers
+
+
+def parse_cookies(cookie_header):
+	cookies = {}
+	if(cookie_header):
+		for i in cookie_header.strip().split(";"):
+			_kv = i.strip().split("=", 1)
+			if(len(_kv) > 1):
+				cookies[_kv[0]] = _kv[1]
+	return cookies
 
 
 # parse query string
@@ -105,6 +270,320 @@ class HeadersDict(dict):
 		return header_value
 
 
+# response body sent directly from the file with sendfile
+class SendFileBody:
+	__slots__ = ("file", "offset", "count")
+
+	def __init__(self, file, offset=0, count=None):
+		self.file = file
+		self.offset = offset
+		self.count = os.fstat(file.fileno()).st_size - offset if count is None else count
+
+	def __len__(self):
+		return self.count
+
+
+# file like reader over the request body on the socket,
+# decodes chunked transfer encoding lazily as the handler reads
+class RequestBodyStream(io.RawIOBase):
+	def __init__(
+		self, buffered_socket, content_length=0, is_chunked=False,
+		max_body_size=HTTP_MAX_REQUEST_BODY_SIZE,
+		max_headers_data_size=HTTP_MAX_HEADERS_DATA_SIZE
+	):
+		self.sock = buffered_socket
+		self.is_chunked = is_chunked
+		self.max_body_size = max_body_size
+		self.max_headers_data_size = max_headers_data_size
+		# bytes left in the body/current chunk
+		self.remaining = 0 if is_chunked else content_length
+		self.bytes_read = 0
+		self.is_done = not is_chunked and content_length <= 0
+
+	def readable(self):
+		return True
+
+	def _next_chunk(self):
+		if(self.bytes_read):
+			self.sock.readuntil('\r\n', 8, False)  # remove the trailing \r\n of previous chunk
+		chunk_header = self.sock.readuntil('\r\n', 512, True)
+		if(chunk_header is None):
+			raise Exception("remote socket closed")
+		self.remaining = get_chunk_size_from_header(chunk_header)  # hex
+		if(self.remaining <= 0):
+			# skip trailers until the empty line
+			while(self.sock.readuntil('\r\n', self.max_headers_data_size, True)):
+				pass
+			self.is_done = True
+
+	def read(self, n=-1):
+		if(n is None or n < 0):
+			return self.readall()
+		if(self.is_done or n == 0):
+			return b''
+		if(self.remaining <= 0):  # chunked
+			self._next_chunk()
+			if(self.is_done):
+				return b''
+
+		n = min(n, self.remaining)
+		if(self.bytes_read + n >= self.max_body_size):
+			raise Exception("Content length too large")
+
+		data = self.sock.recv(n)
+		if(not data):
+			raise Exception("remote socket closed")
+		self.remaining -= len(data)
+		self.bytes_read += len(data)
+		if(self.remaining <= 0 and not self.is_chunked):
+			self.is_done = True
+		return data
+
+	def readinto(self, buf):
+		data = self.read(len(buf))
+		buf[:len(data)] = data
+		return len(data)
+
+	def readall(self):
+		ret = bytearray()
+		while(data := self.read(_64_KB_)):
+			ret.extend(data)
+		return ret
+
+	def __iter__(self):
+		while(data := self.read(_64_KB_)):
+			yield data
+
+
+# concurrency limit with a bounded wait queue, requests that cannot get in
+# are rejected(shed) instead of piling up and slowing down everything
+class AdmissionLimit:
+	def __init__(
+		self, max_concurrency, max_queue=BLASTER_HTTP_MAX_QUEUE,
+		queue_timeout_ms=BLASTER_HTTP_QUEUE_TIMEOUT_MS,
+		shed_latency_ms=BLASTER_HTTP_SHED_LATENCY_MS
+	):
+		self.max_concurrency = int(max_concurrency)
+		self.max_queue = int(max_queue or 0)
+		self.queue_timeout = int(queue_timeout_ms or 0) / 1000
+		self.shed_latency_ms = int(shed_latency_ms or 0)
+		self.semaphore = Semaphore(self.max_concurrency)
+		self.queued = 0
+		self.latency_ms = 0  # moving average of latency of admitted requests
+
+	# returns None if admitted, else the reason for shedding
+	def acquire(self):
+		if(self.semaphore.acquire(blocking=False)):
+			return None
+		if(self.queued >= self.max_queue):
+			return "queue_full"
+		# already slow, queueing would only make it worse
+		if(self.shed_latency_ms and self.latency_ms > self.shed_latency_ms):
+			return "latency"
+		self.queued += 1
+		try:
+			if(not self.semaphore.acquire(timeout=self.queue_timeout)):
+				return "queue_timeout"
+		finally:
+			self.queued -= 1
+		return None
+
+	def release(self, wallclock_ms):
+		self.latency_ms += (wallclock_ms - self.latency_ms) * 0.1
+		self.semaphore.release()
+
+
+# idle and header read deadlines of all connections, checked by one greenlet
+# every second instead of a timer per socket. Expired connections are shut
+# down, which wakes up their greenlet blocked on recv with an EOF.
+# Idle connections are kept in order so the oldest go first when over the cap.
+class ConnectionTimers:
+	WHEEL_SIZE = 64  # slots of 1 second, longer deadlines wait for more rounds
+
+	def __init__(self, max_idle_connections=BLASTER_HTTP_MAX_IDLE_CONNECTIONS):
+		self.max_idle_connections = int(max_idle_connections)
+		self.wheel = [{} for i in range(self.WHEEL_SIZE)]  # {buffered_socket: deadline}
+		self.deadlines = {}  # buffered_socket -> deadline
+		self.idle = {}  # buffered_socket -> None, oldest first
+		self.last_tick = int(time.time())
+		self.ticker = None
+
+	def set_deadline(self, buffered_socket, timeout):
+		self.idle.pop(buffered_socket, None)
+		if((deadline := self.deadlines.get(buffered_socket)) is not None):
+			del self.wheel[deadline % self.WHEEL_SIZE][buffered_socket]
+		# not before the next tick, past slots are checked only in the next round
+		deadline = self.deadlines[buffered_socket] = max(int(time.time() + timeout), self.last_tick + 1)
+		self.wheel[deadline % self.WHEEL_SIZE][buffered_socket] = deadline
+
+	def set_idle(self, buffered_socket, timeout):
+		self.set_deadline(buffered_socket, timeout)
+		self.idle[buffered_socket] = None
+		if(len(self.idle) > self.max_idle_connections):
+			self.expire(next(iter(self.idle)))  # oldest
+
+	def remove(self, buffered_socket):
+		self.idle.pop(buffered_socket, None)
+		if((deadline := self.deadlines.pop(buffered_socket, None)) is not None):
+			del self.wheel[deadline % self.WHEEL_SIZE][buffered_socket]
+
+	def expire(self, buffered_socket):
+		self.remove(buffered_socket)
+		try:
+			buffered_socket.sock.shutdown(socket.SHUT_RDWR)
+		except Exception:
+			pass
+
+	def tick(self):
+		now = int(time.time())
+		# catch up on the seconds missed, atmost one full round
+		for t in range(max(self.last_tick + 1, now - self.WHEEL_SIZE + 1), now + 1):
+			slot = self.wheel[t % self.WHEEL_SIZE]
+			for buffered_socket, deadline in list(slot.items()):
+				if(deadline <= now):
+					self.expire(buffered_socket)
+		self.last_tick = now
+
+	def run(self):
+		while(True):
+			gevent.sleep(1)
+			self.tick()
+
+	def start(self):
+		self.ticker = gevent.spawn(self.run)
+
+	def stop(self):
+		self.ticker and self.ticker.kill(block=False)
+
+
+# {var} -> may be empty, {+var} -> non empty, {*var} -> rest of the path including '/'
+# {*+var} -> non empty rest of the path
+PATH_PARAM_SEGMENT_REGEX = re.compile(r'^\{(\*?)(\+?)([a-zA-Z_][a-zA-Z0-9_]*)\}$')
+# unescaped regex special chars, '.' is treated as literal in paths
+PATH_REGEX_SPECIAL_CHARS_REGEX = re.compile(r'(?<!\\)[\^\$\*\+\?\(\)\[\]\{\}\|]')
+
+
+class PathTreeNode:
+	__slots__ = (
+		"children", "param_children", "catch_all_children",
+		"param_name", "param_required", "method_handlers", "is_alias"
+	)
+
+	def __init__(self, param_name=None, param_required=False):
+		self.children = {}  # static segment -> PathTreeNode
+		self.param_children = []  # {var}, {+var}
+		self.catch_all_children = []  # {*var}, {*+var}
+		self.param_name = param_name
+		self.param_required = param_required
+		self.method_handlers = None  # {GET: handler, ...}
+		self.is_alias = False  # trailing slash alias of a child node
+
+	def get_param_child(self, children, param_name, param_required):
+		for child in children:
+			if(child.param_name == param_name and child.param_required == param_required):
+				return child
+		children.append(child := PathTreeNode(param_name, param_required))
+		return child
+
+
+# segment trie of the route paths, lookup cost depends on the
+# number of segments in the path and not on the number of routes.
+# precedence at each segment: static > {var} > {*var}, backtracks
+# if the matched branch doesn't have a handler for the method.
+class PathTree:
+	def __init__(self):
+		self.root = PathTreeNode()
+
+	@staticmethod
+	def parse(path):
+		# returns [(segment, param_name, is_catch_all, required)...]
+		# or None if it's a custom regex that cannot be put into the tree
+		if(not isinstance(path, str) or not path.startswith("/")):
+			return None
+		segments = path.split("/")
+		ret = []
+		for i, segment in enumerate(segments):
+			if(_match := PATH_PARAM_SEGMENT_REGEX.match(segment)):
+				is_catch_all, required, param_name = _match.groups()
+				if(is_catch_all and i != len(segments) - 1):
+					return None  # catch all should be the last segment
+				ret.append((None, param_name, bool(is_catch_all), bool(required)))
+			elif(PATH_REGEX_SPECIAL_CHARS_REGEX.search(segment)):
+				return None
+			else:
+				ret.append((re.sub(r'\\(.)', r'\1', segment), None, False, False))
+		return ret
+
+	# returns {method: handler} dict of the path to fill in
+	def add(self, path):
+		parsed_segments = PathTree.parse(path)
+		if(parsed_segments is None):
+			return None
+		parent = None
+		node = self.root
+		for segment, param_name, is_catch_all, required in parsed_segments:
+			parent = node
+			if(param_name is None):
+				if((child := node.children.get(segment)) is None):
+					node.children[segment] = child = PathTreeNode()
+				node = child
+			elif(is_catch_all):
+				node = node.get_param_child(node.catch_all_children, param_name, required)
+			else:
+				node = node.get_param_child(node.param_children, param_name, required)
+
+		if(node.method_handlers is None or node.is_alias):
+			node.method_handlers = {}
+			node.is_alias = False
+
+		# trailing slash is optional, /path/ also matches /path
+		if(
+			len(parsed_segments) > 2 and parsed_segments[-1] == ("", None, False, False)
+			and parent.method_handlers is None
+		):
+			parent.method_handlers = node.method_handlers
+			parent.is_alias = True
+
+		return node.method_handlers
+
+	def find(self, path, method, path_params):
+		return self._find(self.root, path.split("/"), 0, method, path_params)
+
+	def _find(self, node, segments, i, method, path_params):
+		num_segments = len(segments)
+		if(i == num_segments):
+			if(node.method_handlers):
+				return node.method_handlers.get(method)
+			return None
+
+		segment = segments[i]
+		if(
+			(child := node.children.get(segment)) is not None
+			and (handler := self._find(child, segments, i + 1, method, path_params))
+		):
+			return handler
+
+		for child in node.param_children:
+			if(
+				(segment or not child.param_required)
+				and (handler := self._find(child, segments, i + 1, method, path_params))
+			):
+				path_params[child.param_name] = segment
+				return handler
+
+		if(node.catch_all_children):
+			rest = "/".join(segments[i:]) if i < num_segments - 1 else segment
+			for child in node.catch_all_children:
+				if(
+					(rest or not child.param_required)
+					and child.method_handlers
+					and (handler := child.method_handlers.get(method))
+				):
+					path_params[child.param_name] = rest
+					return handler
+		return None
+
+
 # argument types
 class _Param:
 	def __init__(self, name=None, _type=str):
@@ -172,6 +651,12 @@ class Body(Object):
 _argument_creator_hooks = {}
 
 
+# handler didn't finish within the route's timeout_ms, a gevent.Timeout
+# (BaseException) so that `except Exception` in handler code can't swallow it
+class HandlerTimeoutException(gevent.Timeout):
+	pass
+
+
 class MissingBlasterArgumentException(Exception):
 	def __init__(self, arg_name, arg_type, *args: object) -> None:
 		self.arg_name = arg_name
@@ -186,6 +671,63 @@ def raise_ex(ex):
 	raise ex
 
 
+def _request_arg(req):  # req: Request
+	return req
+
+
+# generates one function per handler that binds all its arguments in a single
+# pass, plain typed params are looked up and validated inline(same as
+# Request.get), others call their arg generator
+def build_arg_binder(arg_generators, kwarg_generators, name="handler"):
+	namespace = {"_OBJ_END_": _OBJ_END_}
+	lines = ["def _bind(req):"]
+	if(any(hasattr(x, "_inline") for x in list(arg_generators) + [x for _, x in kwarg_generators])):
+		lines.append("\t_body = req._body")
+	arg_vars = []
+	kwarg_vars = []
+	for i, (arg_name, arg_generator) in enumerate(
+		[(None, x) for x in arg_generators] + list(kwarg_generators)
+	):
+		var = "v{}".format(i)
+		(arg_vars if arg_name is None else kwarg_vars).append((arg_name, var))
+		if(arg_generator is _request_arg):
+			lines.append("\t{} = req".format(var))
+		elif((inline := getattr(arg_generator, "_inline", None)) is not None):
+			param_name, validate, default, is_raw_safe = inline
+			namespace["validate" + var] = validate
+			namespace["default" + var] = default
+			# int/float/bool can't carry html, read without escaping. If the
+			# raw value fails, validate the escaped one for the same error
+			raw = ", escape_html=False" if is_raw_safe else ""
+			lines.extend(x.format(var, param_name, raw) for x in (
+				"\t{0} = _body.get({1!r}, default=_OBJ_END_{2}) if _body is not None else _OBJ_END_",
+				"\tif({0} is _OBJ_END_ and req._params):",
+				"\t\t{0} = req._params.get({1!r}, default=_OBJ_END_{2})",
+				"\tif({0} is _OBJ_END_):",
+				"\t\traise TypeError(\"{1} field is required\")" if default is _OBJ_END_
+				else "\t\t{0} = default{0}",
+				"\telse:"
+			))
+			if(is_raw_safe):
+				lines.extend(x.format(var, param_name) for x in (
+					"\t\ttry:",
+					"\t\t\t{0} = validate{0}({0})",
+					"\t\texcept Exception:",
+					"\t\t\t{0} = validate{0}(req.get({1!r}))"
+				))
+			else:
+				lines.append("\t\t{0} = validate{0}({0})".format(var))
+		else:
+			namespace["generator" + var] = arg_generator
+			lines.append("\t{0} = generator{0}(req)".format(var))
+	lines.append("\treturn ({}), {{{}}}".format(
+		"".join(var + ", " for _, var in arg_vars),
+		", ".join("{!r}: {}".format(arg_name, var) for arg_name, var in kwarg_vars)
+	))
+	exec(compile("\n".join(lines), "<arg_binder {}>".format(name), "exec"), namespace)
+	return namespace["_bind"]
+
+
 class Request:
 	# class level
 	_before_hooks = []
@@ -194,12 +736,16 @@ class Request:
 	# instance level
 	sock = None
 	wsock = None
-	_params = None
 	_body = None
 	_body_raw = None
+	_body_stream = None
 	_attachments = None
-	_cookies = None
-	_headers = None
+	# headers, query string and cookies are kept as received and
+	# parsed only when the handler asks for them
+	_raw_headers = ""
+	_raw_headers_lower = None
+	_query_string = None
+	_path_params = None
 	# cookies to send to client
 	_cookies_to_set = None
 	# url data, doesn't contain query string
@@ -241,10 +787,53 @@ class Request:
 		return self._headers.get("x-client") or ""
 
 	def __init__(self, buffered_socket):
-		self._params = HtmlSanitizedDict()  # empty params by default
-		self._headers = HeadersDict()
 		self.sock = buffered_socket
 
+	@functools.cached_property
+	def _headers(self):
+		return parse_http_headers(self._raw_headers, HeadersDict())
+
+	@functools.cached_property
+	def _params(self):
+		_params = HtmlSanitizedDict()  # empty params by default
+		if(self._query_string):
+			_params.update(parse_qs_modified(self._query_string))
+		# path matches override query params
+		if(self._path_params):
+			for path_param, path_param_value in self._path_params.items():
+				if(path_param_value):
+					_params[path_param] = path_param_value
+		return _params
+
+	@functools.cached_property
+	def _cookies(self):
+		return parse_cookies(self._header("cookie"))
+
+	# single header lookup (lowercase name) without parsing the whole block,
+	# used by the server for the few headers it needs on every request
+	def _header(self, name, default=None):
+		if((headers := self.__dict__.get("_headers")) is not None):
+			return headers.get(name, default)
+		if((raw_headers_lower := self._raw_headers_lower) is None):
+			if(not self._raw_headers.isascii()):
+				# lower() can change the length of non ascii text, offsets won't match
+				return self._headers.get(name, default)
+			raw_headers_lower = self._raw_headers_lower = "\r\n" + self._raw_headers.lower()
+		if((i := raw_headers_lower.find("\n" + name + ":")) == -1):
+			return default
+		i += len(name)  # offset in _raw_headers after the ':', lower has 2 more chars
+		j = self._raw_headers.find("\r\n", i)
+		return self._raw_headers[i: j if j != -1 else None].lstrip(" ")
+
+	# all values of a repeated header
+	def _header_values(self, name):
+		values = []
+		for line in self._raw_headers.split("\r\n"):
+			header_name, sep, header_value = line.partition(":")
+			if(sep and header_name.lower() == name):
+				values.append(header_value.lstrip(" "))
+		return values
+
 	# searches in post and get
 	def get(self, key, default=None, **kwargs):
 		val = _OBJ_END_
@@ -286,6 +875,10 @@ class Request:
 			return self._body.get(key, **kwargs)
 		return None
 
+	# file like stream of the body for routes with stream_body=True
+	def BODY_STREAM(self):
+		return self._body_stream
+
 	def ATTACHMENTS(self, key=None):
 		if(key == None):
 			return self._attachments
@@ -319,38 +912,39 @@ class Request:
 		if(isinstance(cookie_value, str)):
 			self._cookies_to_set[key] = cookie_value
 
+	# parses multipart body from an iterable of byte chunks, attachments
+	# are streamed into spooled files instead of being held in memory
+	def parse_multipart_body(self, body_chunks, content_type_header):
+		if(not (boundary := get_boundary(content_type_header))):
+			raise Exception("multipart: boundary missing")
+		parser = MultipartParser(boundary)
+		for data in body_chunks:
+			parser.feed(data)
+
+		self._body = _body = HtmlSanitizedDict()
+		for part in parser.close():
+			if(part.name is None):
+				part.file.close()
+				continue
+			if(part.is_field()):
+				_body[part.name] = part.file.read().decode()
+				part.file.close()
+			else:  # could be a file or other type of data, preserve all data
+				if(self._attachments is None):
+					self._attachments = {}
+				self._attachments[part.name] = MultipartAttachment(
+					attrs=part.attrs,
+					headers=part.headers,
+					file=part.file
+				)
+		return self
+
 	def parse_request_body(self, post_data_bytes, headers):
 		if(not post_data_bytes):
 			return None
-		_attachements = None
 		content_type_header = headers.get("Content-Type", "")
 		if(headers and content_type_header.startswith("multipart/form-data")):
-			self._body = _body = HtmlSanitizedDict()
-			for part in decoder.MultipartDecoder(post_data_bytes, content_type_header).parts:
-				content_disposition = part.headers.pop(b'Content-Disposition', None)
-				if(not content_disposition):
-					continue
-				attrs = {}
-				for i in content_disposition.split(b';'):
-					key_val = i.split(b'=')
-					if(len(key_val) == 2):
-						key = key_val[0].strip().decode()
-						val = key_val[1].strip(b'"\'').decode()
-						attrs[key] = val
-				name = attrs.pop('name', _OBJ_END_)
-				if(name is not _OBJ_END_):
-					# if no additional headers, and no other attributes,
-					# it's just a plain input field
-					if(not part.headers and not attrs):
-						_body[name] = part.text
-					else:  # could be a file or other type of data, preserve all data
-						if(self._attachments == None):
-							self._attachments = _attachements = {}
-						_attachements[name] = {
-							"attrs": attrs,
-							"data": part.content,
-							"headers": part.headers
-						}
+			self.parse_multipart_body((post_data_bytes,), content_type_header)
 		else:
 			post_data_str = post_data_bytes.decode('utf-8')
 			if(
@@ -398,7 +992,7 @@ class Request:
 			that create the argument from the request
 		'''
 		if(_type == Request):  # req: Request
-			return lambda req: req
+			return _request_arg
 		elif(_type == Query):  # query: Query
 			return lambda req: req._params
 		elif(_type == Headers):  # headers: Headers
@@ -450,6 +1044,8 @@ class Request:
 						raise TypeError("{:s} field is required".format(name))
 					return default
 				return validate(ret)
+			# binder reads it inline
+			_no_type_arg._inline = (name, validate, default, _type in (int, float, bool))
 			return _no_type_arg
 
 	def to_dict(self):
@@ -464,10 +1060,17 @@ _all_apps = set()
 class App:
 	route_handlers = None
 	request_handlers = None
+	path_tree = None
 	name = None
 	stream_server = None
 	server_exception_handlers = None
 	is_running = False
+	connection_timers = None
+	connections = None  # live connections, except the ones handed over(websockets)
+	is_draining = False
+	drained = None
+	idle_timeout = BLASTER_HTTP_IDLE_TIMEOUT
+	header_timeout = BLASTER_HTTP_HEADER_TIMEOUT
 
 	def __init__(self, server_exception_handlers=None, **kwargs):
 		self.info = {
@@ -486,10 +1089,27 @@ class App:
 		title='',
 		description='',
 		max_body_size=None,
+		stream_body=False,
+		compress_level=HTTP_COMPRESS_LEVEL,
+		headers=None,
 		before=None,
-		after=None
+		after=None,
+		max_concurrency=None,
+		max_queue=BLASTER_HTTP_MAX_QUEUE,
+		queue_timeout_ms=BLASTER_HTTP_QUEUE_TIMEOUT_MS,
+		shed_latency_ms=BLASTER_HTTP_SHED_LATENCY_MS,
+		timeout_ms=None,
+		cache=None,
+		coalesce=False,
+		ws_deflate=None
 	):
 		methods = methods or ("GET", "POST", "HEAD")
+		# cache=ttl millis or ResponseCache kwargs or a ResponseCache
+		if(cache is not None and not isinstance(cache, ResponseCache)):
+			cache = ResponseCache(
+				name=regex if isinstance(regex, str) else regex.pattern,
+				**(cache if isinstance(cache, dict) else {"ttl": cache})
+			)
 		if(isinstance(methods, str)):
 			methods = (methods,)
 
@@ -498,6 +1118,8 @@ class App:
 			# all untyped arguments are ignored should possiblly come from regex groups
 			# typed args should be constructed, some may be constructed by hooks
 			# named arguments not typed as passed on as with defaults
+			if(coalesce and inspect.isgeneratorfunction(func)):
+				raise Exception("coalesce: {} streams its response, cannot be shared".format(func.__name__))
 
 			self.route_handlers.append({
 				"regex": regex,
@@ -506,15 +1128,53 @@ class App:
 				"title": title,
 				"description": description,
 				"max_body_size": max_body_size,
+				"stream_body": stream_body,
+				"compress_level": compress_level,  # 0 disables compression
+				"headers": headers,  # static headers sent with every response
 				"after": [after] if callable(after) else list(after or []),
-				"before": [before] if callable(before) else list(before or [])
+				"before": [before] if callable(before) else list(before or []),
+				# deadline for the handler, counted from the start of the request
+				"timeout_ms": timeout_ms,
+				# route level limit, checked after the app level limit
+				"admission_limit": max_concurrency and AdmissionLimit(
+					max_concurrency, max_queue=max_queue,
+					queue_timeout_ms=queue_timeout_ms, shed_latency_ms=shed_latency_ms
+				),
+				# encoded GET responses, served before admission control
+				"response_cache": cache,
+				# identical concurrent GETs share one handler call
+				"singleflight": SingleFlight() if coalesce else None,
+				# True or PerMessageDeflate kwargs(window_bits, no_context_takeover, min_size, level)
+				"ws_deflate": ws_deflate
 			})
 			# return func as if nothing's decorated! (so you can call function as is)
 			return func
 
 		return wrapper
 
-	def start(self, port=80, handlers=[], **ssl_args):
+	def start(
+		self, port=80, handlers=[],
+		max_connections=BLASTER_HTTP_MAX_CONNECTIONS,
+		max_concurrency=BLASTER_HTTP_MAX_CONCURRENCY,
+		max_queue=BLASTER_HTTP_MAX_QUEUE,
+		queue_timeout_ms=BLASTER_HTTP_QUEUE_TIMEOUT_MS,
+		shed_latency_ms=BLASTER_HTTP_SHED_LATENCY_MS,
+		idle_timeout=BLASTER_HTTP_IDLE_TIMEOUT,
+		header_timeout=BLASTER_HTTP_HEADER_TIMEOUT,
+		max_idle_connections=BLASTER_HTTP_MAX_IDLE_CONNECTIONS,
+		**ssl_args
+	):
+		self.idle_timeout = int(idle_timeout)
+		self.header_timeout = int(header_timeout)
+		self.connection_timers = ConnectionTimers(max_idle_connections)
+		self.connections = set()
+		self.is_draining = False
+		self.drained = Event()
+		# app level limit, shared by all routes
+		app_admission_limit = int(max_concurrency or 0) and AdmissionLimit(
+			max_concurrency, max_queue=max_queue,
+			queue_timeout_ms=queue_timeout_ms, shed_latency_ms=shed_latency_ms
+		)
 		# sort descending order of the path lengths
 		self.route_handlers.sort(
 			key=lambda x: (-x["regex"].count("/"), x["regex"].split("/")),
@@ -558,9 +1218,11 @@ class App:
 		schema_func.init()
 
 		regexes_map = {}  # cache/update/overwrite
+		self.path_tree = PathTree()
+		binders_build_time = 0
 
-		# iterate larger to smaller path and fill the request_handlers map
-		# build request_handlers map => {regex: {GET: handler,...}...}
+		# iterate larger to smaller path and fill the path tree,
+		# custom regexes go into request_handlers => [(regex, {GET: handler,...})...]
 		for handler in self.route_handlers:
 			regex = handler["regex"]
 
@@ -568,34 +1230,45 @@ class App:
 			handler["path_params"] = _path_params = {}
 			if(isinstance(regex, str)):
 				# special case where path params can be {:varname} {:+varname}
-				# replacing regex with regex haha!
 				_path_params.update({x: False for x in re.findall(r'\{([a-zA-Z_][a-zA-Z0-9_]*)\}', regex)})  # {varname} -> may exist
 				_path_params.update({x: True for x in re.findall(r'\{\+([a-zA-Z_][a-zA-Z0-9_]*)\}', regex)})  # {+varname} -> should exist
 				_path_params.update({x: True for x in re.findall(r'\{\*([a-zA-Z_][a-zA-Z0-9_]*)\}', regex)})  # {*varname} -> may exist including '/'
 
-				regex = re.sub(r'\{([a-zA-Z_][a-zA-Z0-9_]*)\}', '(?P<\g<1>>[^/]*)', regex)
-				regex = re.sub(r'\{\+([a-zA-Z_][a-zA-Z0-9_]*)\}', '(?P<\g<1>>[^/]+)', regex)
-				regex = re.sub(r'\{\*([a-zA-Z_][a-zA-Z0-9_]*)\}', '(?P<\g<1>>.*)', regex)
-				regex = re.sub(r'\{\*\+([a-zA-Z_][a-zA-Z0-9_]*)\}', '(?P<\g<1>>.+)', regex)
-
-			existing_regex_method_handlers = regexes_map.get(regex)
-			if(not existing_regex_method_handlers):
-				regexes_map[regex] = existing_regex_method_handlers = {}
-
-				# check for full path matches, if the given regex doesn't match or end
-				if(not regex.startswith("^")):
-					regex = "^" + regex
-				if(regex.endswith("/")):
-					regex += "?"
-				if(not regex.endswith("$")):
-					regex = regex + "$"
-
-				self.request_handlers.append(
-					(re.compile(regex), existing_regex_method_handlers)
-				)
+			# static segments and path params go into the tree
+			existing_regex_method_handlers = self.path_tree.add(regex)
+			if(existing_regex_method_handlers is None and isinstance(regex, str)):
+				# replacing regex with regex haha!
+				regex = re.sub(r'\{([a-zA-Z_][a-zA-Z0-9_]*)\}', r'(?P<\g<1>>[^/]*)', regex)
+				regex = re.sub(r'\{\+([a-zA-Z_][a-zA-Z0-9_]*)\}', r'(?P<\g<1>>[^/]+)', regex)
+				regex = re.sub(r'\{\*([a-zA-Z_][a-zA-Z0-9_]*)\}', r'(?P<\g<1>>.*)', regex)
+				regex = re.sub(r'\{\*\+([a-zA-Z_][a-zA-Z0-9_]*)\}', r'(?P<\g<1>>.+)', regex)
+
+				existing_regex_method_handlers = regexes_map.get(regex)
+				if(not existing_regex_method_handlers):
+					regexes_map[regex] = existing_regex_method_handlers = {}
+
+					# check for full path matches, if the given regex doesn't match or end
+					if(not regex.startswith("^")):
+						regex = "^" + regex
+					if(regex.endswith("/")):
+						regex += "?"
+					if(not regex.endswith("$")):
+						regex = regex + "$"
+
+					self.request_handlers.append(
+						(re.compile(regex), existing_regex_method_handlers)
+					)
+			elif(existing_regex_method_handlers is None):  # precompiled regex
+				existing_regex_method_handlers = {}
+				self.request_handlers.append((regex, existing_regex_method_handlers))
 
 			for method in handler["methods"]:
 				existing_regex_method_handlers[method.upper()] = handler
+			# per method latency/status/bytes metrics of this route
+			_route_name = handler["regex"] if isinstance(handler["regex"], str) else handler["regex"].pattern
+			handler["metrics"] = {
+				method.upper(): http_metrics.get(_route_name, method.upper()) for method in handler["methods"]
+			}
 			# infer arguments from the typing
 			func = handler["func"]
 			original_func = getattr(func, "_original", func)
@@ -635,13 +1308,48 @@ class App:
 			handler["kwargs"] = kwargs
 			handler["arg_generators"] = arg_generators
 			handler["kwarg_generators"] = kwarg_generators
+			_binder_start_time = time.time()
+			handler["arg_binder"] = build_arg_binder(arg_generators, kwarg_generators, name=_route_name)
+			binders_build_time += time.time() - _binder_start_time
 
 			if(func_signature.return_annotation != inspect._empty):
 				handler["return"] = func_signature.return_annotation
 
+			# encode default + route static headers once
+			route_headers = handler.get("headers") or {}
+			handler["headers"] = {
+				k: v for k, v in default_stream_headers.items() if k not in route_headers
+			}
+			handler["headers"].update(route_headers)
+			handler["headers_block"] = encode_headers(handler["headers"])
+
+			handler["admission_limits"] = tuple(
+				x for x in (app_admission_limit, handler.get("admission_limit")) if x
+			)
+
 			# fix before and after functions at start, cannot be modified later
 			handler["before"] = tuple(handler.get("before", []) + Request._before_hooks)
 			handler["after"] = tuple(handler.get("after", []) + Request._after_hooks)
+			# coalesced requests share one response object, after hooks would modify it for all
+			if(handler.get("singleflight") is not None and handler["after"]):
+				raise Exception(
+					"route {} is coalesced, it cannot have after hooks".format(_route_name)
+				)
+			# cache hits skip before hooks and arg type hooks(user: User..),
+			# they must not leak one user's response to another
+			if(
+				(response_cache := handler.get("response_cache")) is not None
+				and (
+					handler["before"]
+					or any(_type in _argument_creator_hooks for _name, _type, _default in args + kwargs)
+				)
+				and not {"cookie", "authorization"}.intersection(response_cache.headers)
+			):
+				raise Exception(
+					"route {} has before hooks or hooked args, response cache must be keyed by cookie/authorization headers".format(
+						response_cache.name
+					)
+				)
 
 			# openapi docs
 			self.generate_openapi_doc(handler)
@@ -667,13 +1375,21 @@ class App:
 					address
 				)
 
-		LOG_SERVER("server_start", port=port)
+		LOG_SERVER(
+			"server_start", port=port,
+			arg_binders=len(self.route_handlers), arg_binders_build_ms=int(binders_build_time * 1000)
+		)
+		self.port = port
 		self.stream_server = CustomStreamServer(
 			('', port),
-			spawn=100000,
+			spawn=int(max_connections),
 			handle=self.handle_connection,
 			**ssl_args
 		)
+		# serve_forever stops the server when closed and kills the handlers
+		# after stop_timeout, give them until the drain deadline
+		self.stream_server.stop_timeout = BLASTER_HTTP_DRAIN_TIMEOUT + 1
+		self.connection_timers.start()
 		# keep a track
 		self.is_running = True
 
@@ -819,10 +1535,35 @@ class App:
 	def serve(self):
 		self.stream_server.serve_forever()
 
-	def stop(self):
+	# stop accepting, requests in flight finish and their connections
+	# are closed after the response(Connection: close)
+	def drain(self):
+		if(self.is_draining):
+			return
+		self.is_draining = True
+		self.stream_server.close()  # refuse new connections
+		# idle keep-alive connections get a moment for a request already on its way
+		for buffered_socket in list(self.connection_timers.idle):
+			self.connection_timers.set_deadline(buffered_socket, 1)
+		if(not self.connections):
+			self.drained.set()
+		LOG_SERVER("server_draining", port=self.port, connections=len(self.connections))
+
+	def stop(self, drain_timeout=BLASTER_HTTP_DRAIN_TIMEOUT):
+		self.drain()
+		if(not self.drained.wait(drain_timeout)):
+			LOG_WARN("server_drain_timeout", port=self.port, connections=len(self.connections))
+			for buffered_socket in list(self.connections):
+				try:
+					buffered_socket.sock.shutdown(socket.SHUT_RDWR)
+				except Exception:
+					pass
+		else:
+			LOG_SERVER("server_drained", port=self.port)
 		self.is_running = False
-		self.stream_server.stop()
-		_all_apps.remove(self)
+		self.stream_server.stop(timeout=1)
+		self.connection_timers.stop()
+		_all_apps.discard(self)
 
 	@classmethod
 	def response_body_to_parts(cls, ret):
@@ -843,13 +1584,21 @@ class App:
 	# returns none or REUSE_SOCKET_FOR_HTTP
 	def process_http_request(self, buffered_socket: BufferedSocket):
 		reuse_socket_for_next_http_request = True
+		response_started = False  # status line and headers already flushed
 		# ignore request lines > 4096 bytes
 		post_data = None
 		# set all usable timestamp variables at once
 		req = Request(buffered_socket)
 		request_type = None
 		request_path = None
-		headers = None
+		status = None
+		route_metrics = None
+		admitted_limits = []
+		handler_timeout = None
+		body_stream = None
+		bytes_out = 0
+		response_cache = cache_key = None
+		is_cache_leader = False  # computing the response for the cache
 		# READ FIRST REQUEST LINE
 		try:
 			if(not (request_line := buffered_socket.readuntil('\r\n', 4096, True))):
@@ -860,10 +1609,11 @@ class App:
 		# IMP:  RESET ALL CTX VARIABLES
 		req_ctx.req = req  # useful to not passing req around
 		req_ctx.cache = {}
+		req_ctx.deadline = None
 		cur_millis \
 			= req_ctx.timestamp \
 			= req.timestamp \
-			= int(1000 * time.time())
+			= int(1000 * (start_time := time.time()))
 		log_ctx._trace_id = None
 
 		try:
@@ -879,8 +1629,7 @@ class App:
 			# http_version = _request_line[_http_protocol_index + 1:]
 			query_start_index = request_path.find("?")
 			if(query_start_index != -1):
-				query_string = request_path[query_start_index + 1:]
-				req._params.update(parse_qs_modified(query_string))
+				req._query_string = request_path[query_start_index + 1:]
 
 				# strip query string from path
 				request_path \
@@ -888,97 +1637,159 @@ class App:
 					= request_path[:query_start_index]
 
 			# find the handler
-			handler = None
-			for regex, method_handlers in self.request_handlers:
-				request_path_match = regex.match(request_path)
-
-				if(request_path_match is not None):
-					# check if handler has request type handler
-					if(handler := method_handlers.get(request_type)):
-						# found the handler
-						break
+			path_params = {}
+			handler = self.path_tree.find(request_path, request_type, path_params)
+			if(not handler):
+				# fallback to custom regexes
+				for regex, method_handlers in self.request_handlers:
+					request_path_match = regex.match(request_path)
+
+					if(request_path_match is not None):
+						# check if handler has request type handler
+						if(handler := method_handlers.get(request_type)):
+							# found the handler
+							path_params = request_path_match.groupdict()
+							break
 
 			if(not handler):
 				reuse_socket_for_next_http_request = False
 				raise Exception("Method not found")
 
-			# parse the headers
-			headers = req._headers
+			req._path_params = path_params
+			# read the headers, parsed lazily
 			max_headers_data_size \
 				= handler.get("max_headers_data_size") or HTTP_MAX_HEADERS_DATA_SIZE
-			_headers_data_size = 0
-			while(_headers_data_size < max_headers_data_size):  # keep reading headers
-				data = buffered_socket.readuntil('\r\n', max_headers_data_size, True)
-				if(data == b''):
-					break
-				elif(data is None):
-					return  # won't resuse socket
-
-				header_name_value_pair = data.split(b':', 1)
-				if(len(header_name_value_pair) == 2):
-					header_name, header_value = header_name_value_pair
-					headers[header_name.lower().decode()] = header_value.lstrip(b' ').decode()
-
-				_headers_data_size += len(data)
+			try:
+				raw_headers = read_http_headers(buffered_socket, max_headers_data_size)
+			except Exception:
+				raw_headers = None  # header timeout or broken connection
+			if(raw_headers is None):
+				return  # won't resuse socket
+			req._raw_headers = raw_headers
+			# request is in, back to the socket timeout for body and response
+			self.connection_timers.remove(buffered_socket)
+			buffered_socket.sock.settimeout(HTTP_SOCKET_MAX_TIMEOUT)
+			if((route_metrics := handler["metrics"].get(request_type)) is not None):
+				route_metrics.in_flight += 1
 
 			# check if there is a content length or transfer encoding chunked
-			content_length = int(headers.get("content-length", 0))
+			if(
+				(content_length := int(req._header("content-length", 0)))
+				and len(set(req._header_values("content-length"))) > 1
+			):
+				reuse_socket_for_next_http_request = False
+				raise Exception("Conflicting Content-Length headers")
 			_max_body_size = handler.get("max_body_size") or HTTP_MAX_REQUEST_BODY_SIZE
-			if(content_length > 0):
-				if(content_length < _max_body_size):
-					post_data = buffered_socket.recvn(content_length)
-				else:
+			if(content_length >= _max_body_size):
+				reuse_socket_for_next_http_request = False
+				raise Exception("Content length too large")
+			transfer_encoding = req._header("transfer-encoding")
+
+			# cached response, or wait for the greenlet computing it
+			if(
+				(response_cache := handler.get("response_cache")) is not None
+				and request_type == "GET"
+				and not content_length and not transfer_encoding
+			):
+				cache_key = response_cache.key(
+					req,
+					handler.get("compress_level", HTTP_COMPRESS_LEVEL)
+					and get_accepted_encoding(req._header("accept-encoding"))
+				)
+				cached_response, is_cache_leader = response_cache.lookup(cache_key)
+				if(cached_response is not None):
+					_, status_line, headers_block, body = cached_response
+					if(_connection_header := req._header("connection")):
+						reuse_socket_for_next_http_request \
+							= _connection_header.lower() != "close"
+					if(self.is_draining):
+						reuse_socket_for_next_http_request = False
+					status = status_line[9:-2].decode()
+					buffered_socket.sendb(
+						status_line, get_date_header(), headers_block,
+						b'\r\n' if reuse_socket_for_next_http_request else b'Connection: close\r\n\r\n',
+						body
+					)
+					if(
+						not reuse_socket_for_next_http_request
+						or not buffered_socket.buffered_len()
+					):
+						buffered_socket.flush()
+					bytes_out = len(body)
+					LOG_SERVER(
+						"http", response_status=status, request_type=request_type,
+						path=request_path, content_length=bytes_out, cached=True,
+						wallclockms=int(1000 * time.time()) - cur_millis
+					)
+					return REUSE_SOCKET_FOR_HTTP if reuse_socket_for_next_http_request else None
+
+			# admission control, fail fast with 503 before reading the body
+			for admission_limit in handler["admission_limits"]:
+				if(shed_reason := admission_limit.acquire()):
+					route_metrics is not None and route_metrics.observe_shed(shed_reason)
+					if(content_length > 0 or transfer_encoding):
+						reuse_socket_for_next_http_request = False  # body not read
+					status = "503 Service Unavailable"
+					buffered_socket.sendb(
+						b'HTTP/1.1 503 Service Unavailable\r\n', get_date_header(),
+						b'Retry-After: ', str(BLASTER_HTTP_RETRY_AFTER), b'\r\n',
+						b'Content-Length: 0\r\n',
+						b'\r\n' if reuse_socket_for_next_http_request else b'Connection: close\r\n\r\n'
+					)
+					if(
+						not reuse_socket_for_next_http_request
+						or not buffered_socket.buffered_len()
+					):
+						buffered_socket.flush()
+					return REUSE_SOCKET_FOR_HTTP if reuse_socket_for_next_http_request else None
+				admitted_limits.append(admission_limit)
+
+			body_stream = None
+			if(content_length > 0 or (transfer_encoding and "chunked" in transfer_encoding)):
+				body_stream = RequestBodyStream(
+					buffered_socket, content_length=content_length,
+					is_chunked=content_length <= 0,
+					max_body_size=_max_body_size,
+					max_headers_data_size=max_headers_data_size
+				)
+			if(handler.get("stream_body")):
+				# handler reads the body from the socket itself
+				req._body_stream = body_stream or RequestBodyStream(buffered_socket)
+			elif(
+				body_stream is not None
+				and (content_type := req._header("content-type", "")).startswith("multipart/form-data")
+			):
+				# parse as it arrives, attachments are spooled to files
+				try:
+					req.parse_multipart_body(body_stream, content_type)
+				except Exception:
+					reuse_socket_for_next_http_request = False
+					raise
+			elif(content_length > 0):
+				post_data = buffered_socket.recvn(content_length)
+			elif(body_stream is not None):  # handle chuncked encoding
+				try:
+					post_data = body_stream.readall()
+				except Exception:
 					reuse_socket_for_next_http_request = False
-					raise Exception("Content length too large")
-			else:  # handle chuncked encoding
-				transfer_encoding = headers.get("transfer-encoding")
-				if(transfer_encoding and "chunked" in transfer_encoding):
-					post_data = bytearray()
-					chunk_size = get_chunk_size_from_header(
-						buffered_socket.readuntil('\r\n', 512, True)
-					)  # hex
-					while(chunk_size > 0 and len(post_data) + chunk_size < _max_body_size):
-						data = buffered_socket.recvn(chunk_size)
-						post_data.extend(data)
-						buffered_socket.readuntil('\r\n', 8, False)  # remove the trailing \r\n
-						# next chunk size
-						chunk_size = get_chunk_size_from_header(
-							buffered_socket.readuntil('\r\n', 512, True)
-						)  # hex
-					# as bytes
+					raise
 
 			func = handler.get("func")
-			# process cookies
-			cookie_header = headers.get("Cookie", None)
-			decoded_cookies = {}
-			if(cookie_header):
-				_temp = cookie_header.strip().split(";")
-				for i in _temp:
-					_kv = i.strip().split("=", 1)
-					if(len(_kv) > 1):
-						decoded_cookies[_kv[0]] = _kv[1]
-			req._cookies = decoded_cookies
-			# process cookies end
 			req._body_raw = post_data
-			req.parse_request_body(post_data, headers)
-
-			handler_args = []
-			handler_kwargs = {}
-
-			# update any path matches if they exist
-			path_params = request_path_match.groupdict()
-			for path_param, path_param_value in path_params.items():
-				if(path_param_value):
-					req._params[path_param] = path_param_value
+			if(post_data):
+				req.parse_request_body(post_data, req._headers)
 
 			# set a reference to handler
 			req.handler = handler
 
-			for _arg_generator in handler["arg_generators"]:
-				handler_args.append(_arg_generator(req))
+			if(timeout_ms := handler.get("timeout_ms")):
+				# remaining budget is visible to db/http calls through req_ctx
+				req_ctx.deadline = start_time + timeout_ms / 1000
+				handler_timeout = HandlerTimeoutException.start_new(
+					max(req_ctx.deadline - time.time(), 0.001)
+				)
 
-			for name, _kwarg_generator in handler["kwarg_generators"]:
-				handler_kwargs[name] = _kwarg_generator(req)
+			handler_args, handler_kwargs = handler["arg_binder"](req)
 
 			before_handling_hooks = handler.get("before")
 			after_handling_hooks = handler.get("after")
@@ -991,26 +1802,63 @@ class App:
 
 			if(not response_from_handler):
 				# if before handlers return already something
-				response_from_handler = func(*handler_args, **handler_kwargs)
+				if(
+					(singleflight := handler.get("singleflight")) is not None
+					and (request_type == "GET" or request_type == "HEAD")
+					and body_stream is None
+				):
+					# same path, query and identity => same response
+					(response_from_handler, cookies_to_set), is_coalesced = singleflight.run(
+						(request_path, req._query_string, req._header("cookie"), req._header("authorization")),
+						_call_with_cookies_set, req, func, handler_args, handler_kwargs
+					)
+					if(is_coalesced):
+						if(is_streaming_body(App.response_body_to_parts(response_from_handler)[2])):
+							# an iterator can be read only once, run our own
+							response_from_handler = func(*handler_args, **handler_kwargs)
+						else:
+							if(cookies_to_set):  # set by the handler for the leader's request
+								req._cookies_to_set = dict(cookies_to_set)
+							if(route_metrics is not None):
+								route_metrics.coalesced += 1
+				else:
+					response_from_handler = func(*handler_args, **handler_kwargs)
 
 				for after_handling_hook in after_handling_hooks:  # post processing
 					response_from_handler = after_handling_hook(req, response_from_handler)
 
-				# if there is connection header, handle it
-				if(_connection_header := headers.get('Connection')):
-					reuse_socket_for_next_http_request \
-						= _connection_header.lower() != "close"
-				# app specific headers
-				# handle various return values from handler functions
+			if(handler_timeout is not None):
+				handler_timeout.close()
+
+			# if there is connection header, handle it
+			if(_connection_header := req._header("connection")):
+				reuse_socket_for_next_http_request \
+					= _connection_header.lower() != "close"
+			if(self.is_draining):
+				reuse_socket_for_next_http_request = False  # last response on this connection
+			# body not fully read by the handler, cannot reuse the socket
+			if(req._body_stream is not None and not req._body_stream.is_done):
+				reuse_socket_for_next_http_request = False
+
+			# app specific headers
+			# handle various return values from handler functions
 
 			status, response_headers, body = App.response_body_to_parts(response_from_handler)
 
+			# everything written from here is the encoded response
+			response_sendbuf = buffered_socket.sendbuf
+			response_start = len(response_sendbuf)
+
 			# resp.1 Send status line
 			if(status or (body is not I_AM_HANDLING_THE_SOCKET)):
 				# we will send the status, either default
 				# or given from response
-				status = str(status) if status else '200 OK'
-				buffered_socket.sendb(b'HTTP/1.1 ', status, b'\r\n')
+				if(status):
+					status = str(status)
+					buffered_socket.sendb(b'HTTP/1.1 ', status, b'\r\n')
+				else:
+					status = '200 OK'
+					buffered_socket.sendb(b'HTTP/1.1 200 OK\r\n')
 
 			# resp.2 Send headers
 			if(response_headers or (body is not I_AM_HANDLING_THE_SOCKET)):
@@ -1022,24 +1870,35 @@ class App:
 						buffered_socket.sendb(header, b'\r\n')
 
 				else:
-					if(isinstance(response_headers, dict)):
+					if(response_headers is None):  # no headers => use default stream headers
+						# precomputed default + route headers
+						response_headers = handler["headers"]
+						buffered_socket.sendb(get_date_header(), handler["headers_block"])
+
+					elif(response_headers.keys().isdisjoint(handler["headers"])):
+						# nothing to override, precomputed default + route headers
+						if('Date' not in response_headers):
+							buffered_socket.sendb(get_date_header())
+						buffered_socket.sendb(handler["headers_block"])
+						for key, val in response_headers.items():
+							buffered_socket.sendb(key, b': ', val, b'\r\n')
+
+					else:
 						# mix default stream headers
-						# add default stream headers
-						for key, val in default_stream_headers.items():
+						if('Date' not in response_headers):
+							buffered_socket.sendb(get_date_header())
+						for key, val in handler["headers"].items():
 							if(key not in response_headers):
 								buffered_socket.sendb(key, b': ', val, b'\r\n')
 
-					elif(response_headers is None):  # no headers => use default stream headers
-						response_headers = default_stream_headers
-
-					# Send all specified headers
-					for key, val in response_headers.items():
-						buffered_socket.sendb(key, b': ', val, b'\r\n')
+						# Send all specified headers
+						for key, val in response_headers.items():
+							buffered_socket.sendb(key, b': ', val, b'\r\n')
 
 				# perform any dev specific things
 				if(IS_DEV):
 					if(DEV_FORCE_ACCESS_CONTROL_ALLOW_ORIGIN):
-						allowed_origins = headers.get("origin", "*")
+						allowed_origins = req._header("origin", "*")
 						if(isinstance(DEV_FORCE_ACCESS_CONTROL_ALLOW_ORIGIN, str)):
 							allowed_origins = DEV_FORCE_ACCESS_CONTROL_ALLOW_ORIGIN
 
@@ -1077,19 +1936,56 @@ class App:
 
 			# resp.3.2 Send finalizing headers(content related only) and body
 			else:
-				if(isinstance(body, (dict, list))):
-					body = json.dumps(body)
+				# compress only the content types we know, not when handler sent raw headers
+				is_compressible = False
+				if(is_json_body(body)):
+					body = json_encode(body)
 					buffered_socket.sendb(b'Content-Type: application/json\r\n')
-				elif(isinstance(response_headers, dict) and ("Content-Type" not in response_headers)):
-					buffered_socket.sendb(b'Content-Type: text/html; charset=utf-8\r\n')
+					is_compressible = not isinstance(response_headers, list)
+				elif(isinstance(response_headers, dict)):
+					if((content_type := response_headers.get("Content-Type")) is None):
+						buffered_socket.sendb(b'Content-Type: text/html; charset=utf-8\r\n')
+						content_type = "text/html"
+					is_compressible = COMPRESSIBLE_CONTENT_TYPE_REGEX.match(content_type) is not None\
+						and "Content-Encoding" not in response_headers
 
 				# encode body
 				if(isinstance(body, str)):
 					body = body.encode()
 
+				# compress if client accepts
+				if(
+					is_compressible
+					and (not status or str(status).startswith("200"))
+					and (compress_level := handler.get("compress_level", HTTP_COMPRESS_LEVEL))
+					and request_type != "HEAD"
+					and isinstance(body, (bytes, bytearray))
+					and len(body) >= HTTP_COMPRESS_MIN_SIZE
+					and (encoding := get_accepted_encoding(req._header("accept-encoding")))
+				):
+					body = compress_body(body, encoding, compress_level)
+					buffered_socket.sendb(b'Content-Encoding: ', encoding, b'\r\n')
+
 				# resp.3.3 send content length and body
 				content_length = 0
-				if(body):
+				if(is_streaming_body(body)):
+					# generators/iterators are sent as chunks as they are produced
+					buffered_socket.sendb(b'Transfer-Encoding: chunked\r\n\r\n')
+					if(request_type != "HEAD"):
+						response_started = True
+						buffered_socket.flush()  # send headers without waiting for the body
+						content_length = send_chunked_body(buffered_socket, body)
+					elif(hasattr(body, "close")):
+						body.close()
+				elif(isinstance(body, SendFileBody)):
+					content_length = body.count
+					buffered_socket.sendb(b'Content-Length: ', str(content_length), b'\r\n\r\n')
+					if(request_type != "HEAD"):
+						response_started = True
+						if(buffered_socket.sendfile(body.file, body.offset, body.count) != body.count):
+							# file shrunk, Content-Length already sent
+							reuse_socket_for_next_http_request = False
+				elif(body):
 					content_length = len(body)
 					# finalize all the headers
 					if(request_type != "HEAD"):
@@ -1102,7 +1998,23 @@ class App:
 				else:
 					buffered_socket.sendb(b'Content-Length: 0', b'\r\n\r\n')
 
-				buffered_socket.flush()  # flush the socket
+				if(
+					is_cache_leader
+					and status.startswith("200")
+					and not req._cookies_to_set
+					and not response_started
+					and buffered_socket.sendbuf is response_sendbuf  # not flushed in between
+				):
+					response_cache.store(cache_key, response_sendbuf[response_start:])
+
+				# pipelined requests already read, batch their responses
+				# into a single flush after the last one
+				if(
+					not reuse_socket_for_next_http_request
+					or not buffered_socket.buffered_len()
+				):
+					buffered_socket.flush()  # flush the socket
+				bytes_out = content_length
 				_wallclock_ms = int(1000 * time.time()) - cur_millis
 				LOG_SERVER(
 					"http", response_status=status, request_type=request_type,
@@ -1118,8 +2030,18 @@ class App:
 						wallclockms=_wallclock_ms
 					)
 
-		except Exception as ex:
+		except (Exception, HandlerTimeoutException) as ex:
+			if(isinstance(ex, HandlerTimeoutException) and ex is not handler_timeout):
+				raise  # not ours
 			stacktrace_string = traceback.format_exc()
+			if(response_started):
+				# status and headers already sent, only thing
+				# we can do is break the connection
+				LOG_ERROR(
+					"http", exception_str=str(ex), stacktrace_string=stacktrace_string,
+					request_type=request_type, request_line=request_line
+				)
+				return
 			status = None
 			resp_headers = []
 			body = None
@@ -1132,11 +2054,16 @@ class App:
 					_resp_headers and resp_headers.extend(_resp_headers)
 					log_handler = LOG_WARN
 					break
-			if(isinstance(body, (dict, list))):
-				body = json.dumps(body)
+			if(is_json_body(body)):
+				body = json_encode(body)
 				resp_headers.append("Content-Type: application/json")
 
-			status = str(status) if status else b'502 Server error'
+			if(status):
+				status = str(status)
+			elif(ex is handler_timeout):
+				status = b'504 Gateway Timeout'
+			else:
+				status = b'502 Server error'
 			body = body or b'Internal server error'
 
 			reuse_socket_for_next_http_request = False
@@ -1150,9 +2077,10 @@ class App:
 					buffered_socket.sendb(resp_header, b'\r\n')
 
 				# err.2.3 send final headers(content related only) and body
+				bytes_out = len(body)
 				buffered_socket.sendb(  # final send
 					b'Connection: close', b'\r\n',
-					b'Content-Length: ', str(len(body)), b'\r\n\r\n',
+					b'Content-Length: ', str(bytes_out), b'\r\n\r\n',
 					body
 				)
 				buffered_socket.flush()  # flush the socket
@@ -1171,6 +2099,32 @@ class App:
 				traceback.print_exc()
 			# BREAK THIS CONNECTION
 
+		finally:
+			if(handler_timeout is not None):
+				handler_timeout.close()
+			if(req._attachments):
+				# spooled files, may be on disk
+				for attachment in req._attachments.values():
+					attachment["file"].close()
+			if(is_cache_leader):
+				response_cache.done(cache_key)  # wake up waiting greenlets
+			_wallclock_ms = 1000 * (time.time() - start_time)
+			for admission_limit in admitted_limits:
+				admission_limit.release(_wallclock_ms)
+			if(route_metrics is not None):
+				route_metrics.in_flight -= 1
+				if(isinstance(status, bytes)):
+					status = status.decode()
+				route_metrics.observe(
+					_wallclock_ms,
+					str(status)[:3] if status else "200",
+					len(request_line) + len(req._raw_headers) + 4 + (
+						body_stream.bytes_read if body_stream is not None and body_stream.bytes_read
+						else len(post_data or b'')
+					),
+					bytes_out
+				)
+
 		if(reuse_socket_for_next_http_request):
 			return REUSE_SOCKET_FOR_HTTP
 
@@ -1178,26 +2132,61 @@ class App:
 		all the connection handling magic happens here
 	'''
 	def handle_connection(self, socket, address):
-		socket.settimeout(HTTP_SOCKET_MAX_TIMEOUT)  # set a timeout of 40 seconds
 		buffered_socket = BufferedSocket(socket)
+		connection_timers = self.connection_timers
 		close_socket = True
-		while(True):
-			ret = self.process_http_request(buffered_socket)
-			if(ret is REUSE_SOCKET_FOR_HTTP):
-				continue  # try again
-			elif(ret is I_AM_HANDLING_THE_SOCKET):
-				close_socket = False
-			break  # DEFAULT: break the loop
+		self.connections.add(buffered_socket)
+		try:
+			while(True):
+				# waiting for the next request and its headers, deadlines are
+				# on the timer wheel, socket doesn't need its own timeout
+				socket.settimeout(None)
+				if(not buffered_socket.buffered_len()):  # not pipelined
+					if(self.is_draining):
+						break
+					connection_timers.set_idle(buffered_socket, self.idle_timeout)
+					if(not buffered_socket.peek(1)):
+						break  # closed by client or idle timeout
+				connection_timers.set_deadline(buffered_socket, self.header_timeout)
+
+				ret = self.process_http_request(buffered_socket)
+				if(ret is REUSE_SOCKET_FOR_HTTP):
+					continue  # try again
+				elif(ret is I_AM_HANDLING_THE_SOCKET):
+					close_socket = False
+				break  # DEFAULT: break the loop
+		except Exception:
+			pass  # broken connection
+		finally:
+			connection_timers.remove(buffered_socket)
 
 		if(close_socket):
+			try:
+				buffered_socket.flush()  # any pending pipelined responses
+			except Exception:
+				pass
 			buffered_socket.close()
 
+		self.connections.discard(buffered_socket)
+		if(self.is_draining and not self.connections):
+			self.drained.set()
+
 
+# exit stage 0: stop accepting, in-flight requests continue
 @events.register_listener("blaster_exit0")
-def stop_all_apps():
+def drain_all_apps():
+	LOG_DEBUG("server_info", data="draining all servers")
+	for app in list(_all_apps):
+		app.drain()
+
+
+# exit stage 1: wait for in-flight requests until the drain deadline
+@events.register_listener("blaster_exit1")
+def stop_all_apps(drain_timeout=BLASTER_HTTP_DRAIN_TIMEOUT):
 	LOG_DEBUG("server_info", data="exiting all servers")
+	drain_deadline = time.time() + drain_timeout
 	for app in list(_all_apps):
-		app.stop()  # should handle all connections gracefully
+		app.stop(drain_timeout=max(0, drain_deadline - time.time()))  # should handle all connections gracefully
 
 
 # create a global app for generic single server use
@@ -1235,6 +2224,142 @@ def redirect_http_to_https():
 # additional utils
 
 DEFAULT_STATIC_FILE_CACHE = {}
+# total memory for the static files kept in memory, rest use sendfile
+HTTP_STATIC_FILES_MEMORY_BUDGET = 64 * _1_MB_
+HTTP_STATIC_FILE_MAX_MEMORY_SIZE = _1_MB_
+HTTP_BYTES_RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class StaticFile:
+	__slots__ = (
+		"file_path", "size", "mtime", "etag", "etags", "headers",
+		"data", "variants", "file"
+	)
+
+	def __init__(self, file_path):
+		stat = os.stat(file_path)
+		self.file_path = file_path
+		self.size = stat.st_size
+		self.mtime = int(stat.st_mtime)
+		self.etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+		self.etags = {self.etag}
+		self.headers = {
+			'ETag': self.etag,
+			'Last-Modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+			'Accept-Ranges': 'bytes'
+		}
+		# add mime type header
+		mime_type = FILE_EXTENSION_TO_MIME_TYPE.get(os.path.splitext(file_path)[1])
+		if(mime_type):
+			self.headers['Content-Type'] = mime_type
+			self.headers['Cache-Control'] = 'max-age=86400'
+		else:  # not text/html, the default for handler responses
+			self.headers['Content-Type'] = 'application/octet-stream'
+		self.data = None  # in memory if within budget
+		self.variants = None  # {encoding: (headers, data)}
+		self.file = None  # cached file object for sendfile
+
+	# loads into memory with compressed variants, returns memory used
+	def load(self):
+		with open(self.file_path, "rb") as f:
+			self.data = f.read()
+		content_type = self.headers.get('Content-Type')
+		if(
+			'Cache-Control' in self.headers  # cacheable
+			and len(self.data) >= HTTP_COMPRESS_MIN_SIZE
+			and COMPRESSIBLE_CONTENT_TYPE_REGEX.match(content_type)
+		):
+			# compress once, with the best compression
+			self.variants = {}
+			for encoding, level in (("br", 11), ("gzip", 9)):
+				if(encoding == "br" and not brotli):
+					continue
+				compressed_data = compress_body(self.data, encoding, level)
+				if(len(compressed_data) < len(self.data)):
+					etag = self.etag[:-1] + "-" + encoding + '"'
+					self.etags.add(etag)
+					self.variants[encoding] = (
+						dict(self.headers, **{'Content-Encoding': encoding, 'ETag': etag}),
+						compressed_data
+					)
+		return self.memory_size()
+
+	def memory_size(self):
+		if(self.data is None):
+			return 0
+		return len(self.data) + sum(len(data) for _, data in (self.variants or {}).values())
+
+	def is_not_modified(self, req):
+		if(if_none_match := req.HEADERS("if-none-match")):
+			return if_none_match.strip() == "*" or any(
+				etag.strip().removeprefix("W/") in self.etags
+				for etag in if_none_match.split(",")
+			)
+		if(if_modified_since := req.HEADERS("if-modified-since")):
+			try:
+				# epoch seconds, HTTP dates are GMT
+				return self.mtime <= email.utils.mktime_tz(email.utils.parsedate_tz(if_modified_since))
+			except (TypeError, ValueError, OverflowError):
+				pass
+		return False
+
+	# returns (start, end) inclusive, None for full file, False if unsatisfiable
+	def get_range(self, req):
+		if(not (range_header := req.HEADERS("range"))):
+			return None
+		if((if_range := req.HEADERS("if-range")) and if_range.strip() != self.etag):
+			return None  # changed, send the full file
+		if(not (_match := HTTP_BYTES_RANGE_REGEX.match(range_header.replace(" ", "")))):
+			return None  # multiple ranges/other units are not supported, send full
+		start, end = _match.groups()
+		if(not start):  # suffix range, last n bytes
+			if(not end or not int(end)):
+				return False
+			start, end = max(0, self.size - int(end)), self.size - 1
+		else:
+			start = int(start)
+			end = min(int(end), self.size - 1) if end else self.size - 1
+		if(start > end or start >= self.size):
+			return False
+		return start, end
+
+	def get_file(self):
+		if(self.file is None):
+			self.file = open(self.file_path, "rb")
+		return self.file
+
+	def response(self, req):
+		if(self.is_not_modified(req)):
+			return "304 Not Modified", {
+				k: v for k, v in self.headers.items() if k in ('ETag', 'Last-Modified', 'Cache-Control')
+			}, b''
+
+		if(
+			self.variants
+			and not req.HEADERS("range")
+			and (encoding := get_accepted_encoding(req.HEADERS("accept-encoding")))
+			and (variant := self.variants.get(encoding))
+		):
+			return "200 OK", variant[0], variant[1]
+
+		_range = self.get_range(req)
+		if(_range is False):
+			return "416 Range Not Satisfiable", {
+				'Content-Range': "bytes */{:d}".format(self.size)
+			}, b''
+		status, headers, start, count = "200 OK", self.headers, 0, self.size
+		if(_range):
+			start, end = _range
+			count = end - start + 1
+			status = "206 Partial Content"
+			headers = dict(
+				self.headers, **{'Content-Range': "bytes {:d}-{:d}/{:d}".format(start, end, self.size)}
+			)
+		if(self.data is not None):
+			return status, headers, self.data if count == self.size else memoryview(self.data)[start: start + count]
+		if(count == 0):
+			return status, headers, b''
+		return status, headers, SendFileBody(self.get_file(), start, count)
 
 
 def static_file_handler(
@@ -1243,7 +2368,9 @@ def static_file_handler(
 	default_file="index.html",
 	file_not_found_cb=None,
 	file_cache=DEFAULT_STATIC_FILE_CACHE,
-	dynamic_files=IS_DEV  # always reload from filesystem if not in cache
+	dynamic_files=IS_DEV,  # always reload from filesystem if not in cache
+	memory_budget=HTTP_STATIC_FILES_MEMORY_BUDGET,
+	max_memory_file_size=HTTP_STATIC_FILE_MAX_MEMORY_SIZE
 ):
 	# both paths should start with /
 	if(url_path[-1] != "/"):
@@ -1251,54 +2378,52 @@ def static_file_handler(
 
 	_base_folder_path_ = os.path.abspath(_base_folder_path_) + "/"
 
-	def get_file_resp(path):
+	def get_static_file(path):
 		file_path = os.path.abspath(_base_folder_path_ + str(path))
 		if(
 			path
 			and not file_path.startswith(_base_folder_path_)
 		):
-			return "404 Not Found", [], "Invalid path submitted"
-
-		data = open(file_path, "rb").read()
-		resp_headers = None
-		# add mime type header
-		mime_type = FILE_EXTENSION_TO_MIME_TYPE.get(os.path.splitext(file_path)[1])
-		if(mime_type):
-			resp_headers = {
-				'Content-Type': mime_type,
-				'Cache-Control': 'max-age=86400'
-			}
-		return ("200 OK", resp_headers, data)
+			return None
+		if(not os.path.isfile(file_path)):  # directories, sockets..
+			return None
+		return StaticFile(file_path)
 
 	def file_handler(req: Request, path):
 		if(not path):
 			path = default_file or ""
 
-		file_resp = file_cache.get(url_path + path, None)
-		if(not file_resp and dynamic_files):  # always reload from filesystem in devmode
+		nonlocal memory_budget
+		static_file = file_cache.get(url_path + path, None)
+		if(not static_file and dynamic_files):  # files added after start, load once
 			try:
-				file_resp = get_file_resp(path)
-				file_cache[path] = file_resp  # add to cache
+				if(static_file := get_static_file(path)):
+					if(static_file.size <= max_memory_file_size and memory_budget > 0):
+						memory_budget -= static_file.load()
+					file_cache[url_path + path] = static_file
 			except Exception:
-				pass
+				static_file = None
 
-		if(not file_resp):
+		if(not static_file):
 			if(file_not_found_cb):
-				file_resp = file_not_found_cb(path, req=req)
-		return file_resp or ("404 Not Found", [], "-NO-FILE-")
-	# headers , data
-	# preload all files once on load
-	file_names = [
-		os.path.join(dp, f)
-		for dp, dn, filenames in os.walk(_base_folder_path_) for f in filenames
-	]
-	for file_name in file_names:
-		relative_file_path = ltrim(file_name, _base_folder_path_)
-		_url_file_path = url_path + relative_file_path
-		# strip / at the begininning in the cache
-		# as we search matching path without leading slash in the cache
-		# in the file handler
-		file_cache[_url_file_path] = get_file_resp(relative_file_path)
+				return file_not_found_cb(path, req=req) or ("404 Not Found", [], "-NO-FILE-")
+			return "404 Not Found", [], "-NO-FILE-"
+		return static_file.response(req)
+
+	# preload all files once on load, smaller files
+	# are kept in memory until the memory budget
+	static_files = []
+	for dp, dn, filenames in os.walk(_base_folder_path_):
+		for f in filenames:
+			file_name = os.path.join(dp, f)
+			relative_file_path = ltrim(file_name, _base_folder_path_)
+			static_files.append((url_path + relative_file_path, StaticFile(file_name)))
+
+	static_files.sort(key=lambda x: x[1].size)
+	for _url_file_path, static_file in static_files:
+		if(static_file.size <= max_memory_file_size and memory_budget > 0):
+			memory_budget -= static_file.load()
+		file_cache[_url_file_path] = static_file
 
 	return url_path + "{*path}", file_handler
 
@@ -1307,7 +2432,10 @@ def proxy_file_handler(url_path, proxy_url):
 	import requests
 
 	def file_handler(req: Request, path):
-		ret = requests.get(proxy_url + path, headers=dict(req._headers), verify=False)
+		ret = requests.get(
+			proxy_url + path, headers=dict(req._headers), verify=False,
+			timeout=deadline_timeout()
+		)
 		return {"Content-Type": ret.headers["Content-Type"]}, ret.text
 	return url_path + "{*path}", file_handler
 
@@ -1316,12 +2444,15 @@ def proxy_file_handler(url_path, proxy_url):
 def _get_web_socket_handler(req: Request):
 	set_socket_fast_close_options(req.sock)
 	# sends handshake automatically
-	ws = req.wsock = WebSocketServerHandler(req.sock)
+	ws = req.wsock = WebSocketServerHandler(
+		req.sock, deflate=req.handler and req.handler.get("ws_deflate")
+	)
 	ws.do_handshake(req.HEADERS())
 	return ws
 
 
 Request.set_arg_type_hook(WebSocketServerHandler, _get_web_socket_handler)
+Request.set_arg_type_hook(RequestBodyStream, lambda req: req._body_stream)
 
 
 # Utils
@@ -5,6 +5,7 @@ Created on 04-Nov-2017
 '''
 
 import gevent
+import gevent.socket
 from gevent.threading import Thread
 from gevent.queue import Queue, Empty as QueueEmptyException
 import os
@@ -24,6 +25,7 @@ import types
 from gevent import sleep, spawn
 from functools import reduce as _reduce
 from gevent.lock import BoundedSemaphore
+from gevent.event import AsyncResult
 from datetime import timezone, timedelta, datetime
 import time
 import hmac
@@ -47,6 +49,7 @@ from ..websocket._core import WebSocket, WebSocketTimeoutException
 from ..env import DEBUG_PRINT_LEVEL
 from ..utils.xss_html import XssHtml
 from ..utils import events
+from .. import req_ctx
 from ..logging import LOG_WARN, LOG_ERROR, LOG_DEBUG, LOG_APP_INFO, log_ctx
 # CUSTOM IMPORTS
 try:
@@ -1388,6 +1391,8 @@ def batched_iter(iterable, n=1):
 
 # This is the most *important* socket wrapped implementation
 # used by blaster server.
+# reads go into a preallocated buffer via recv_into, consumed data
+# only moves the read offset, no reslicing of the pending data.
 class BufferedSocket():
 
 	is_eof = False
@@ -1395,9 +1400,12 @@ class BufferedSocket():
 	store = None
 	lock = None
 
-	def __init__(self, sock):
+	def __init__(self, sock, read_buffer_size=4096):
 		self.sock = sock
-		self.readbuf = bytearray()
+		self.read_buffer_size = read_buffer_size
+		self.readbuf = bytearray(read_buffer_size)
+		self.read_start = 0  # start of unconsumed data in readbuf
+		self.read_end = 0  # end of received data in readbuf
 		self.sendbuf = bytearray()
 
 	def close(self):
@@ -1410,6 +1418,11 @@ class BufferedSocket():
 			if(isinstance(data, str)):
 				data = data.encode()
 			n += len(data)
+			if(len(data) > _1MB_):
+				# large body, send as is instead of copying into the buffer
+				self.flush()
+				self.sock.sendall(data)
+				continue
 			self.sendbuf.extend(data)
 		if(len(self.sendbuf) > _1MB_):
 			return self.flush()  # flush if more than 1MB buffered
@@ -1431,6 +1444,36 @@ class BufferedSocket():
 		self.sock.sendall(send_buf)  # send all data and returns None
 		return n
 
+	# sends count bytes of the file from offset, zero copy with os.sendfile,
+	# waits cooperatively when the socket buffer is full
+	def sendfile(self, file, offset=0, count=None) -> int:
+		self.flush()
+		if(count is None):
+			count = os.fstat(file.fileno()).st_size - offset
+		file_fd = file.fileno()
+		total_sent = 0
+		if(hasattr(self.sock, "do_handshake")):
+			# ssl socket, data has to go through the ssl layer. read from explicit
+			# offsets, the file object can be shared by concurrent responses
+			while(total_sent < count):
+				if(not (data := os.pread(file_fd, min(_64KB_, count - total_sent), offset + total_sent))):
+					break  # reached end of file
+				self.sock.sendall(data)
+				total_sent += len(data)
+			return total_sent
+		sock_fd = self.sock.fileno()
+		timeout = self.sock.gettimeout()
+		while(total_sent < count):
+			try:
+				sent = os.sendfile(sock_fd, file_fd, offset + total_sent, count - total_sent)
+			except BlockingIOError:
+				gevent.socket.wait_write(sock_fd, timeout=timeout)
+				continue
+			if(sent == 0):
+				break  # reached end of file
+			total_sent += sent
+		return total_sent
+
 	def sendl(self, *_data):
 		if(not self.lock):
 			self.lock = BoundedSemaphore()
@@ -1439,70 +1482,96 @@ class BufferedSocket():
 		self.lock.release()
 		return ret
 
+	def buffered_len(self):
+		return self.read_end - self.read_start
+
+	def _consume(self, n):
+		# returns n bytes from the read offset and moves it
+		start = self.read_start
+		ret = self.readbuf[start: start + n]
+		self.read_start = start + n
+		if(self.read_start == self.read_end):
+			# everything consumed, reuse the buffer from the beginning
+			self.read_start = self.read_end = 0
+			if(len(self.readbuf) > _64KB_):
+				self.readbuf = bytearray(self.read_buffer_size)  # release grown buffer
+		return ret
+
+	# receives more data into the free space of readbuf, returns bytes received
+	def _recv_into_buffer(self):
+		if(self.sendbuf):
+			self.flush()  # don't hold pending responses while waiting on the peer
+		readbuf = self.readbuf
+		if(self.read_end == len(readbuf)):
+			pending = self.read_end - self.read_start
+			if(self.read_start > 0 and pending < (len(readbuf) >> 1)):
+				# move pending data to the beginning
+				readbuf[:pending] = readbuf[self.read_start: self.read_end]
+			else:
+				# double the buffer
+				readbuf = self.readbuf = readbuf[self.read_start: self.read_end] + bytearray(len(readbuf))
+			self.read_start = 0
+			self.read_end = pending
+
+		with memoryview(readbuf) as buf:
+			n = self.sock.recv_into(buf[self.read_end:])
+		if(not n):
+			self.is_eof = True
+			return 0
+		self.read_end += n
+		return n
+
+	# returns upto n buffered bytes without consuming them
+	def peek(self, n):
+		while(self.read_end - self.read_start < n):
+			if(not self._recv_into_buffer()):
+				break
+		return bytes(self.readbuf[self.read_start: min(self.read_start + n, self.read_end)])
+
 	def recv(self, n):
-		if(len(self.readbuf)):
-			ret = self.readbuf
-			self.readbuf = bytearray()
-			return ret
+		if(self.read_end > self.read_start):
+			return self._consume(min(n, self.read_end - self.read_start))
 		return self.sock.recv(n)
 
 	def recvn(self, n):
-		while(len(self.readbuf) < n):
-			data = self.sock.recv(4096)
-			if(not data):
-				self.is_eof = True
-				return self.readbuf or None
-			self.readbuf.extend(data)
-
-		# return n bytes for now
-		ret = self.readbuf[:n]
-		# set remaining to new store
-		self.readbuf = self.readbuf[n:]
-		return ret
+		while(self.read_end - self.read_start < n):
+			if(not self._recv_into_buffer()):
+				return self._consume(self.read_end - self.read_start) or None
+
+		# return n bytes
+		return self._consume(n)
 
 	# fails if it couldn't find the delimiter until max_size
 	def readuntil(self, delimiter, max_size, discard_delimiter):
-		# check in store
 		if(isinstance(delimiter, str)):
 			delimiter = delimiter.encode()
 
 		delimiter_len = len(delimiter)
-		# scan the store until end, if not found extend
-		# and continue until store > max_size
-		to_scan_len = len(self.readbuf)
-		i = 0  # how much we scanned already
-
-		_store = self.readbuf  # get a reference
+		scanned = 0  # bytes from read_start that don't contain the delimiter
 		while(True):
-			if(i > max_size):
-				# WITHIN THE LIMIT DELIMITER NOT FOUND
-				self.is_eof = True
+			index = self.readbuf.find(
+				delimiter, self.read_start + scanned, self.read_end
+			)
+			if(index != -1):
+				found_len = index - self.read_start + delimiter_len
+				if(found_len > max_size):
+					break
+				ret = self._consume(found_len)
+				if(discard_delimiter):
+					del ret[-delimiter_len:]
+				return ret
+
+			pending = self.read_end - self.read_start
+			if(pending >= max_size):
+				break
+			# delimiter may span across the next recv
+			scanned = max(0, pending - delimiter_len + 1)
+			if(not self._recv_into_buffer()):
 				return None
-			if(i >= delimiter_len):
-				j = 0
-				lookup_from = i - delimiter_len
-				while(j < delimiter_len and _store[lookup_from + j] == delimiter[j]):
-					j += 1
-
-				if(j == delimiter_len):
-					# found
-					ret = None
-					if(discard_delimiter):
-						ret = _store[:i - delimiter_len]
-					else:
-						ret = _store[:i]
-					self.readbuf = _store[i:]  # set store to unscanned/pending
-					return ret
-			if(i >= to_scan_len):
-				# scanned all buffer, need more
-				data = self.sock.recv(4096)
-				if(not data):
-					self.is_eof = True
-					return None
-
-				_store.extend(data)  # fetch more data
-				to_scan_len = len(_store)
-			i += 1
+
+		# WITHIN THE LIMIT DELIMITER NOT FOUND
+		self.is_eof = True
+		return None
 
 	def __getattr__(self, key):
 		ret = getattr(self.sock, key, _OBJ_END_)
@@ -1514,7 +1583,7 @@ class BufferedSocket():
 # this variable indicated the TCP_USER_TIMEOUT
 # parameter that indicated after how long without an
 # ack packet we should close
-__tcp_user_timeout = 30 * 1000
+TCP_USER_TIMEOUT_MS = 30 * 1000
 
 
 def set_socket_fast_close_options(sock):
@@ -1535,18 +1604,36 @@ def set_socket_fast_close_options(sock):
 	# after 30 seconds if there is no ack
 	# then we assume broken and close it
 	TCP_USER_TIMEOUT = 18
-	sock.setsockopt(socket.SOL_TCP, TCP_USER_TIMEOUT, 30 * 1000)
+	sock.setsockopt(socket.SOL_TCP, TCP_USER_TIMEOUT, TCP_USER_TIMEOUT_MS)
+
+
+# policies when a connection has high_water messages queued,
+# drops are counted in dropped and logged
+WS_QUEUE_DROP_OLDEST = 0  # drop the oldest queued message
+WS_QUEUE_COALESCE = 1  # a new message replaces the queued one with same ref, else drop oldest
+WS_QUEUE_DISCONNECT = 2  # mark the connection stale and close it(default)
+
+WS_QUEUE_HIGH_WATER = 1000
+# retransmit buffer limits, besides keeping only tcp user timeout of messages
+WS_ASSUMED_SENT_MAX_BYTES = 1024 * 1024
 
 
 # wraps send method of websocket which keeps a buffer of messages
 # for 20 seconds if the connection closes, you can use them to resend
 class WebsocketConnection(WebSocket):
-	# to keep track of how many greenlets are waiting on semaphore to send
+	# messages waiting to be sent, [ref, msg, frame, is_text, retransmit] entries,
+	# msg is encoded when written so a per connection compressor(permessage-deflate
+	# context takeover) sees the messages in the order they go out
 	queue = None
+	# latest queued entry of a ref, to coalesce
+	queued_refs = None
 	# queue for older sent messages in case of reset we try to retransmit
 	msg_assumed_sent = None
+	msg_assumed_sent_bytes = 0
+	msg_assumed_sent_sizes = None  # encoded size of each msg_assumed_sent
+	dropped = 0  # messages dropped at high water
 	ws = None
-	lock = BoundedSemaphore()
+	lock = None
 	is_stale = False
 	last_msg_recv_timestamp = None
 	last_msg_sent_timestamp = None
@@ -1554,46 +1641,130 @@ class WebsocketConnection(WebSocket):
 	user_id = None
 	is_viewer_list = False
 
-	def __init__(self, ws, user_id):
+	def __init__(
+		self, ws, user_id,
+		high_water=WS_QUEUE_HIGH_WATER, queue_policy=WS_QUEUE_DISCONNECT,
+		max_assumed_sent_bytes=WS_ASSUMED_SENT_MAX_BYTES
+	):
 		self.ws = ws
-		# to keep track of how many greenlets are waiting on semaphore to send
 		self.queue = collections.deque()
+		self.queued_refs = {}
+		self.high_water = high_water
+		self.queue_policy = queue_policy
 		# queue for older sent messages in case of reset we try to retransmit
 		self.msg_assumed_sent = collections.deque()
+		self.msg_assumed_sent_bytes = 0
+		self.msg_assumed_sent_sizes = collections.deque()
+		self.dropped = 0
+		self.max_assumed_sent_bytes = max_assumed_sent_bytes
+		# held by the greenlet writing the queue
+		self.lock = BoundedSemaphore()
 		self.user_id = user_id
 
 		self.last_msg_recv_timestamp\
 			= self.last_msg_sent_timestamp \
 			= time.time() * 1000
 
+	@property
+	def deflate(self):  # to share compressed frames in broadcast
+		return getattr(self.ws, "deflate", None)
+
+	def close(self, status=1000, reason=""):
+		self.is_stale = True
+		self.queue.clear()
+		self.queued_refs.clear()
+		self.ws.close(status, reason)
+
+	def _enqueue(self, ref, msg, frame, is_text=True, retransmit=True):
+		if(
+			self.queue_policy == WS_QUEUE_COALESCE
+			and ref is not None
+			and (entry := self.queued_refs.get(ref)) is not None
+		):
+			entry[1] = msg  # latest state of ref, keeps its place in the queue
+			entry[2] = frame
+			return
+		if(len(self.queue) >= self.high_water):
+			if(self.queue_policy == WS_QUEUE_DISCONNECT):
+				self.close(1008, "slow consumer")
+				raise Exception("send queue full, disconnected {}".format(self.user_id))
+			dropped = self.queue.popleft()
+			if(self.queued_refs.get(dropped[0]) is dropped):
+				del self.queued_refs[dropped[0]]
+			if(not self.dropped & (self.dropped - 1)):  # 1, 2, 4, 8.. not to flood logs
+				LOG_WARN("ws_queue_full", user_id=self.user_id, dropped=self.dropped + 1)
+			self.dropped += 1
+		entry = [ref, msg, frame, is_text, retransmit]
+		self.queue.append(entry)
+		if(ref is not None):
+			self.queued_refs[ref] = entry
+
+	# for broadcast, frame is already encoded by the server
+	def queue_frame(self, frame):
+		if(
+			self.is_stale or len(self.queue) >= self.high_water
+			or not hasattr(self.ws, "send_frames")
+		):
+			return False
+		self._enqueue(None, None, frame, retransmit=False)
+		if(not self.lock.locked()):
+			spawn(self._flush_queued)
+		return True
+
+	# for broadcast, encoded when written
+	def queue_message(self, payload, is_text=True):
+		if(
+			self.is_stale or len(self.queue) >= self.high_water
+			or not hasattr(self.ws, "send_frames")
+		):
+			return False
+		self._enqueue(None, payload, None, is_text=is_text, retransmit=False)
+		if(not self.lock.locked()):
+			spawn(self._flush_queued)
+		return True
+
+	def _flush_queued(self):
+		try:
+			self._flush()
+		except Exception:
+			pass  # is_stale is set
+
 	# msg is only string data , #ref is used
 	# just in case an exception occurs , we pass that ref
 	def send(self, msg, ref=None, add_to_assumend_sent=True):
 		if(self.is_stale):
 			raise Exception("stale connection")
 
-		self.queue.append((ref, msg))
+		self._enqueue(ref, msg, None, retransmit=add_to_assumend_sent)
 		if(self.lock.locked()):
 			return
+		self._flush()
 
+	# sends everything queued, messages queued while a write
+	# is in progress go together in the next write
+	def _flush(self):
 		self.lock.acquire()
-		data_ref = None
-		data = None
 		try:
 			while(not self.is_stale and len(self.queue) > 0):
-				data_ref, data = self.queue.popleft()  # peek
-				self.ws.send(data)  # msg objects only
+				entries = list(self.queue)
+				self.queue.clear()
+				self.queued_refs.clear()
+				if(send_frames := getattr(self.ws, "send_frames", None)):
+					encode_message = self.ws.encode_message
+					frames = [
+						frame if frame is not None else encode_message(msg, is_text=is_text)
+						for _ref, msg, frame, is_text, _retransmit in entries
+					]
+					send_frames(frames)
+					sizes = [len(frame) for frame in frames]
+				else:
+					sizes = []
+					for _ref, msg, _frame, _is_text, _retransmit in entries:
+						self.ws.send(msg)  # msg objects only
+						sizes.append(len(msg.encode() if isinstance(msg, str) else msg))
 				current_timestamp = time.time() * 1000
 				self.last_msg_sent_timestamp = current_timestamp
-				if(add_to_assumend_sent):
-					while(
-						len(self.msg_assumed_sent) > 0
-						and self.msg_assumed_sent[0][0] < current_timestamp - __tcp_user_timeout
-					):
-						# keep inly 20 seconds of previous data
-						self.msg_assumed_sent.popleft()
-
-					self.msg_assumed_sent.append((current_timestamp, data_ref, data))
+				self._add_to_assumed_sent(current_timestamp, entries, sizes)
 		except Exception:
 			err_msg = "Exception while sending message to {}, might be closed ".format(
 				self.user_id
@@ -1604,6 +1775,27 @@ class WebsocketConnection(WebSocket):
 			self.lock.release()
 		return
 
+	# sizes: encoded size of each entry as written
+	def _add_to_assumed_sent(self, current_timestamp, entries, sizes):
+		msg_assumed_sent = self.msg_assumed_sent
+		msg_assumed_sent_sizes = self.msg_assumed_sent_sizes
+		for (data_ref, data, _frame, _is_text, retransmit), size in zip(entries, sizes):
+			if(not retransmit):
+				continue  # broadcasts are not retransmitted
+			msg_assumed_sent.append((current_timestamp, data_ref, data))
+			msg_assumed_sent_sizes.append(size)
+			self.msg_assumed_sent_bytes += size
+		# keep only tcp user timeout of previous data, within the memory bound
+		while(
+			len(msg_assumed_sent) > 0
+			and (
+				msg_assumed_sent[0][0] < current_timestamp - TCP_USER_TIMEOUT_MS
+				or self.msg_assumed_sent_bytes > self.max_assumed_sent_bytes
+			)
+		):
+			msg_assumed_sent.popleft()
+			self.msg_assumed_sent_bytes -= msg_assumed_sent_sizes.popleft()
+
 
 def parse_cmd_line_arguments():
 	from sys import argv
@@ -2129,10 +2321,30 @@ def debug_requests():
 	debug_requests_off()
 
 
+# caps the timeout(seconds or (connect, read)) of an outbound call
+# to what's left of the current request's deadline
+def deadline_timeout(timeout=None):
+	if((remaining_ms := req_ctx.remaining_ms()) is None):
+		return timeout
+	remaining = max(remaining_ms, 1) / 1000
+	if(timeout is None):
+		return remaining
+	if(isinstance(timeout, tuple)):
+		return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+	return min(timeout, remaining)
+
+
+class DeadlineHTTPAdapter(requests.adapters.HTTPAdapter):
+	def send(self, request, timeout=None, **kwargs):
+		return super().send(request, timeout=deadline_timeout(timeout), **kwargs)
+
+
 # USEFUL FOR CACHING REQUEST
 class FileCacheSession(requests.Session):
 	def __init__(self, cache_dir=".cache_requests"):
 		super().__init__()
+		self.mount("http://", DeadlineHTTPAdapter())
+		self.mount("https://", DeadlineHTTPAdapter())
 		self.cache_dir = cache_dir
 		os.makedirs(cache_dir, exist_ok=True)
 
@@ -2204,6 +2416,67 @@ def memoized_method(func):
 	return wrapper
 
 
+_SINGLEFLIGHT_ABORTED_ = object()
+
+
+# concurrent calls with the same key wait for the one in flight
+# instead of running the same thing again (singleflight).
+# all callers get the same result object, don't mutate it
+class SingleFlight:
+	def __init__(self):
+		self.in_flight = {}  # key -> AsyncResult
+		self.calls = 0  # actually ran
+		self.coalesced = 0  # waited for another call's result
+
+	# returns (result, is_shared)
+	def run(self, key, func, *args, **kwargs):
+		if((pending := self.in_flight.get(key)) is not None):
+			self.coalesced += 1
+			if((ret := pending.get()) is not _SINGLEFLIGHT_ABORTED_):  # raises the leader's exception
+				return ret, True
+			return self.run(key, func, *args, **kwargs)
+		self.in_flight[key] = pending = AsyncResult()
+		self.calls += 1
+		try:
+			ret = func(*args, **kwargs)
+		except Exception as ex:
+			pending.set_exception(ex)
+			raise
+		except BaseException:
+			# leader killed/timed out, waiters run it themselves
+			pending.set(_SINGLEFLIGHT_ABORTED_)
+			raise
+		finally:
+			if(self.in_flight.get(key) is pending):
+				del self.in_flight[key]
+		pending.set(ret)
+		return ret, False
+
+	def do(self, key, func, *args, **kwargs):
+		return self.run(key, func, *args, **kwargs)[0]
+
+	def hit_ratio(self):
+		total = self.calls + self.coalesced
+		return self.coalesced / total if total else 0.0
+
+
+# @coalesce or @coalesce(key=lambda user_id, **kwargs: user_id)
+# args must be hashable when no key function is given
+def coalesce(func=None, key=None):
+	def decorator(func):
+		singleflight = SingleFlight()
+
+		def wrapper(*args, **kwargs):
+			return singleflight.do(
+				key(*args, **kwargs) if key else (args, frozenset(kwargs.items())),
+				func, *args, **kwargs
+			)
+		wrapper._original = getattr(func, "_original", func)
+		wrapper.singleflight = singleflight
+		return wrapper
+	return decorator(func) if func is not None else decorator
+
+
 def NON_NULL(*args):
 	for a in args:
 		if a is not None:
@@ -2252,9 +2525,8 @@ def ASSERT_RATE_PER_MINUTE(key, count=60, _type=""):
 
 def set_requests_default_args(**_kwargs):
 	import requests
-	from requests.adapters import HTTPAdapter
 
-	class _HTTPAdapter(HTTPAdapter):
+	class _HTTPAdapter(DeadlineHTTPAdapter):
 		def send(self, request, **kwargs):
 			for key, default in _kwargs.items():
 				if(key not in kwargs):
@@ -2265,6 +2537,7 @@ def set_requests_default_args(**_kwargs):
 	adapter = _HTTPAdapter()  # Set your default timeout in seconds
 	session.mount("http://", adapter)
 	session.mount("https://", adapter)
+	return session
 
 
 def xmltodict(xml_node, attributes=False):
@@ -0,0 +1,167 @@
+from tempfile import SpooledTemporaryFile
+from requests.structures import CaseInsensitiveDict
+
+_1KB_ = 1024
+_1MB_ = _1KB_ * _1KB_
+
+# parts larger than this are moved from memory to a temporary file on disk
+MULTIPART_SPOOL_MAX_MEMORY_SIZE = _1MB_
+MULTIPART_MAX_PART_HEADERS_SIZE = 16 * _1KB_
+
+# parser states
+_PREAMBLE = 0
+_AFTER_BOUNDARY = 1
+_HEADERS = 2
+_BODY = 3
+_END = 4
+
+
+def get_boundary(content_type_header):
+	for param in content_type_header.split(";")[1:]:
+		key, _, val = param.strip().partition("=")
+		if(key.lower() == "boundary" and val):
+			return val.strip('"').encode()
+	return None
+
+
+class MultipartPart:
+	__slots__ = ("headers", "name", "attrs", "file", "size")
+
+	def __init__(self, headers, spool_max_memory_size):
+		self.headers = headers
+		self.name = None
+		self.attrs = {}
+		self.size = 0
+		content_disposition = headers.pop(b'Content-Disposition', None)
+		if(content_disposition):
+			for i in content_disposition.split(b';'):
+				key_val = i.split(b'=', 1)
+				if(len(key_val) == 2):
+					self.attrs[key_val[0].strip().decode()] = key_val[1].strip().strip(b'"\'').decode()
+			self.name = self.attrs.pop("name", None)
+		self.file = SpooledTemporaryFile(max_size=spool_max_memory_size)
+
+	def write(self, data):
+		self.size += len(data)
+		self.file.write(data)
+
+	# no additional headers, and no other attributes,
+	# it's just a plain input field
+	def is_field(self):
+		return not self.headers and not self.attrs
+
+
+# {"attrs": .., "headers": .., "file": ..}, "data" is read from
+# the file only when asked for with att["data"] or att.get("data"),
+# it is not a stored key, so keys(), items(), dict(att) and {**att}
+# don't have it, use "file" there. The file is closed once the
+# response is sent, read or copy it before that if you need it later
+class MultipartAttachment(dict):
+	def __contains__(self, key):
+		return key == "data" or super().__contains__(key)
+
+	def __getitem__(self, key):
+		if(key == "data"):
+			_file = super().__getitem__("file")
+			_file.seek(0)
+			data = _file.read()
+			_file.seek(0)
+			return data
+		return super().__getitem__(key)
+
+	def get(self, key, default=None):
+		try:
+			return self.__getitem__(key)
+		except KeyError:
+			return default
+
+
+# incremental multipart/form-data parser, scans for the boundary
+# in the fed data and streams each part's content into a spooled file
+class MultipartParser:
+	def __init__(
+		self, boundary,
+		spool_max_memory_size=MULTIPART_SPOOL_MAX_MEMORY_SIZE,
+		max_part_headers_size=MULTIPART_MAX_PART_HEADERS_SIZE
+	):
+		if(isinstance(boundary, str)):
+			boundary = boundary.encode()
+		self.dash_boundary = b'--' + boundary
+		self.delimiter = b'\r\n--' + boundary
+		self.spool_max_memory_size = spool_max_memory_size
+		self.max_part_headers_size = max_part_headers_size
+		self.buf = bytearray()
+		self.state = _PREAMBLE
+		self.part = None
+		self.parts = []
+
+	def feed(self, data):
+		buf = self.buf
+		buf += data
+		pos = 0
+		with memoryview(buf) as view:
+			while(True):
+				if(self.state == _PREAMBLE):
+					i = buf.find(self.dash_boundary, pos)
+					if(i == -1):
+						pos = max(pos, len(buf) - len(self.dash_boundary) + 1)
+						break
+					pos = i + len(self.dash_boundary)
+					self.state = _AFTER_BOUNDARY
+
+				elif(self.state == _AFTER_BOUNDARY):
+					if(len(buf) - pos < 2):
+						break
+					if(buf[pos: pos + 2] == b'--'):
+						self.state = _END
+					elif(buf[pos: pos + 2] == b'\r\n'):
+						pos += 2
+						self.state = _HEADERS
+					else:
+						raise Exception("multipart: invalid boundary")
+
+				elif(self.state == _HEADERS):
+					if(buf[pos: pos + 2] == b'\r\n'):
+						headers_end = pos  # no headers
+					elif((headers_end := buf.find(b'\r\n\r\n', pos)) != -1):
+						headers_end += 2
+					elif(len(buf) - pos > self.max_part_headers_size):
+						raise Exception("multipart: part headers too large")
+					else:
+						break
+					headers = CaseInsensitiveDict()
+					for line in bytes(view[pos: headers_end]).split(b'\r\n'):
+						header_name, sep, header_value = line.partition(b':')
+						if(sep):
+							headers[header_name.strip()] = header_value.strip()
+					self.part = MultipartPart(headers, self.spool_max_memory_size)
+					pos = headers_end + 2
+					self.state = _BODY
+
+				elif(self.state == _BODY):
+					i = buf.find(self.delimiter, pos)
+					if(i == -1):
+						# keep the tail that may be the start of a delimiter
+						safe_end = len(buf) - len(self.delimiter) + 1
+						if(safe_end > pos):
+							self.part.write(view[pos: safe_end])
+							pos = safe_end
+						break
+					self.part.write(view[pos: i])
+					self.part.file.seek(0)
+					self.parts.append(self.part)
+					self.part = None
+					pos = i + len(self.delimiter)
+					self.state = _AFTER_BOUNDARY
+
+				else:  # _END, ignore epilogue
+					pos = len(buf)
+					break
+
+		del buf[:pos]
+		return self
+
+	def close(self):
+		if(self.state != _END):
+			raise Exception("multipart: incomplete body")
+		return self.parts
@@ -1,4 +1,6 @@
 def html_escape(s):
+	if("<" not in s and ">" not in s):
+		return s  # nothing to escape, most strings
 	s = s.replace("<", "&lt;")
 	s = s.replace(">", "&gt;")
 	return s
@@ -7,12 +9,28 @@ def html_escape(s):
 # custom containers ##########
 # HtmlSanitizedList and HtmlSanitizedDict are used for HTML safe operation
 # the idea is to wrap them to sanitizeContainers, and escape them while retrieving
-# rather than during inserting/parsing stage
+# rather than during inserting/parsing stage.
+# Raw values: get(k, escape_html=False) / at(i, escape_html=False) for a single
+# value (nested containers are returned as sanitized containers), raw() for
+# the shallow unescaped container
 class HtmlSanitizedSetterGetter(object):
+	_escaped = None  # key -> (raw value, escaped value), memoized escapes
+
 	def __getitem__(self, k, escape_html=True):
 		val = super().__getitem__(k)
-		if(escape_html and isinstance(val, str)):
-			return html_escape(val)
+		if(isinstance(val, str)):
+			if(not escape_html or ("<" not in val and ">" not in val)):
+				return val
+			if(
+				(escaped := self._escaped) is not None
+				and (_escaped := escaped.get(k)) is not None
+				and _escaped[0] is val  # not replaced since
+			):
+				return _escaped[1]
+			if(escaped is None):
+				self._escaped = escaped = {}
+			escaped[k] = (val, _escaped := html_escape(val))
+			return _escaped
 		elif(isinstance(val, dict)):
 			if(isinstance(val, HtmlSanitizedDict)):
 				return val
@@ -39,7 +57,7 @@ class HtmlSanitizedList(HtmlSanitizedSetterGetter, list):
 		return list(super().__iter__())
 
 	def __iter__(self):
-		# unoptimized but for this it's okay, always returns sanitized one
+		# always returns sanitized ones
 		return map(self.__getitem__, range(len(self)))
 
 	def get(self, i, escape_html=True, default=None):
@@ -51,6 +69,7 @@ class HtmlSanitizedList(HtmlSanitizedSetterGetter, list):
 		except Exception:
 			return default
 
+	# can pass escape_html=false if you want raw data
 	def at(self, k, escape_html=True):
 		return self.__getitem__(
 			k,
@@ -83,5 +102,5 @@ class HtmlSanitizedDict(HtmlSanitizedSetterGetter, dict):
 			return default
 
 	def items(self):
-		# unoptimized but for this it's okay, always returns sanitized one
+		# always returns sanitized ones
 		return map(lambda k: (k, self.__getitem__(k)), dict.keys(self))
@@ -11,6 +11,18 @@ from ..tools import BufferedSocket
 _has_forked = False
 _is_listening = True
 BLASTER_FORK_ID = 0
+BLASTER_NUM_PROCS = 1
+
+# raw frames are not pickled, tagged with a first byte
+# pickle never starts with(protocol >= 2 starts with 0x80)
+RAW_FRAME = 0x01
+_raw_frame_handlers = {}  # channel(0-255) -> handler(memoryview of data)
+# send_raw_multiproc(channel, data), sends to every other process, set after fork
+send_raw_multiproc = None
+
+
+def register_raw_frame_handler(channel, handler):
+	_raw_frame_handlers[channel] = handler
 
 
 # forks current process x num_process
@@ -20,9 +32,9 @@ BLASTER_FORK_ID = 0
 def blaster_fork(num_procs):
 	# post load imports, because of config variables
 	# GLOBALS
-	global BLASTER_FORK_ID, _has_forked
+	global BLASTER_FORK_ID, BLASTER_NUM_PROCS, _has_forked, send_raw_multiproc
 
-	num_procs = min(num_procs, os.cpu_count())
+	num_procs = BLASTER_NUM_PROCS = min(num_procs, os.cpu_count())
 
 	if(_has_forked):
 		raise Exception("Cannot blaster_fork again")
@@ -56,6 +68,15 @@ def blaster_fork(num_procs):
 		while(_is_listening and (data_size_bytes := sock.recvn(4))):
 			data_size = int.from_bytes(data_size_bytes, byteorder=sys.byteorder)
 			data_bytes = sock.recvn(data_size)
+			if(data_bytes[0] == RAW_FRAME):
+				if(BROADCASTER_PID == CUR_PID):
+					# forward to everyone except the sender
+					for _sock in tracked_connections:
+						if(_sock is not sock):
+							_sock.sendl(data_size_bytes, data_bytes)
+				if((handler := _raw_frame_handlers.get(data_bytes[1])) is not None):
+					handler(memoryview(data_bytes)[2:])
+				continue
 			data = pickle.loads(data_bytes)
 			if(data["type"] == EVENT):
 				events.broadcast_event(data["event"], *data["args"], **data["kwargs"])
@@ -64,7 +85,7 @@ def blaster_fork(num_procs):
 					# we are the central broadcaster process
 					# broadcast to all clients
 					for _sock in tracked_connections:
-						_sock.sendl(data_bytes)  # locked send
+						_sock.sendl(data_size_bytes, data_bytes)  # locked send
 			if(data["type"] == FUNCTION_CALL):
 				if(BROADCASTER_PID == CUR_PID):
 					# execute only on master
@@ -101,6 +122,17 @@ def blaster_fork(num_procs):
 
 	events.broadcast_event_multiproc = broadcast_event_multiproc
 
+	# unlike events, not delivered to the current process
+	def _send_raw_multiproc(channel, data):
+		msg_header = (len(data) + 2).to_bytes(4, byteorder=sys.byteorder)
+		if(BROADCASTER_PID == os.getpid()):
+			for _sock in tracked_connections:
+				_sock.sendl(msg_header, bytes((RAW_FRAME, channel)), data)
+		else:
+			sock.sendl(msg_header, bytes((RAW_FRAME, channel)), data)
+
+	send_raw_multiproc = _send_raw_multiproc
+
 	@events.register_listener("blaster_exit1")
 	def stop_broadcaster():
 		global _is_listening
@@ -146,9 +178,10 @@ def blaster_fork(num_procs):
 		for i in range(3):
 			try:
 				# cloned process, connect to the BROADCASTER SOCKET
-				sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				# buffered, broadcast_event_multiproc sends on it with sendl
+				sock = BufferedSocket(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
 				sock.connect(multiproc_broadcaster_sock_address)
-				joinables.append(_thread := Thread(target=read_data_from_other_process, args=(BufferedSocket(sock),)))
+				joinables.append(_thread := Thread(target=read_data_from_other_process, args=(sock,)))
 				_thread.start()
 				break
 			except Exception as ex:
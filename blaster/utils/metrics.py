@@ -0,0 +1,180 @@
+import os
+import bisect
+import itertools
+from gevent.event import Event
+from . import events
+from . import fork
+
+# fixed log scale latency buckets(upper bounds in ms), last one is +Inf
+LATENCY_BUCKETS_MS = (
+	0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000
+)
+METRICS_COLLECT_TIMEOUT = 2  # seconds to wait for other workers
+
+
+class RouteMetrics:
+	__slots__ = (
+		"buckets", "sum_ms", "count", "statuses", "bytes_in", "bytes_out", "in_flight", "shed", "coalesced"
+	)
+
+	def __init__(self):
+		self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)  # not cumulative
+		self.sum_ms = 0.0
+		self.count = 0
+		self.statuses = {}  # "200" -> count
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.in_flight = 0
+		self.shed = {}  # reason -> count, rejected by admission control
+		self.coalesced = 0  # got the result of an identical in-flight request
+
+	def observe(self, wallclock_ms, status, bytes_in, bytes_out):
+		self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, wallclock_ms)] += 1
+		self.sum_ms += wallclock_ms
+		self.count += 1
+		self.statuses[status] = self.statuses.get(status, 0) + 1
+		self.bytes_in += bytes_in
+		self.bytes_out += bytes_out
+
+	def observe_shed(self, reason):
+		self.shed[reason] = self.shed.get(reason, 0) + 1
+
+	def to_dict(self):
+		return {
+			"buckets": list(self.buckets), "sum_ms": self.sum_ms, "count": self.count,
+			"statuses": dict(self.statuses), "bytes_in": self.bytes_in,
+			"bytes_out": self.bytes_out, "in_flight": self.in_flight, "shed": dict(self.shed),
+			"coalesced": self.coalesced
+		}
+
+
+class Metrics:
+	def __init__(self):
+		self.routes = {}  # (route, method) -> RouteMetrics
+
+	def get(self, route, method):
+		if((route_metrics := self.routes.get((route, method))) is None):
+			self.routes[(route, method)] = route_metrics = RouteMetrics()
+		return route_metrics
+
+	# plain picklable copy, to send across processes
+	def snapshot(self):
+		return {
+			"routes": {key: route_metrics.to_dict() for key, route_metrics in self.routes.items()}
+		}
+
+
+# process wide http metrics, updated by the server for each request
+http_metrics = Metrics()
+
+
+def merge_snapshots(snapshots):
+	ret = {"routes": {}}
+	for snapshot in snapshots:
+		for key, route_snapshot in snapshot["routes"].items():
+			if((merged := ret["routes"].get(key)) is None):
+				ret["routes"][key] = merged = RouteMetrics().to_dict()
+			for i, n in enumerate(route_snapshot["buckets"]):
+				merged["buckets"][i] += n
+			for status, n in route_snapshot["statuses"].items():
+				merged["statuses"][status] = merged["statuses"].get(status, 0) + n
+			for reason, n in route_snapshot["shed"].items():
+				merged["shed"][reason] = merged["shed"].get(reason, 0) + n
+			for k in ("sum_ms", "count", "bytes_in", "bytes_out", "in_flight", "coalesced"):
+				merged[k] += route_snapshot.get(k, 0)
+	return ret
+
+
+def _escape_label(val):
+	return str(val).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# prometheus text exposition format
+def to_prometheus_text(snapshot):
+	lines = [
+		"# HELP blaster_http_request_duration_seconds Request latency by route and method.",
+		"# TYPE blaster_http_request_duration_seconds histogram"
+	]
+	routes = sorted(
+		(("route=\"{}\",method=\"{}\"".format(_escape_label(route), _escape_label(method)), route_snapshot)
+		for (route, method), route_snapshot in snapshot["routes"].items()),
+		key=lambda x: x[0]
+	)
+	for labels, route_snapshot in routes:
+		cumulative = 0
+		for le, n in zip(LATENCY_BUCKETS_MS + ("+Inf",), route_snapshot["buckets"]):
+			cumulative += n
+			le = le if le == "+Inf" else repr(le / 1000)
+			lines.append("blaster_http_request_duration_seconds_bucket{{{},le=\"{}\"}} {}".format(labels, le, cumulative))
+		lines.append("blaster_http_request_duration_seconds_sum{{{}}} {}".format(labels, route_snapshot["sum_ms"] / 1000))
+		lines.append("blaster_http_request_duration_seconds_count{{{}}} {}".format(labels, route_snapshot["count"]))
+
+	lines.append("# HELP blaster_http_responses_total Responses by route, method and status.")
+	lines.append("# TYPE blaster_http_responses_total counter")
+	for labels, route_snapshot in routes:
+		for status, n in sorted(route_snapshot["statuses"].items()):
+			lines.append("blaster_http_responses_total{{{},status=\"{}\"}} {}".format(labels, _escape_label(status), n))
+
+	lines.append("# HELP blaster_http_shed_total Requests rejected with 503 by admission control.")
+	lines.append("# TYPE blaster_http_shed_total counter")
+	for labels, route_snapshot in routes:
+		for reason, n in sorted(route_snapshot["shed"].items()):
+			lines.append("blaster_http_shed_total{{{},reason=\"{}\"}} {}".format(labels, _escape_label(reason), n))
+
+	for name, key, _type, _help in (
+		("blaster_http_request_bytes_total", "bytes_in", "counter", "Request bytes received."),
+		("blaster_http_response_bytes_total", "bytes_out", "counter", "Response body bytes sent."),
+		("blaster_http_requests_in_flight", "in_flight", "gauge", "Requests being handled."),
+		("blaster_http_coalesced_total", "coalesced", "counter", "Requests served by an identical in-flight request.")
+	):
+		lines.append("# HELP {} {}".format(name, _help))
+		lines.append("# TYPE {} {}".format(name, _type))
+		for labels, route_snapshot in routes:
+			lines.append("{}{{{}}} {}".format(name, labels, route_snapshot[key]))
+	return "\n".join(lines) + "\n"
+
+
+# cross worker collection, the requesting worker broadcasts a request
+# and every worker(including itself) responds with its snapshot
+_pending_collections = {}  # request_id -> (Event, {fork_id: snapshot})
+_collection_ids = itertools.count()
+
+
+@events.register_listener("blaster_metrics_request")
+def _on_metrics_request(request_id):
+	events.broadcast_event_multiproc(
+		"blaster_metrics_response", request_id, fork.BLASTER_FORK_ID, http_metrics.snapshot()
+	)
+
+
+@events.register_listener("blaster_metrics_response")
+def _on_metrics_response(request_id, fork_id, snapshot):
+	if((pending := _pending_collections.get(request_id)) is None):
+		return  # some other worker's request
+	done, snapshots = pending
+	snapshots[fork_id] = snapshot
+	if(len(snapshots) >= fork.BLASTER_NUM_PROCS):
+		done.set()
+
+
+# merged snapshot of all workers, workers that don't respond
+# within the timeout are left out
+def collect_metrics(timeout=METRICS_COLLECT_TIMEOUT):
+	if(events.broadcast_event_multiproc is None):  # not forked
+		return http_metrics.snapshot()
+	request_id = "{}-{}".format(os.getpid(), next(_collection_ids))
+	_pending_collections[request_id] = (done := Event(), snapshots := {})
+	try:
+		events.broadcast_event_multiproc("blaster_metrics_request", request_id)
+		done.wait(timeout)
+	finally:
+		_pending_collections.pop(request_id, None)
+	return merge_snapshots(snapshots.values())
+
+
+# opt-in route, app.start(handlers=[("/metrics", metrics_handler)])
+def metrics_handler():
+	return (
+		{"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+		to_prometheus_text(collect_metrics())
+	)
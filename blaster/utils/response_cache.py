@@ -0,0 +1,136 @@
+import collections
+from gevent.event import Event
+from . import events
+from ..tools import cur_ms
+
+_1MB_ = 1024 * 1024
+
+RESPONSE_CACHE_MAX_SIZE = 32 * _1MB_
+RESPONSE_CACHE_MAX_ENTRY_SIZE = _1MB_
+RESPONSE_CACHE_WAIT_TIMEOUT = 5  # seconds to wait for the greenlet computing the response
+
+# name -> ResponseCache, for invalidation
+_response_caches = {}
+
+
+# caches complete encoded responses of a route(status line, header bytes, body)
+# keyed by path + selected query params + selected headers + content encoding.
+# On a miss only one greenlet per key runs the handler, others wait for it
+# or get the stale response if there is one.
+# NOTE: cached responses skip before hooks, arg type hooks and admission control,
+# routes with before hooks or hooked args(auth, user: User) must have "cookie"
+# or "authorization" in headers
+class ResponseCache:
+	def __init__(
+		self, name=None, ttl=60 * 1000, params=None, headers=None,
+		max_size=RESPONSE_CACHE_MAX_SIZE, max_entry_size=RESPONSE_CACHE_MAX_ENTRY_SIZE,
+		serve_stale=True, wait_timeout=RESPONSE_CACHE_WAIT_TIMEOUT
+	):
+		self.name = name
+		self.ttl = ttl  # millis
+		self.params = tuple(params) if params is not None else None  # None => whole query string
+		self.headers = tuple(x.lower() for x in headers or ())
+		self.max_size = max_size
+		self.max_entry_size = max_entry_size
+		self.serve_stale = serve_stale
+		self.wait_timeout = wait_timeout
+		self.entries = collections.OrderedDict()  # key -> (expires_at, status_line, headers_block, body)
+		self.size = 0
+		self.in_flight = {}  # key -> Event, set when the response is computed
+		self.hits = self.stale_hits = self.misses = 0
+		if(name is not None):
+			_response_caches[name] = self
+
+	def key(self, req, encoding):
+		if(self.params is None):
+			params = req._query_string
+		else:
+			params = tuple(req._params.get(x) for x in self.params)
+		return (
+			req.path, params,
+			tuple(req._header(x) for x in self.headers) if self.headers else None,
+			encoding
+		)
+
+	# returns (entry, is_leader), when entry is None and is_leader is True
+	# the caller computes the response, stores it and calls done(key)
+	def lookup(self, key):
+		entry = self.entries.get(key)
+		if(entry is not None and entry[0] > cur_ms()):
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return entry, False
+		if((computing := self.in_flight.get(key)) is not None):
+			if(entry is not None and self.serve_stale):
+				self.stale_hits += 1
+				return entry, False
+			computing.wait(self.wait_timeout)
+			if((entry := self.entries.get(key)) is not None):
+				self.hits += 1
+				return entry, False
+			self.misses += 1
+			return None, False  # not cacheable or failed, compute without caching
+		self.misses += 1
+		self.in_flight[key] = Event()
+		return None, True
+
+	def done(self, key):
+		if((computing := self.in_flight.pop(key, None)) is not None):
+			computing.set()
+
+	# response: complete encoded response as written to the socket
+	def store(self, key, response):
+		if(len(response) > self.max_entry_size):
+			return
+		status_end = response.find(b'\r\n') + 2
+		headers_end = response.find(b'\r\n\r\n', status_end - 2) + 2
+		if(status_end < 2 or headers_end < 2):
+			return
+		# Date and Connection are set for each response when serving
+		headers_block = b''.join(
+			line + b'\r\n' for line in bytes(response[status_end: headers_end]).split(b'\r\n')
+			if line and not line.startswith((b'Date: ', b'Connection: '))
+		)
+		entry = (
+			cur_ms() + self.ttl, bytes(response[:status_end]),
+			headers_block, bytes(response[headers_end + 2:])
+		)
+		self.delete(key)
+		self.entries[key] = entry
+		self.size += self.entry_size(entry)
+		while(self.size > self.max_size and self.entries):
+			self.delete(next(iter(self.entries)))  # least recently used
+
+	@staticmethod
+	def entry_size(entry):
+		return len(entry[1]) + len(entry[2]) + len(entry[3]) + 128
+
+	def delete(self, key):
+		if((entry := self.entries.pop(key, None)) is not None):
+			self.size -= self.entry_size(entry)
+
+	def clear(self, path=None):
+		if(path is None):
+			self.entries.clear()
+			self.size = 0
+			return
+		for key in [key for key in self.entries if key[0] == path]:
+			self.delete(key)
+
+
+@events.register_listener("blaster_response_cache_invalidate")
+def _on_invalidate(name=None, path=None):
+	if(name is not None):
+		(response_cache := _response_caches.get(name)) and response_cache.clear(path)
+		return
+	for response_cache in _response_caches.values():
+		response_cache.clear(path)
+
+
+# clears cached responses of a route(name defaults to the route path/regex),
+# optionally only for a path, in all forked workers
+def invalidate_response_cache(name=None, path=None):
+	if(events.broadcast_event_multiproc is not None):
+		events.broadcast_event_multiproc("blaster_response_cache_invalidate", name, path)
+	else:
+		events.broadcast_event("blaster_response_cache_invalidate", name, path)
@@ -0,0 +1,126 @@
+import struct
+import gevent
+from . import fork
+from ..websocket.server import broadcast, SLOW_CONSUMER_SKIP
+
+# fork raw frame channel of registry messages
+WS_REGISTRY_CHANNEL = 1
+
+# message targets
+USER = 0
+ROOM = 1
+
+# batch entry: kind, is_text, key length, payload length, key, payload
+_ENTRY_HEADER = struct.Struct("!BBHI")
+
+
+# user_id and room -> websocket connections of this worker, connections
+# are anything broadcast accepts(WebSocketServerHandler, WebsocketConnection).
+# Messages are delivered to local connections directly and sent to other
+# workers over the fork broadcaster socket, all messages of a tick in one frame.
+# Connections are removed when their websocket closes
+class ConnectionRegistry:
+	def __init__(self, slow_consumer=SLOW_CONSUMER_SKIP):
+		self.users = {}  # user_id -> {connections}
+		self.rooms = {}  # room -> {connections}
+		self.conn_user = {}  # connection -> user_id
+		self.conn_rooms = {}  # connection -> {rooms}
+		self.slow_consumer = slow_consumer
+		self.pending = []  # encoded entries for other workers
+		self.flusher = None
+
+	def add(self, conn, user_id=None, rooms=()):
+		self._track(conn)
+		if(user_id is None):
+			user_id = getattr(conn, "user_id", None)
+		if(user_id is not None):
+			user_id = str(user_id)
+			self.conn_user[conn] = user_id
+			self.users.setdefault(user_id, set()).add(conn)
+		for room in rooms:
+			self.join(conn, room)
+
+	def remove(self, conn):
+		if((user_id := self.conn_user.pop(conn, None)) is not None):
+			_discard(self.users, user_id, conn)
+		for room in self.conn_rooms.pop(conn, ()):
+			_discard(self.rooms, room, conn)
+
+	def join(self, conn, room):
+		self._track(conn)
+		room = str(room)
+		self.rooms.setdefault(room, set()).add(conn)
+		self.conn_rooms.setdefault(conn, set()).add(room)
+
+	# unregister when the underlying websocket closes
+	def _track(self, conn):
+		if(conn in self.conn_user or conn in self.conn_rooms):
+			return  # already tracked
+		ws = getattr(conn, "ws", conn)  # WebsocketConnection wraps the handler
+		ws.add_close_callback(lambda: self.remove(conn))
+
+	def leave(self, conn, room):
+		room = str(room)
+		_discard(self.rooms, room, conn)
+		if((rooms := self.conn_rooms.get(conn)) is not None):
+			rooms.discard(room)
+			if(not rooms):
+				del self.conn_rooms[conn]
+
+	def send_to_user(self, user_id, payload, is_text=True):
+		return self._publish(USER, str(user_id), payload, is_text)
+
+	def publish(self, room, payload, is_text=True):
+		return self._publish(ROOM, str(room), payload, is_text)
+
+	# returns the number of local connections it was queued on
+	def _publish(self, kind, key, payload, is_text):
+		if(isinstance(payload, str)):
+			payload = payload.encode()
+		ret = self._deliver(kind, key, payload, is_text)
+		if(fork.send_raw_multiproc is not None):
+			key_bytes = key.encode()
+			self.pending.append(
+				_ENTRY_HEADER.pack(kind, 1 if is_text else 0, len(key_bytes), len(payload))
+			)
+			self.pending.append(key_bytes)
+			self.pending.append(payload)
+			if(self.flusher is None):
+				self.flusher = gevent.spawn(self._flush)
+		return ret
+
+	def _flush(self):
+		pending = self.pending
+		self.pending = []
+		self.flusher = None
+		if(pending):
+			fork.send_raw_multiproc(WS_REGISTRY_CHANNEL, b"".join(pending))
+
+	def _deliver(self, kind, key, payload, is_text):
+		conns = (self.users if kind == USER else self.rooms).get(key)
+		if(not conns):
+			return 0
+		return broadcast(list(conns), payload, is_text=is_text, slow_consumer=self.slow_consumer)
+
+	# batch from another worker
+	def on_batch(self, data):
+		pos = 0
+		n = len(data)
+		while(pos < n):
+			kind, is_text, key_len, payload_len = _ENTRY_HEADER.unpack_from(data, pos)
+			pos += _ENTRY_HEADER.size
+			key = str(data[pos: pos + key_len], "utf-8")
+			pos += key_len
+			self._deliver(kind, key, bytes(data[pos: pos + payload_len]), is_text == 1)
+			pos += payload_len
+
+
+def _discard(conns_map, key, conn):
+	if((conns := conns_map.get(key)) is not None):
+		conns.discard(conn)
+		if(not conns):
+			del conns_map[key]
+
+
+ws_registry = ConnectionRegistry()
+fork.register_raw_frame_handler(WS_REGISTRY_CHANNEL, ws_registry.on_batch)
@@ -12,6 +12,14 @@ import errno
 
 import codecs
 import struct
+import zlib
+import collections
+import gevent
+from gevent.lock import BoundedSemaphore
+try:
+	import numpy  # faster unmasking of large payloads
+except ImportError:
+	numpy = None
 
 VER = sys.version_info[0]
 
@@ -23,7 +31,7 @@ HANDSHAKE_STR = (
 	"HTTP/1.1 101 Switching Protocols\r\n"
 	"Upgrade: WebSocket\r\n"
 	"Connection: Upgrade\r\n"
-	"Sec-WebSocket-Accept: %(acceptstr)s\r\n\r\n"
+	"Sec-WebSocket-Accept: %(acceptstr)s\r\n%(extensions)s\r\n"
 )
 
 GUID_STR = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
@@ -36,21 +44,201 @@ PING = 0x9
 PONG = 0xA
 
 HEADERB1 = 1
-HEADERB2 = 3
-LENGTHSHORT = 4
-LENGTHLONG = 5
-MASK = 6
 PAYLOAD = 7
 
 MAXHEADER = 65536
 MAXPAYLOAD = 33554432
-
+MAX_SEND_QUEUE = 256
+WS_DEFLATE_MIN_SIZE = 256
+WS_DEFLATE_LEVEL = 6
+# appended by every sync flush, stripped from the wire (RFC 7692 7.2.1)
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+NUMPY_UNMASK_MIN_SIZE = 4096
+
+
+# xor payload with the 4 byte mask repeated, on the whole buffer at once
+def unmask_payload(data, mask):
+	n = len(data)
+	if(n == 0):
+		return bytearray()
+	mask = (mask * ((n + 3) // 4))[:n]
+	if(numpy is not None and n >= NUMPY_UNMASK_MIN_SIZE):
+		ret = bytearray(n)
+		numpy.bitwise_xor(
+			numpy.frombuffer(data, dtype=numpy.uint8),
+			numpy.frombuffer(mask, dtype=numpy.uint8),
+			out=numpy.frombuffer(ret, dtype=numpy.uint8)
+		)
+		return ret
+	return bytearray(
+		(int.from_bytes(data, "big") ^ int.from_bytes(mask, "big")).to_bytes(n, "big")
+	)
+
+
+def encode_frame(opcode, data, fin=True, rsv1=False):
+	if isinstance(data, str):
+		data = data.encode('utf-8')
+
+	b1 = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+	length = len(data)
+	if length <= 125:
+		header = struct.pack("!BB", b1, length)
+	elif length <= 65535:
+		header = struct.pack("!BBH", b1, 126, length)
+	else:
+		header = struct.pack("!BBQ", b1, 127, length)
+	return header + data
+
+
+class PerMessageDeflate:
+	"""
+			permessage-deflate (RFC 7692) state of one connection.
+			window_bits and no_context_takeover apply to what the server sends,
+			messages smaller than min_size are sent uncompressed.
+	"""
+
+	def __init__(
+		self, window_bits=15, no_context_takeover=False,
+		min_size=WS_DEFLATE_MIN_SIZE, level=WS_DEFLATE_LEVEL
+	):
+		self.window_bits = window_bits
+		self.no_context_takeover = no_context_takeover
+		self.min_size = min_size
+		self.level = level
+		self.compressor = None
+		# client may use any window, 15 can inflate all of them
+		self.decompressor = zlib.decompressobj(-15)
+
+	@classmethod
+	def negotiate(cls, config, extensions_header):
+		"""
+				Picks the first permessage-deflate offer in Sec-WebSocket-Extensions
+				that we can accept. config is True or kwargs of PerMessageDeflate.
+				Returns (PerMessageDeflate, response extension string) or (None, None).
+		"""
+		config = config if isinstance(config, dict) else {}
+		for offer in (extensions_header or "").split(","):
+			name, *params = [x.strip() for x in offer.split(";")]
+			if(name.lower() != "permessage-deflate"):
+				continue
+			offer_params = {}
+			for param in params:
+				key, _, val = param.partition("=")
+				key = key.strip().lower()
+				if(key in offer_params):
+					break  # duplicate parameter, decline this offer
+				offer_params[key] = val.strip().strip('"') or None
+			else:
+				window_bits = min(max(config.get("window_bits", 15), 9), 15)
+				no_context_takeover = config.get("no_context_takeover", False)
+				response = ["permessage-deflate"]
+				try:
+					for key, val in offer_params.items():
+						if(key == "server_max_window_bits"):
+							# zlib cannot produce an 8 bit window, decline it
+							if(not (9 <= (requested := int(val)) <= 15)):
+								raise ValueError(val)
+							window_bits = min(window_bits, requested)
+						elif(key == "server_no_context_takeover" and val is None):
+							no_context_takeover = True
+						elif(key == "client_max_window_bits"):
+							if(val is not None and not (8 <= int(val) <= 15)):
+								raise ValueError(val)
+						elif(key == "client_no_context_takeover" and val is None):
+							pass  # only the client's compressor resets, we inflate either way
+						else:
+							raise ValueError(key)
+				except ValueError:
+					continue
+				if(no_context_takeover):
+					response.append("server_no_context_takeover")
+				if(window_bits < 15 or "server_max_window_bits" in offer_params):
+					response.append("server_max_window_bits={}".format(window_bits))
+				return cls(
+					window_bits=window_bits, no_context_takeover=no_context_takeover,
+					min_size=config.get("min_size", WS_DEFLATE_MIN_SIZE),
+					level=config.get("level", WS_DEFLATE_LEVEL)
+				), "; ".join(response)
+		return None, None
+
+	# messages compressed without context takeover are the same for
+	# every connection with these settings
+	def shared_key(self):
+		return (self.window_bits, self.level) if self.no_context_takeover else None
+
+	def compress(self, data):
+		if(self.no_context_takeover or self.compressor is None):
+			self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits)
+		ret = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		if(ret.endswith(DEFLATE_TAIL)):
+			ret = ret[:-4]
+		return ret
+
+	# final is the last frame of the message
+	def decompress(self, data, final, max_size):
+		if(final):
+			data = bytes(data) + DEFLATE_TAIL
+		ret = self.decompressor.decompress(data, max_size)
+		if(self.decompressor.unconsumed_tail):
+			raise Exception('payload exceeded allowable size')
+		return bytearray(ret)
+
+
+# slow consumer policies for broadcast
+SLOW_CONSUMER_SKIP = 0  # the message is not delivered to it
+SLOW_CONSUMER_CLOSE = 1  # the connection is closed
+
+
+def broadcast(connections, payload, is_text=True, slow_consumer=SLOW_CONSUMER_SKIP):
+	"""
+			Send the same message to all connections, the frame is encoded
+			once and the same bytes are queued on every connection. Connections
+			with permessage-deflate and no context takeover share one
+			compressed frame. With context takeover the compressor state is
+			per connection, so the message goes through queue_message and
+			is compressed in the order it is sent.
+			Connections are anything with queue_frame(frame) -> bool and
+			queue_message(payload, is_text) -> bool.
+			Returns the number of connections the message was queued on.
+	"""
+	opcode = TEXT if is_text or isinstance(payload, str) else BINARY
+	if(isinstance(payload, str)):
+		payload = payload.encode('utf-8')
+	frame = memoryview(encode_frame(opcode, payload))
+	compressed_frames = {}  # shared_key => frame
+	sent = 0
+	for conn in connections:
+		conn_frame = frame
+		if(
+			(deflate := getattr(conn, "deflate", None)) is not None
+			and len(payload) >= deflate.min_size
+		):
+			if((shared_key := deflate.shared_key()) is None):
+				conn_frame = None
+			elif((conn_frame := compressed_frames.get(shared_key)) is None):
+				conn_frame = compressed_frames[shared_key] = memoryview(
+					encode_frame(opcode, deflate.compress(payload), rsv1=True)
+				)
+		if(
+			conn.queue_frame(conn_frame) if conn_frame is not None
+			else conn.queue_message(payload, opcode == TEXT)
+		):
+			sent += 1
+		elif(slow_consumer == SLOW_CONSUMER_CLOSE):
+			conn.close(1008, "slow consumer")
+	return sent
 
 
 class WebSocketServerHandler(object):
 
-	def __init__(self, sock):
+	def __init__(self, sock, deflate=None):
 		self.client = sock
+		# True or PerMessageDeflate kwargs to offer permessage-deflate,
+		# replaced by the negotiated PerMessageDeflate or None in the handshake
+		self.deflate_config = deflate
+		self.deflate = None
+		self.rsv1 = False  # current frame is compressed
+		self.msg_compressed = False  # message being received is compressed
 		self.handshaked = False
 
 		self.fin = 0
@@ -59,8 +247,6 @@ class WebSocketServerHandler(object):
 		self.hasmask = 0
 		self.maskarray = None
 		self.length = 0
-		self.lengtharray = None
-		self.index = 0
 		self.request = None
 		self.usingssl = False
 
@@ -70,10 +256,18 @@ class WebSocketServerHandler(object):
 		self.frag_decoder = codecs.getincrementaldecoder('utf-8')(errors='strict')
 		self.closed = False
 		self.state = HEADERB1
+		self.recv_buffer = bytearray()  # received bytes not parsed yet
 
 		# restrict the size of header and payload for security reasons
 		self.maxheader = MAXHEADER
 		self.maxpayload = MAXPAYLOAD
+		# frames waiting to be written, bounded for broadcasts
+		self.send_queue = collections.deque()
+		self.send_lock = BoundedSemaphore()
+		self.max_send_queue = MAX_SEND_QUEUE
+
+		# called once when the connection closes, ex: to unregister it
+		self.close_callbacks = []
 
 		# additional fields convenience
 		self.conn_obj = None
@@ -85,13 +279,23 @@ class WebSocketServerHandler(object):
 			except (socket.error, Exception) as ex:
 				self.on_close(ex)
 				self.client.close()
+				self._run_close_callbacks()
 				break
 			except socket.timeout as ex:
 				if(not self.on_timeout()):
 					self.on_close(ex)
 					self.client.close()
+					self._run_close_callbacks()
 					break
 
+	def add_close_callback(self, callback):
+		self.close_callbacks.append(callback)
+
+	def _run_close_callbacks(self):
+		callbacks, self.close_callbacks = self.close_callbacks, []
+		for callback in callbacks:
+			callback()
+
 	def on_timeout(self):
 		return False
 
@@ -126,6 +330,11 @@ class WebSocketServerHandler(object):
 			# unknown or reserved opcode so just close
 			raise Exception('unknown opcode')
 
+		if self.opcode == TEXT or self.opcode == BINARY:
+			self.msg_compressed = self.rsv1
+		if self.msg_compressed and (self.opcode == TEXT or self.opcode == BINARY or self.opcode == STREAM):
+			self.data = self.deflate.decompress(self.data, bool(self.fin), self.maxpayload)
+
 		if self.opcode == CLOSE:
 			status = 1000
 			reason = u''
@@ -225,7 +434,14 @@ class WebSocketServerHandler(object):
 			key = headers['Sec-WebSocket-Key'].strip()
 			k = key + GUID_STR
 			k_s = base64.b64encode(hashlib.sha1(k.encode()).digest()).decode('utf-8')
-			hStr = HANDSHAKE_STR % {'acceptstr': k_s}
+			extensions = ''
+			if(self.deflate_config):
+				self.deflate, deflate_response = PerMessageDeflate.negotiate(
+					self.deflate_config, headers.get('Sec-WebSocket-Extensions')
+				)
+				if(deflate_response):
+					extensions = 'Sec-WebSocket-Extensions: %s\r\n' % deflate_response
+			hStr = HANDSHAKE_STR % {'acceptstr': k_s, 'extensions': extensions}
 			self._send_buffer(hStr.encode('utf-8'))
 			self.handshaked = True
 			
@@ -236,17 +452,74 @@ class WebSocketServerHandler(object):
 	
 
 	def _handle_data(self):
-			# do the HTTP header and handshake
-			data = self.client.recv(8192)
-			if not data:
-					raise Exception("remote socket closed")
-
-			if VER >= 3:
-					for d in data:
-							self._parse_message(d)
-			else:
-					for d in data:
-							self._parse_message(ord(d))
+		data = self.client.recv(8192)
+		if not data:
+			raise Exception("remote socket closed")
+		self._parse_data(data)
+
+	# parses as many frames as there are in the received data, headers with
+	# struct.unpack_from and payloads as slices, partial frames are continued
+	# on the next call
+	def _parse_data(self, data):
+		buf = self.recv_buffer
+		buf += data
+		pos = 0
+		try:
+			with memoryview(buf) as view:
+				while(True):
+					if(self.state == HEADERB1):
+						available = len(buf) - pos
+						if(available < 2):
+							break
+						b1 = buf[pos]
+						b2 = buf[pos + 1]
+						opcode = b1 & 0x0F
+						if(b1 & 0x70 and (
+							b1 & 0x30 or self.deflate is None
+							or (opcode != TEXT and opcode != BINARY)
+						)):
+							raise Exception('RSV bit must be 0')
+						length = b2 & 0x7F
+						if(opcode == PING and length > 125):
+							raise Exception('ping packet is too large')
+						hasmask = (b2 & 0x80) == 0x80
+						header_len = 2 + (2 if length == 126 else 8 if length == 127 else 0) + (4 if hasmask else 0)
+						if(available < header_len):
+							break  # wait for the rest of the header
+						if(length == 126):
+							length = struct.unpack_from('!H', buf, pos + 2)[0]
+						elif(length == 127):
+							length = struct.unpack_from('!Q', buf, pos + 2)[0]
+						if(length >= self.maxpayload):
+							raise Exception('payload exceeded allowable size')
+
+						self.fin = b1 & 0x80
+						self.rsv1 = b1 & 0x40 == 0x40
+						self.opcode = opcode
+						self.hasmask = hasmask
+						self.length = length
+						self.maskarray = bytes(view[pos + header_len - 4: pos + header_len]) if hasmask else None
+						self.data = bytearray()
+						self.state = PAYLOAD
+						pos += header_len
+
+					# PAYLOAD, copy as much as is there
+					needed = self.length - len(self.data)
+					if(len(buf) - pos < needed):
+						self.data += view[pos:]
+						pos = len(buf)
+						break
+					self.data += view[pos: pos + needed]
+					pos += needed
+					if(self.hasmask):
+						self.data = unmask_payload(self.data, self.maskarray)
+					try:
+						self._handle_packet()
+					finally:
+						self.state = HEADERB1
+						self.data = bytearray()
+		finally:
+			del buf[:pos]
 
 	def close(self, status=1000, reason=u''):
 		"""
@@ -268,6 +541,7 @@ class WebSocketServerHandler(object):
 
 		finally:
 					self.closed = True
+					self._run_close_callbacks()
 
 
 	def _send_buffer(self, buff):
@@ -329,203 +603,72 @@ class WebSocketServerHandler(object):
 				If data is a unicode object then the frame is sent as Text.
 				If the data is a bytearray object then the frame is sent as Binary.
 		"""
+		self._send_frame(self.encode_message(data, is_text=is_text))
+
+	def encode_message(self, data, is_text=True):
+		"""
+				Frame bytes of a message, compressed if negotiated. Frames have
+				to be sent in the order they are encoded when context takeover is on.
+		"""
 		opcode = BINARY
 		if is_text or isinstance(data, str):
 			opcode = TEXT
-		self._send_message(False, opcode, data)
+		if(self.deflate is not None):
+			if isinstance(data, str):
+				data = data.encode('utf-8')
+			if(len(data) >= self.deflate.min_size):
+				return encode_frame(opcode, self.deflate.compress(data), rsv1=True)
+		return encode_frame(opcode, data)
+
+	def send_frames(self, frames):
+		"""
+				Write already encoded frames with a single send.
+		"""
+		self._send_frame(b''.join(frames))
 
 
 	def _send_message(self, fin, opcode, data):
+		self._send_frame(encode_frame(opcode, data, fin=not fin))
 
-		payload = bytearray()
-
-		b1 = 0
-		b2 = 0
-		if fin is False:
-			b1 |= 0x80
-		b1 |= opcode
-
-		if isinstance(data, str):
-			data = data.encode('utf-8')
-
-		length = len(data)
-		payload.append(b1)
-
-		if length <= 125:
-			b2 |= length
-			payload.append(b2)
-
-		elif length >= 126 and length <= 65535:
-			b2 |= 126
-			payload.append(b2)
-			payload.extend(struct.pack("!H", length))
-
-		else:
-			b2 |= 127
-			payload.append(b2)
-			payload.extend(struct.pack("!Q", length))
-
-		if length > 0:
-			payload.extend(data)
-
-		self._send_buffer(payload)
-
-
-	def _parse_message(self, byte):
-		# read in the header
-		if self.state == HEADERB1:
-
-			self.fin = byte & 0x80
-			self.opcode = byte & 0x0F
-			self.state = HEADERB2
-
-			self.index = 0
-			self.length = 0
-			self.lengtharray = bytearray()
-			self.data = bytearray()
-
-			rsv = byte & 0x70
-			if rsv != 0:
-					raise Exception('RSV bit must be 0')
-
-		elif self.state == HEADERB2:
-			mask = byte & 0x80
-			length = byte & 0x7F
-
-			if self.opcode == PING and length > 125:
-					raise Exception('ping packet is too large')
-
-			if mask == 128:
-					self.hasmask = True
-			else:
-					self.hasmask = False
-
-			if length <= 125:
-					self.length = length
-
-					# if we have a mask we must read it
-					if self.hasmask is True:
-						self.maskarray = bytearray()
-						self.state = MASK
-					else:
-						# if there is no mask and no payload we are done
-						if self.length <= 0:
-								try:
-									self._handle_packet()
-								finally:
-									self.state = self.HEADERB1
-									self.data = bytearray()
-
-						# we have no mask and some payload
-						else:
-								# self.index = 0
-								self.data = bytearray()
-								self.state = PAYLOAD
-
-			elif length == 126:
-					self.lengtharray = bytearray()
-					self.state = LENGTHSHORT
-
-			elif length == 127:
-					self.lengtharray = bytearray()
-					self.state = LENGTHLONG
-
-
-		elif self.state == LENGTHSHORT:
-			self.lengtharray.append(byte)
-
-			if len(self.lengtharray) > 2:
-					raise Exception('short length exceeded allowable size')
-
-			if len(self.lengtharray) == 2:
-					self.length = struct.unpack_from('!H', self.lengtharray)[0]
-
-					if self.hasmask is True:
-						self.maskarray = bytearray()
-						self.state = MASK
-					else:
-						# if there is no mask and no payload we are done
-						if self.length <= 0:
-								try:
-									self._handle_packet()
-								finally:
-									self.state = HEADERB1
-									self.data = bytearray()
-
-						# we have no mask and some payload
-						else:
-								# self.index = 0
-								self.data = bytearray()
-								self.state = PAYLOAD
-
-		elif self.state == LENGTHLONG:
-
-			self.lengtharray.append(byte)
-
-			if len(self.lengtharray) > 8:
-					raise Exception('long length exceeded allowable size')
-
-			if len(self.lengtharray) == 8:
-					self.length = struct.unpack_from('!Q', self.lengtharray)[0]
-
-					if self.hasmask is True:
-						self.maskarray = bytearray()
-						self.state = MASK
-					else:
-						# if there is no mask and no payload we are done
-						if self.length <= 0:
-								try:
-									self._handle_packet()
-								finally:
-									self.state = HEADERB1
-									self.data = bytearray()
-
-						# we have no mask and some payload
-						else:
-								# self.index = 0
-								self.data = bytearray()
-								self.state = PAYLOAD
-
-		# MASK STATE
-		elif self.state == MASK:
-			self.maskarray.append(byte)
-
-			if len(self.maskarray) > 4:
-					raise Exception('mask exceeded allowable size')
-
-			if len(self.maskarray) == 4:
-					# if there is no mask and no payload we are done
-					if self.length <= 0:
-						try:
-								self._handle_packet()
-						finally:
-								self.state = HEADERB1
-								self.data = bytearray()
-
-					# we have no mask and some payload
-					else:
-						# self.index = 0
-						self.data = bytearray()
-						self.state = PAYLOAD
+	# frames are written in order by whichever greenlet holds the send lock,
+	# others just queue them and return
+	def _send_frame(self, frame):
+		self.send_queue.append(frame)
+		if(self.send_lock.locked()):
+			return
+		self._flush_send_queue()
 
-		# PAYLOAD STATE
-		elif self.state == PAYLOAD:
-			if self.hasmask is True:
-					self.data.append(byte ^ self.maskarray[self.index % 4])
-			else:
-					self.data.append(byte)
+	def _flush_send_queue(self):
+		with self.send_lock:
+			while(self.send_queue):
+				self._send_buffer(self.send_queue.popleft())
 
-			# if length exceeds allowable size then we except and remove the connection
-			if len(self.data) >= self.maxpayload:
-					raise Exception('payload exceeded allowable size')
+	def queue_frame(self, frame):
+		"""
+				Queue an already encoded frame and write it from another greenlet.
+				Returns False without queuing if the connection is closed or
+				already has max_send_queue frames waiting to be written.
+		"""
+		if(self.closed or len(self.send_queue) >= self.max_send_queue):
+			return False
+		self.send_queue.append(frame)
+		if(not self.send_lock.locked()):
+			gevent.spawn(self._flush_queued_frames)
+		return True
+
+	def queue_message(self, data, is_text=True):
+		"""
+				Like queue_frame, encoded(compressed) only if it is queued, so
+				the compressor sees messages in the order they are written.
+		"""
+		if(self.closed or len(self.send_queue) >= self.max_send_queue):
+			return False
+		return self.queue_frame(self.encode_message(data, is_text=is_text))
 
-			# check if we have processed length bytes; if so we are done
-			if (self.index + 1) == self.length:
-					try:
-						self._handle_packet()
-					finally:
-						# self.index = 0
-						self.state = HEADERB1
-						self.data = bytearray()
-			else:
-					self.index += 1
+	def _flush_queued_frames(self):
+		try:
+			self._flush_send_queue()
+		except Exception:
+			# reader loop sees the broken socket and calls on_close
+			self.closed = True
+			self.send_queue.clear()
@@ -21,12 +21,14 @@ setup(
 		"ujson>=5.10.0",
 		"python-dateutil>=2.8.1",
 		"requests>=2.25.1",
-		"requests-toolbelt>=1.0.0",
 		"urllib3>=1.26.4",
 		"cityhash>=0.4.8",
 		"PyYAML>=6.0",
 		"pybase64>=1.4.2"
 	],
+	extras_require={
+		"orjson": ["orjson>=3.0.0"]  # faster json responses
+	},
 	classifiers=[
 		'Development Status :: 3 - Alpha',      # Chose either "3 - Alpha", "4 - Beta" or "5 - Production/Stable" as the current state of your package
 		'Intended Audience :: Developers',      # Define that your audience are developers
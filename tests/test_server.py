@@ -1,9 +1,286 @@
 import unittest
 import gevent
+import socket
+import time
 from blaster import tools, blaster_exit
-from blaster.server import PathTree, PathTreeNode
+from blaster.server import App, PathTree, PathTreeNode, Request, ConnectionTimers, \
+	get_accepted_encoding, json_encode, is_json_body, build_arg_binder, brotli
+from blaster.tools.sanitize_html import HtmlSanitizedDict
+from blaster.schema import Object, Int, Str, schema
+import json
 
 
 class TestServer(unittest.TestCase):
 	def test_path_prefix_tree(self):
-		pass
+		path_tree = PathTree()
+		self.assertIsInstance(path_tree.root, PathTreeNode)
+
+		routes = [
+			"/", "/items/{item_id}", "/items/new", "/items/{item_id}/edit",
+			"/say/{+something}", "/static/{*path}", "/files/{*+path}", "/folder/",
+			r"/openapi\.json"
+		]
+		for route in routes:
+			path_tree.add(route)["GET"] = route
+		# custom regexes are not part of the tree
+		self.assertIsNone(path_tree.add(r"/user/(\d+)"))
+		self.assertIsNone(path_tree.add("/file/{name}.json"))
+		self.assertIsNone(path_tree.add("/static/{*path}/edit"))
+
+		def find(path, method="GET"):
+			path_params = {}
+			return path_tree.find(path, method, path_params), path_params
+
+		self.assertEqual(find("/"), ("/", {}))
+		self.assertEqual(find("/items/new"), ("/items/new", {}))
+		self.assertEqual(find("/items/10"), ("/items/{item_id}", {"item_id": "10"}))
+		self.assertEqual(find("/items/"), ("/items/{item_id}", {"item_id": ""}))
+		self.assertEqual(find("/items/new/edit"), ("/items/{item_id}/edit", {"item_id": "new"}))
+		self.assertEqual(find("/items/10/delete"), (None, {}))
+		self.assertEqual(find("/say/hi"), ("/say/{+something}", {"something": "hi"}))
+		self.assertEqual(find("/say/"), (None, {}))
+		self.assertEqual(find("/static/a/b.js"), ("/static/{*path}", {"path": "a/b.js"}))
+		self.assertEqual(find("/static/"), ("/static/{*path}", {"path": ""}))
+		self.assertEqual(find("/static"), (None, {}))
+		self.assertEqual(find("/files/"), (None, {}))
+		self.assertEqual(find("/files/a"), ("/files/{*+path}", {"path": "a"}))
+		self.assertEqual(find("/folder/"), ("/folder/", {}))
+		self.assertEqual(find("/folder"), ("/folder/", {}))
+		self.assertEqual(find("/openapi.json"), (r"/openapi\.json", {}))
+		self.assertEqual(find("/items/10", method="POST"), (None, {}))
+
+		# backtracks to params if static branch doesn't have the method
+		path_tree.add("/items/{item_id}")["POST"] = "post_item"
+		self.assertEqual(find("/items/new", method="POST"), ("post_item", {"item_id": "new"}))
+
+	def test_lazy_request_parsing(self):
+		req = Request(None)
+		req._raw_headers = "Host: localhost\r\nContent-Length: 12\r\nX-Empty:\r\nCookie: a=1; b=2=3\r\ncontent-type:  text/plain"
+		req._query_string = "x=1&y[]=2&y[]=3&id=q"
+		req._path_params = {"id": "10", "empty": ""}
+
+		# fast path doesn't parse the whole block
+		self.assertEqual(req._header("content-length"), "12")
+		self.assertEqual(req._header("host"), "localhost")
+		self.assertEqual(req._header("content-type"), "text/plain")
+		self.assertEqual(req._header("x-empty"), "")
+		self.assertIsNone(req._header("length"))
+		self.assertEqual(req._header("transfer-encoding", 0), 0)
+		self.assertNotIn("_headers", req.__dict__)
+		self.assertNotIn("_params", req.__dict__)
+		self.assertNotIn("_cookies", req.__dict__)
+
+		self.assertEqual(req.HEADERS("Content-Length"), "12")
+		self.assertEqual(req.HEADERS("content-type"), "text/plain")
+		self.assertEqual(req.COOKIES(), {"a": "1", "b": "2=3"})
+		self.assertEqual(req.PARAMS("x"), "1")
+		self.assertEqual(req.PARAMS("y"), ["2", "3"])
+		self.assertEqual(req.PARAMS("id"), "10")  # path params override query
+		self.assertNotIn("empty", req.PARAMS())
+		# after parsing, fast path reads from the parsed headers
+		self.assertEqual(req._header("content-length"), "12")
+
+		# non ascii text before the header doesn't shift the lookup
+		req = Request(None)
+		req._raw_headers = "X-Name: \u0130\u0130\u0130\u0130\r\nContent-Length: 12\r\nHost: h"
+		self.assertEqual(req._header("content-length"), "12")
+		self.assertEqual(req._header("host"), "h")
+
+		# repeated headers resolve to the first one in both paths
+		req = Request(None)
+		req._raw_headers = "Content-Length: 5\r\nContent-Length: 7"
+		self.assertEqual(req._header("content-length"), "5")
+		self.assertEqual(req._header_values("content-length"), ["5", "7"])
+		self.assertEqual(req.HEADERS("content-length"), "5")
+
+		req = Request(None)
+		self.assertEqual(req.HEADERS(), {})
+		self.assertEqual(req.PARAMS(), {})
+		self.assertEqual(req.COOKIES(), {})
+
+	def test_accepted_encoding(self):
+		self.assertEqual(get_accepted_encoding("gzip, deflate"), "gzip")
+		self.assertIsNone(get_accepted_encoding("gzip;q=0"))
+		self.assertIsNone(get_accepted_encoding("gzip;q=abc"))  # malformed q is skipped
+		self.assertEqual(get_accepted_encoding("br;q=abc, gzip;q=0.5"), "gzip")
+		# highest q wins
+		self.assertEqual(get_accepted_encoding("gzip;q=1, br;q=0.1"), "gzip")
+		self.assertEqual(get_accepted_encoding("br;q=0, *"), "gzip")
+		self.assertIsNone(get_accepted_encoding("identity, deflate"))
+		if(brotli):  # preferred on ties
+			self.assertEqual(get_accepted_encoding("gzip, br"), "br")
+			self.assertEqual(get_accepted_encoding("gzip;q=0.5, br;q=0.8"), "br")
+			self.assertEqual(get_accepted_encoding("*;q=0.5"), "br")
+
+	def test_json_encode(self):
+		class Item(Object):
+			id: Int
+			name: Str
+
+		schema(Item)
+		item = Item.from_dict({"id": 1, "name": "a"})
+		self.assertTrue(is_json_body(item))
+		self.assertFalse(is_json_body("text"))
+		self.assertEqual(json.loads(json_encode(item)), {"id": 1, "name": "a"})
+		self.assertEqual(json.loads(json_encode({"items": [item]})), {"items": [{"id": 1, "name": "a"}]})
+		# large lists are encoded in batches, same output
+		items = [{"i": i, "s": "x" * (i % 5)} for i in range(3000)] + [item]
+		self.assertEqual(json.loads(json_encode(items)), items[:-1] + [{"id": 1, "name": "a"}])
+		self.assertEqual(json.loads(json_encode([])), [])
+		# same output whichever backend, int keys and big ints
+		self.assertEqual(json.loads(json_encode({1: "x", "y": [2 ** 70]})), {"1": "x", "y": [2 ** 70]})
+		with self.assertRaises(TypeError):
+			json_encode({"x": object()})
+
+	def test_arg_binder(self):
+		def custom(req):
+			return req.path
+
+		arg_generators = [
+			Request.arg_generator("req", Request, None),
+			Request.arg_generator("a", int, tools._OBJ_END_),
+			Request.arg_generator("b", str, tools._OBJ_END_),
+			custom
+		]
+		kwarg_generators = [("c", Request.arg_generator("c", int, 5))]
+		binder = build_arg_binder(arg_generators, kwarg_generators, name="/test")
+
+		req = Request(None)
+		req.path = "/test"
+		req._query_string = "a=1&b=<x>&c=2"
+		self.assertEqual(binder(req), ((req, 1, "&lt;x&gt;", "/test"), {"c": 2}))
+		# body first, then params, default when missing
+		req = Request(None)
+		req._query_string = "a=1&b=q"
+		req._body = HtmlSanitizedDict({"a": "7"})
+		args, kwargs = binder(req)
+		self.assertEqual((args[1:3], kwargs), ((7, "q"), {"c": 5}))
+		# same as calling the generators one by one
+		self.assertEqual(
+			list(args), [arg_generator(req) for arg_generator in arg_generators]
+		)
+		req = Request(None)
+		req._query_string = "b=q"
+		with self.assertRaises(TypeError):
+			binder(req)
+		# int read without escaping, errors still see the escaped value
+		req = Request(None)
+		req._query_string = "a=1.5<x>&b=q"
+		with self.assertRaises(Exception) as ctx:
+			binder(req)
+		self.assertNotIn("<x>", str(ctx.exception))
+		self.assertEqual(build_arg_binder([], [])(req), ((), {}))
+
+	def test_connection_timers(self):
+		class FakeSocket:
+			def __init__(self):
+				self.sock = self
+				self.is_shutdown = False
+
+			def shutdown(self, how):
+				self.is_shutdown = True
+
+		timers = ConnectionTimers(max_idle_connections=2)
+		a, b, c, d = FakeSocket(), FakeSocket(), FakeSocket(), FakeSocket()
+		timers.set_idle(a, 30)
+		timers.set_idle(b, 30)
+		timers.set_idle(a, 30)  # a is idle again, b is now the oldest
+		timers.set_idle(c, 30)
+		self.assertTrue(b.is_shutdown)
+		self.assertFalse(a.is_shutdown or c.is_shutdown)
+
+		# header deadline replaces idle deadline, not counted as idle
+		timers.set_deadline(a, -1)
+		timers.set_deadline(d, 1000)  # more than one round of the wheel
+		gevent.sleep(1.1)
+		timers.tick()
+		self.assertTrue(a.is_shutdown)
+		self.assertFalse(c.is_shutdown or d.is_shutdown)
+		self.assertEqual(set(timers.deadlines), {c, d})
+
+		timers.remove(c)
+		timers.remove(d)
+		self.assertEqual(timers.deadlines, {})
+		self.assertEqual(timers.idle, {})
+		self.assertEqual(sum(len(x) for x in timers.wheel), 0)
+
+	def test_graceful_drain(self):
+		app = App()
+
+		@app.route("/slow")
+		def slow():
+			gevent.sleep(0.5)
+			return "slow"
+
+		@app.route("/fast")
+		def fast():
+			return "fast"
+
+		app.start(port=8002)
+		gevent.spawn(app.serve)
+		gevent.sleep(0.1)
+
+		def read_until_closed(sock):
+			response = b""
+			while(data := sock.recv(4096)):
+				response += data
+			return response
+
+		idle_client = socket.create_connection(("localhost", 8002))
+		idle_client.sendall(b"GET /fast HTTP/1.1\r\nHost: localhost\r\n\r\n")
+		self.assertTrue(idle_client.recv(4096).endswith(b"fast"))  # now idle keep-alive
+		busy_client = socket.create_connection(("localhost", 8002))
+		busy_client.sendall(b"GET /slow HTTP/1.1\r\nHost: localhost\r\n\r\n")
+		gevent.sleep(0.1)
+
+		start = time.time()
+		stopper = gevent.spawn(app.stop, drain_timeout=5)
+		gevent.sleep(0.1)
+		with self.assertRaises(ConnectionRefusedError):
+			socket.create_connection(("localhost", 8002))
+
+		# in-flight request completes, told to close the connection
+		response = read_until_closed(busy_client)
+		self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+		self.assertIn(b"Connection: close", response)
+		self.assertTrue(response.endswith(b"slow"))
+		self.assertEqual(read_until_closed(idle_client), b"")
+
+		stopper.join()
+		self.assertLess(time.time() - start, 3)
+		self.assertFalse(app.connections)
+
+	def test_response_cache_identity(self):
+		class CacheUser(str):
+			pass
+
+		Request.set_arg_type_hook(CacheUser, lambda req: CacheUser(req._header("authorization", "")))
+
+		def whoami(user: CacheUser):
+			return "user:" + user
+
+		# cache hit skips the arg hook, key has no identity
+		app = App()
+		app.route("/whoami", cache=60 * 1000)(whoami)
+		with self.assertRaises(Exception):
+			app.start(port=8003)
+
+		app = App()
+		app.route("/whoami", cache={"ttl": 60 * 1000, "headers": ["authorization"]})(whoami)
+		app.start(port=8003)
+		gevent.spawn(app.serve)
+		gevent.sleep(0.1)
+
+		def get(auth):
+			client = socket.create_connection(("localhost", 8003))
+			client.sendall(b"GET /whoami HTTP/1.1\r\nHost: localhost\r\nAuthorization: " + auth + b"\r\n\r\n")
+			response = client.recv(4096)
+			client.close()
+			return response
+
+		try:
+			self.assertTrue(get(b"alice").endswith(b"user:alice"))
+			self.assertTrue(get(b"bob").endswith(b"user:bob"))
+			self.assertTrue(get(b"alice").endswith(b"user:alice"))
+		finally:
+			app.stop(drain_timeout=1)
@@ -1,7 +1,14 @@
-from blaster.server import start_server, route, Request, stop_all_apps
+from blaster.server import start_server, route, Request, stop_all_apps, \
+    RequestBodyStream, static_file_handler
+from blaster.utils.metrics import metrics_handler
+from blaster.utils.response_cache import invalidate_response_cache
+from blaster import req_ctx
 import unittest
+import os
+import tempfile
 import requests
 import socket
+import gevent
 from threading import Thread
 
 
@@ -10,11 +17,119 @@ def test(req: Request, param1: str):
     return {"param1": param1}
 
 
+@route("/test_stream", methods=["POST"], stream_body=True, max_body_size=64 * 1024 * 1024)
+def count_stream_bytes(body: RequestBodyStream):
+    num_bytes = 0
+    for data in body:
+        num_bytes += len(data)
+    return {"num_bytes": num_bytes}
+
+
+uploaded_attachments = []
+
+
+@route("/test_upload", methods=["POST"])
+def upload(req: Request, param1: str):
+    attachment = req.ATTACHMENTS("file1")
+    uploaded_attachments.append(attachment)
+    return {
+        "param1": param1,
+        "filename": attachment["attrs"]["filename"],
+        "size": len(attachment["file"].read()),
+        "has_data": "data" in attachment
+    }
+
+
+@route("/test_generator")
+def generate_rows(num_rows: int):
+    for i in range(num_rows):
+        yield "row" + str(i) + "\n"
+
+
+@route("/test_large_json")
+def large_json():
+    return {"items": ["item" + str(i) for i in range(1000)]}
+
+
+@route("/test_large_json_uncompressed", compress_level=0)
+def large_json_uncompressed():
+    return {"items": ["item" + str(i) for i in range(1000)]}
+
+
+@route("/test_route_headers", headers={"X-Route": "route", "X-Frame-Options": "DENY"})
+def route_headers(override: int = 0):
+    if(override):
+        return {"X-Route": "overridden"}, "ok"
+    return "ok"
+
+
+@route("/test_limited", max_concurrency=1, max_queue=1, queue_timeout_ms=200)
+def limited():
+    gevent.sleep(0.5)
+    return "ok"
+
+
+@route("/test_timeout", timeout_ms=200)
+def timeout(sleep_ms: int = 0, swallow: int = 0):
+    remaining_ms = req_ctx.remaining_ms()
+    try:
+        gevent.sleep(sleep_ms / 1000)
+    except Exception:
+        if(not swallow):
+            raise
+        return {"swallowed": True}
+    return {"remaining_ms": remaining_ms}
+
+
+cached_calls = []
+
+
+@route("/test_cached", cache={"ttl": 60 * 1000, "params": ["q"]})
+def cached(q: str = ""):
+    cached_calls.append(q)
+    gevent.sleep(0.2)
+    return {"q": q, "call": len(cached_calls)}
+
+
+coalesced_calls = []
+
+
+@route("/test_coalesced", coalesce=True)
+def coalesced(req: Request, q: str = ""):
+    coalesced_calls.append(q)
+    req.SET_COOKIE("seen", q)
+    gevent.sleep(0.2)
+    return {"q": q, "call": len(coalesced_calls)}
+
+
+coalesced_stream_calls = []
+
+
+@route("/test_coalesced_stream", coalesce=True)
+def coalesced_stream():
+    coalesced_stream_calls.append(1)
+    gevent.sleep(0.2)
+    return {"Content-Type": "text/plain"}, (x for x in ["a", "b", "c"])
+
+
+STATIC_FILES_DIR = tempfile.mkdtemp()
+with open(os.path.join(STATIC_FILES_DIR, "app.js"), "w") as f:
+    f.write("console.log('hello');\n" * 1000)
+
+
 class TestServer(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.server_thread = Thread(target=start_server, args=(8001,))
+        cls.server_thread = Thread(
+            target=start_server, args=(8001,),
+            kwargs={"handlers": [
+                static_file_handler("/static/", STATIC_FILES_DIR),
+                static_file_handler("/static_sendfile/", STATIC_FILES_DIR, memory_budget=0),
+                static_file_handler("/static_dynamic/", STATIC_FILES_DIR, dynamic_files=True),
+                ("/metrics", metrics_handler)
+            ]}
+        )
         cls.server_thread.start()
 
     @classmethod
@@ -95,3 +210,273 @@ class TestServer(unittest.TestCase):
 
         except Exception as e:
             print(f"An error occurred: {e}")
+
+    def test_server_chunked_body(self):
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.connect(('localhost', 8001))
+        client_socket.sendall(
+            b"POST /test HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"Content-Type: application/x-www-form-urlencoded\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+            b"7\r\nparam1=\r\n"
+            b"a\r\nchunkvalue\r\n"
+            b"0\r\n\r\n"
+        )
+        response = b""
+        while b"chunkvalue" not in response:
+            data = client_socket.recv(4096)
+            if not data:
+                break
+            response += data
+        client_socket.close()
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertIn(b'"param1":"chunkvalue"', response)
+        self.CHECK_SERVER_OKAY()
+
+    def test_server_pipelining(self):
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.connect(('localhost', 8001))
+        request = (
+            "POST /test HTTP/1.1\r\n"
+            "Host: example.com\r\n"
+            "Content-Type: application/x-www-form-urlencoded\r\n"
+            "Content-Length: {}\r\n\r\n{}"
+        )
+        bodies = ["param1=value" + str(i) for i in range(10)]
+        client_socket.sendall("".join(request.format(len(body), body) for body in bodies).encode())
+        response = b""
+        while response.count(b"HTTP/1.1 200 OK") < len(bodies) or not response.endswith(b"}"):
+            data = client_socket.recv(4096)
+            if not data:
+                break
+            response += data
+        client_socket.close()
+        # responses in the same order as requests
+        positions = [response.find(('"param1":"value' + str(i) + '"').encode()) for i in range(10)]
+        self.assertNotIn(-1, positions)
+        self.assertEqual(positions, sorted(positions))
+
+    def test_server_connection_close(self):
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.connect(('localhost', 8001))
+        client_socket.sendall(b"POST /test?param1=x HTTP/1.1\r\nHost: example.com\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+        client_socket.settimeout(5)
+        response = b""
+        while data := client_socket.recv(4096):  # server closes the connection
+            response += data
+        client_socket.close()
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertIn(b'"param1":"x"', response)
+
+    def test_server_metrics(self):
+        for i in range(3):
+            requests.post("http://localhost:8001/test", data={"param1": "x" * 100})
+        requests.post("http://localhost:8001/test", data={})  # missing param, 502
+        resp = requests.get("http://localhost:8001/metrics")
+        self.assertTrue(resp.headers["Content-Type"].startswith("text/plain"))
+        lines = {}
+        for line in resp.text.splitlines():
+            if not line.startswith("#"):
+                name, _, val = line.rpartition(" ")
+                lines[name] = float(val)
+        labels = 'route="/test",method="POST"'
+        count = lines["blaster_http_request_duration_seconds_count{" + labels + "}"]
+        self.assertGreaterEqual(count, 4)
+        self.assertEqual(lines["blaster_http_request_duration_seconds_bucket{" + labels + ',le="+Inf"}'], count)
+        self.assertGreaterEqual(lines["blaster_http_responses_total{" + labels + ',status="200"}'], 3)
+        self.assertGreaterEqual(lines["blaster_http_responses_total{" + labels + ',status="502"}'], 1)
+        self.assertGreaterEqual(lines["blaster_http_request_bytes_total{" + labels + "}"], 3 * 100)
+        self.assertGreater(lines["blaster_http_response_bytes_total{" + labels + "}"], 0)
+        self.assertEqual(lines["blaster_http_requests_in_flight{" + labels + "}"], 0)
+        # the metrics request itself is in flight
+        self.assertEqual(lines['blaster_http_requests_in_flight{route="/metrics",method="GET"}'], 1)
+
+    def test_server_admission_control(self):
+        # one admitted, one waits in the queue and times out, one finds the queue full
+        responses = [
+            x.value for x in gevent.joinall([
+                gevent.spawn(requests.get, "http://localhost:8001/test_limited") for i in range(3)
+            ])
+        ]
+        self.assertEqual(sorted(x.status_code for x in responses), [200, 503, 503])
+        for resp in responses:
+            if(resp.status_code == 503):
+                self.assertEqual(resp.headers["Retry-After"], "1")
+        self.assertEqual(requests.get("http://localhost:8001/test_limited").status_code, 200)
+        metrics_text = requests.get("http://localhost:8001/metrics").text
+        self.assertIn('blaster_http_shed_total{route="/test_limited",method="GET",reason="queue_full"} 1', metrics_text)
+        self.assertIn('blaster_http_shed_total{route="/test_limited",method="GET",reason="queue_timeout"} 1', metrics_text)
+
+    def test_server_handler_timeout(self):
+        resp = requests.get("http://localhost:8001/test_timeout")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(0 < resp.json()["remaining_ms"] <= 200)
+        resp = requests.get("http://localhost:8001/test_timeout?sleep_ms=2000")
+        self.assertEqual(resp.status_code, 504)
+        self.assertLess(resp.elapsed.total_seconds(), 1)
+        # except Exception in the handler doesn't swallow the timeout
+        resp = requests.get("http://localhost:8001/test_timeout?sleep_ms=2000&swallow=1")
+        self.assertEqual(resp.status_code, 504)
+
+    def test_server_response_cache(self):
+        # concurrent misses run the handler once
+        responses = [
+            x.value for x in gevent.joinall([
+                gevent.spawn(requests.get, "http://localhost:8001/test_cached?q=a") for i in range(5)
+            ])
+        ]
+        self.assertEqual(cached_calls, ["a"])
+        self.assertEqual({x.json()["call"] for x in responses}, {1})
+        # params not in the key are ignored
+        resp = requests.get("http://localhost:8001/test_cached?q=a&other=1")
+        self.assertEqual(resp.json(), {"q": "a", "call": 1})
+        self.assertEqual(resp.headers["Content-Type"], "application/json")
+        self.assertIn("Date", resp.headers)
+        self.assertEqual(requests.get("http://localhost:8001/test_cached?q=b").json()["call"], 2)
+        # raw keep-alive connection gets the same encoded response
+        sock = socket.create_connection(("localhost", 8001))
+        sock.sendall((
+            "GET /test_cached?q=a HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: "
+            + requests.utils.default_headers()["Accept-Encoding"] + "\r\n\r\n"
+        ).encode() * 2)
+        data = b""
+        while(data.count(b'"call":1') < 2):
+            if(not (_data := sock.recv(4096))):
+                break
+            data += _data
+        sock.close()
+        self.assertEqual(data.count(b'"call":1'), 2)
+        self.assertEqual(data.count(b"HTTP/1.1 200 OK\r\n"), 2)
+        invalidate_response_cache("/test_cached")
+        self.assertEqual(requests.get("http://localhost:8001/test_cached?q=a").json()["call"], 3)
+        self.assertEqual(cached_calls, ["a", "b", "a"])
+
+    def test_server_coalesce(self):
+        responses = [
+            x.value for x in gevent.joinall(
+                [gevent.spawn(requests.get, "http://localhost:8001/test_coalesced?q=a") for i in range(5)]
+                + [gevent.spawn(requests.get, "http://localhost:8001/test_coalesced?q=b")]
+            )
+        ]
+        self.assertEqual(sorted(coalesced_calls), ["a", "b"])
+        self.assertEqual(len({x.json()["call"] for x in responses[:5]}), 1)
+        # cookies set by the handler reach every coalesced request
+        self.assertTrue(all(x.cookies.get("seen") == x.json()["q"] for x in responses))
+        # not cached, runs again once done
+        requests.get("http://localhost:8001/test_coalesced?q=a")
+        self.assertEqual(len(coalesced_calls), 3)
+        metrics_text = requests.get("http://localhost:8001/metrics").text
+        self.assertIn('blaster_http_coalesced_total{route="/test_coalesced",method="GET"} 4', metrics_text)
+
+    def test_server_coalesce_streaming_response(self):
+        # an iterator body is not shared, each request reads its own
+        responses = [
+            x.value for x in gevent.joinall(
+                [gevent.spawn(requests.get, "http://localhost:8001/test_coalesced_stream") for i in range(3)]
+            )
+        ]
+        self.assertEqual([x.text for x in responses], ["abc"] * 3)
+        self.assertEqual(len(coalesced_stream_calls), 3)
+
+    def test_server_stream_body(self):
+        self.assertEqual(
+            requests.post("http://localhost:8001/test_stream", data=b"x" * (5 * 1024 * 1024)).json()["num_bytes"],
+            5 * 1024 * 1024
+        )
+        # chunked, generator body
+        self.assertEqual(
+            requests.post("http://localhost:8001/test_stream", data=(b"y" * 1000 for i in range(100))).json()["num_bytes"],
+            100 * 1000
+        )
+        self.CHECK_SERVER_OKAY()
+
+    def test_server_multipart(self):
+        resp = requests.post(
+            "http://localhost:8001/test_upload",
+            data={"param1": "value1"},
+            files={"file1": ("a.bin", b"z" * (1024 * 1024 + 1))}
+        ).json()
+        self.assertEqual(resp, {"param1": "value1", "filename": "a.bin", "size": 1024 * 1024 + 1, "has_data": True})
+        # spooled files are closed once the response is sent
+        self.assertTrue(uploaded_attachments[-1]["file"].closed)
+        self.CHECK_SERVER_OKAY()
+
+    def test_server_generator_response(self):
+        resp = requests.get("http://localhost:8001/test_generator?num_rows=1000")
+        self.assertEqual(resp.headers["Transfer-Encoding"], "chunked")
+        self.assertEqual(resp.text, "".join("row" + str(i) + "\n" for i in range(1000)))
+        self.CHECK_SERVER_OKAY()
+
+    def test_server_compression(self):
+        resp = requests.get("http://localhost:8001/test_large_json", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(len(resp.json()["items"]), 1000)
+
+        resp = requests.get("http://localhost:8001/test_large_json", headers={"Accept-Encoding": "identity"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(len(resp.json()["items"]), 1000)
+
+        resp = requests.get("http://localhost:8001/test_large_json_uncompressed", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+        # precompressed static files
+        resp = requests.get("http://localhost:8001/static/app.js", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.text, "console.log('hello');\n" * 1000)
+        resp = requests.get("http://localhost:8001/static/app.js", headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.text, "console.log('hello');\n" * 1000)
+
+    def test_server_static_files(self):
+        content = "console.log('hello');\n" * 1000
+        for url_path in ("/static/", "/static_sendfile/"):
+            url = "http://localhost:8001" + url_path + "app.js"
+            resp = requests.get(url, headers={"Accept-Encoding": "identity"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.text, content)
+            etag = resp.headers["ETag"]
+
+            # conditional requests
+            resp = requests.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            resp = requests.get(url, headers={"If-Modified-Since": resp.headers["Last-Modified"]})
+            self.assertEqual(resp.status_code, 304)
+
+            # ranges
+            resp = requests.get(url, headers={"Range": "bytes=0-6"})
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(resp.text, "console")
+            self.assertEqual(resp.headers["Content-Range"], "bytes 0-6/" + str(len(content)))
+            resp = requests.get(url, headers={"Range": "bytes=-3"})
+            self.assertEqual(resp.text, "');\n"[1:])
+            resp = requests.get(url, headers={"Range": "bytes=100000-"})
+            self.assertEqual(resp.status_code, 416)
+
+        # dates compare as GMT whichever way the zone is written
+        url = "http://localhost:8001/static/app.js"
+        last_modified = requests.get(url).headers["Last-Modified"]
+        resp = requests.get(url, headers={"If-Modified-Since": last_modified.replace("GMT", "-0000")})
+        self.assertEqual(resp.status_code, 304)
+        resp = requests.get(url, headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})
+        self.assertEqual(resp.status_code, 200)
+
+        # added after start, only regular files are served
+        os.makedirs(os.path.join(STATIC_FILES_DIR, "subdir"), exist_ok=True)
+        with open(os.path.join(STATIC_FILES_DIR, "data.unknownext"), "wb") as f:
+            f.write(b"\x00\x01")
+        self.assertEqual(requests.get("http://localhost:8001/static_dynamic/subdir").status_code, 404)
+        resp = requests.get("http://localhost:8001/static_dynamic/data.unknownext")
+        self.assertEqual(resp.content, b"\x00\x01")
+        self.assertEqual(resp.headers["Content-Type"], "application/octet-stream")
+        self.CHECK_SERVER_OKAY()
+
+    def test_server_route_headers(self):
+        resp = requests.get("http://localhost:8001/test_route_headers")
+        self.assertEqual(resp.headers["X-Route"], "route")
+        self.assertEqual(resp.headers["X-Frame-Options"], "DENY")
+        self.assertEqual(resp.headers["X-Content-Type-Options"], "nosniff")
+        self.assertIn("GMT", resp.headers["Date"])
+        resp = requests.get("http://localhost:8001/test_route_headers?override=1")
+        self.assertEqual(resp.headers["X-Route"], "overridden")
+        self.assertEqual(resp.headers["X-Frame-Options"], "DENY")
@@ -79,6 +79,34 @@ class TestSanitization(unittest.TestCase):
 		# test serialization deserialization
 		self.assertTrue(isinstance(sl, list))
 
+	def test_sanitization_memoized(self):
+		sd = HtmlSanitizedDict(a="<a>", plain="text")
+		self.assertIs(sd["plain"], sd["plain"])  # nothing to escape, same object
+		self.assertIs(sd["a"], sd["a"])  # memoized
+		sd["a"] = "<x>"  # replaced, escaped again
+		self.assertEqual(sd["a"], "&lt;x&gt;")
+		sd.update(a="<y>")
+		self.assertEqual(sd.get("a"), "&lt;y&gt;")
+		self.assertEqual(sd.get("a", escape_html=False), "<y>")
+		sl = HtmlSanitizedList(["<a>", "b"])
+		self.assertEqual(sl[0], "&lt;a&gt;")
+		sl[0] = "<c>"
+		self.assertEqual(list(sl), ["&lt;c&gt;", "b"])
+
+	def test_sanitization_raw(self):
+		sd = HtmlSanitizedDict(a="<a>", d={"e": "<e>"}, l=["<l>"])
+		self.assertEqual(sd.get("a", escape_html=False), "<a>")
+		self.assertEqual(sd.get("missing", escape_html=False), None)
+		# nested containers stay sanitized, their values read raw the same way
+		self.assertEqual(sd.get("d", escape_html=False).get("e", escape_html=False), "<e>")
+		self.assertEqual(sd.get("d", escape_html=False)["e"], "&lt;e&gt;")
+		sl = sd.get("l", escape_html=False)
+		self.assertEqual((sl.at(0, escape_html=False), sl.get(0, escape_html=False)), ("<l>", "<l>"))
+		self.assertEqual(sl.get(5, escape_html=False), None)
+		self.assertEqual(sl[0], "&lt;l&gt;")
+		self.assertEqual(sd.raw()["a"], "<a>")
+		self.assertEqual(sl.raw(), ["<l>"])
+
 
 class TestAuth(unittest.TestCase):
 	def test(self):
@@ -419,6 +447,39 @@ class TestTools(unittest.TestCase):
 		# when last item is added, it expired first 4 items
 		self.assertEqual(len(c.to_son()), 5)
 
+	def test_coalesce(self):
+		from blaster.tools import coalesce
+		calls = []
+
+		@coalesce
+		def fetch(key, fail=False):
+			calls.append(key)
+			gevent.sleep(0.1)
+			if(fail):
+				raise ValueError(key)
+			return {"key": key}
+
+		results = [x.value for x in gevent.joinall([gevent.spawn(fetch, "a") for i in range(5)])]
+		self.assertEqual(calls, ["a"])
+		self.assertTrue(all(x is results[0] for x in results))
+		self.assertEqual(fetch.singleflight.hit_ratio(), 0.8)
+		# not in flight anymore
+		self.assertEqual(fetch("a"), {"key": "a"})
+		self.assertEqual(calls, ["a", "a"])
+		# waiters get the exception
+		greenlets = gevent.joinall([gevent.spawn(fetch, "b", fail=True) for i in range(3)])
+		self.assertTrue(all(isinstance(x.exception, ValueError) for x in greenlets))
+		self.assertEqual(calls, ["a", "a", "b"])
+		self.assertEqual(fetch.singleflight.in_flight, {})
+
+		# leader killed, waiter runs it
+		killed = gevent.spawn(fetch, "c")
+		waiter = gevent.spawn(fetch, "c")
+		gevent.sleep(0.01)
+		killed.kill()
+		self.assertEqual(waiter.get(), {"key": "c"})
+		self.assertEqual(calls, ["a", "a", "b", "c", "c"])
+
 	def test_get_by_key_path(self):
 		self.assertEqual(
 			get_by_key_path({"a": {"b": 1}}, "a.b"), 1
@@ -539,6 +600,95 @@ class TestTools(unittest.TestCase):
 		)
 
 
+class TestBufferedSocket(unittest.TestCase):
+	def test_readuntil_and_recvn(self):
+		import socket
+		from blaster.tools import BufferedSocket
+		a, b = socket.socketpair()
+		buffered_socket = BufferedSocket(a, read_buffer_size=16)
+
+		b.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n\r\nbody")
+		self.assertEqual(buffered_socket.readuntil("\r\n", 4096, True), b"GET / HTTP/1.1")
+		self.assertEqual(buffered_socket.peek(2), b"Ho")
+		self.assertEqual(buffered_socket.readuntil(b"\r\n\r\n", 4096, False), b"Host: x\r\n\r\n")
+		self.assertEqual(buffered_socket.recvn(4), b"body")
+
+		# delimiter split across recvs
+		b.sendall(b"abc\r")
+		gevent.spawn_later(0.05, b.sendall, b"\ndef")
+		self.assertEqual(buffered_socket.readuntil("\r\n", 8, True), b"abc")
+		self.assertEqual(buffered_socket.recvn(3), b"def")
+
+		# larger than the initial buffer
+		b.sendall(b"x" * 100 + b"\r\n")
+		self.assertEqual(len(buffered_socket.readuntil("\r\n", 4096, True)), 100)
+
+		# limits
+		b.sendall(b"0123456789\r\n")
+		self.assertIsNone(buffered_socket.readuntil("\r\n", 11, True))
+		self.assertTrue(buffered_socket.is_eof)
+
+		b.close()
+		buffered_socket.close()
+
+	def test_sendfile_ssl_shared_file(self):
+		import tempfile
+		from blaster.tools import BufferedSocket
+
+		class SSLSocket:  # only what the ssl path of sendfile uses
+			def __init__(self):
+				self.sent = b""
+
+			def do_handshake(self):
+				pass
+
+			def sendall(self, data):
+				self.sent += data
+
+		with tempfile.TemporaryFile() as f:
+			f.write(bytes(range(256)) * 400)
+			f.flush()
+			buffered_socket = BufferedSocket(sock := SSLSocket())
+			# same file object, explicit offsets, position doesn't matter
+			self.assertEqual(buffered_socket.sendfile(f, 0, 102400), 102400)
+			self.assertEqual(buffered_socket.sendfile(f, 0, 102400), 102400)
+			self.assertEqual(buffered_socket.sendfile(f, 10, 5), 5)
+			self.assertEqual(sock.sent, (bytes(range(256)) * 400) * 2 + bytes(range(10, 15)))
+			# shorter than asked, caller closes the connection
+			self.assertEqual(buffered_socket.sendfile(f, 102398, 10), 2)
+
+
+class TestMultipart(unittest.TestCase):
+	def test_multipart_parser(self):
+		from blaster.tools.multipart import MultipartParser, get_boundary
+		self.assertEqual(get_boundary('multipart/form-data; boundary="abc"'), b"abc")
+		body = (
+			b"preamble\r\n--xyz\r\n"
+			b'Content-Disposition: form-data; name="field1"\r\n\r\n'
+			b"value1\r\n--xyz\r\n"
+			b'Content-Disposition: form-data; name="file1"; filename="a.txt"\r\n'
+			b"Content-Type: text/plain\r\n\r\n"
+			+ b"\r\n--xy" * 1000 + b"\r\n--xyz--\r\n"
+		)
+		for chunk_size in (1, 7, 4096, len(body)):
+			parser = MultipartParser("xyz", spool_max_memory_size=1024)
+			for i in range(0, len(body), chunk_size):
+				parser.feed(body[i: i + chunk_size])
+			field, _file = parser.close()
+			self.assertEqual(field.name, "field1")
+			self.assertTrue(field.is_field())
+			self.assertEqual(field.file.read(), b"value1")
+			self.assertEqual(_file.name, "file1")
+			self.assertEqual(_file.attrs, {"filename": "a.txt"})
+			self.assertEqual(_file.headers[b"content-type"], b"text/plain")
+			self.assertEqual(_file.file.read(), b"\r\n--xy" * 1000)
+			self.assertTrue(_file.file._rolled)  # moved to disk
+
+		parser = MultipartParser("xyz")
+		parser.feed(body[:-10])
+		self.assertRaises(Exception, parser.close)
+
+
 class TestBackgroundTasks(unittest.TestCase):
 	def test_background_threads_and_order(self):
 		NUM_BUCKETS = 1000
@@ -0,0 +1,386 @@
+import os
+import struct
+import zlib
+import unittest
+import gevent
+from blaster.websocket.server import WebSocketServerHandler, unmask_payload, \
+	broadcast, PerMessageDeflate, TEXT, BINARY, STREAM, CLOSE, PING, PONG, SLOW_CONSUMER_CLOSE
+from blaster.tools import WebsocketConnection, WS_QUEUE_COALESCE, WS_QUEUE_DROP_OLDEST
+from blaster.utils import fork
+from blaster.utils.ws_registry import ConnectionRegistry, WS_REGISTRY_CHANNEL
+
+
+class FakeSocket:
+	def __init__(self):
+		self.sent = bytearray()
+		self.num_sends = 0
+
+	def send(self, data):
+		self.sent += data
+		self.num_sends += 1
+		return len(data)
+
+	def sendall(self, data):
+		self.sent += data
+
+	def close(self):
+		pass
+
+
+class Handler(WebSocketServerHandler):
+	def __init__(self, deflate=None):
+		super().__init__(FakeSocket(), deflate=deflate)
+		self.messages = []
+
+	def on_message(self):
+		self.messages.append(self.data)
+
+
+def frame(opcode, payload, fin=True, mask=b'\x01\x02\x03\x04', rsv1=False):
+	if(isinstance(payload, str)):
+		payload = payload.encode()
+	header = bytearray([(0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode])
+	mask_bit = 0x80 if mask else 0
+	if(len(payload) <= 125):
+		header.append(mask_bit | len(payload))
+	elif(len(payload) <= 65535):
+		header.append(mask_bit | 126)
+		header += struct.pack("!H", len(payload))
+	else:
+		header.append(mask_bit | 127)
+		header += struct.pack("!Q", len(payload))
+	if(mask):
+		header += mask
+		payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+	return bytes(header) + payload
+
+
+class TestWebSocketServerParser(unittest.TestCase):
+	def test_unmask(self):
+		data = os.urandom(10001)
+		mask = b'\x0a\xf0\x33\x7c'
+		self.assertEqual(
+			unmask_payload(bytearray(data), mask),
+			bytearray(b ^ mask[i % 4] for i, b in enumerate(data))
+		)
+		self.assertEqual(unmask_payload(bytearray(), mask), bytearray())
+
+	def test_frames(self):
+		handler = Handler()
+		# byte by byte, header and payload split across reads
+		for b in frame(TEXT, "hello"):
+			handler._parse_data(bytes([b]))
+		self.assertEqual(handler.messages, ["hello"])
+
+		# many frames in one read, all header lengths, masked and not
+		large = os.urandom(70000)
+		handler._parse_data(
+			frame(BINARY, b"x" * 200) + frame(TEXT, "", mask=None) + frame(BINARY, large)
+			+ frame(TEXT, "€", mask=None)
+		)
+		self.assertEqual(handler.messages[1:], [bytearray(b"x" * 200), "", bytearray(large), "€"])
+
+		# fragmented text, utf-8 split between fragments
+		data = "a€b".encode()
+		handler._parse_data(frame(TEXT, data[:2], fin=False) + frame(STREAM, data[2:4], fin=False))
+		handler._parse_data(frame(STREAM, data[4:]))
+		self.assertEqual(handler.messages[-1], "a€b")
+		with self.assertRaises(Exception):
+			handler._parse_data(frame(STREAM, "x"))  # no fragment started
+
+	def test_control_frames(self):
+		handler = Handler()
+		handler._parse_data(frame(PING, "p"))
+		self.assertEqual(bytes(handler.client.sent), frame(PONG, "p", mask=None))
+
+		handler.client.sent = bytearray()
+		handler._parse_data(frame(CLOSE, struct.pack("!H", 1001) + b"bye"))
+		self.assertEqual(bytes(handler.client.sent), frame(CLOSE, struct.pack("!H", 1001) + b"bye", mask=None))
+		self.assertTrue(handler.closed)
+
+		handler = Handler()
+		handler._parse_data(frame(CLOSE, struct.pack("!H", 1005)))
+		self.assertEqual(bytes(handler.client.sent), frame(CLOSE, struct.pack("!H", 1002), mask=None))
+
+		with self.assertRaises(Exception):
+			Handler()._parse_data(frame(PING, "p" * 126))
+
+	def test_limits(self):
+		handler = Handler()
+		handler.maxpayload = 1024
+		handler._parse_data(frame(BINARY, b"x" * 1023))
+		with self.assertRaises(Exception):
+			handler._parse_data(frame(BINARY, b"x" * 1024)[:8])  # header is enough to reject
+		with self.assertRaises(Exception):
+			Handler()._parse_data(bytes([0x80 | 0x40 | TEXT, 0]))  # rsv bit
+		with self.assertRaises(Exception):
+			Handler()._parse_data(frame(0x3, "x"))  # reserved opcode
+
+	def test_broadcast(self):
+		handlers = [Handler() for i in range(3)]
+		slow = handlers[2]
+		slow.max_send_queue = 1
+		slow.send_lock.acquire()  # a write in progress that doesn't finish
+		self.assertEqual(broadcast(handlers, "hello"), 3)
+		self.assertEqual(broadcast(handlers, b"bin", is_text=False), 2)
+		gevent.sleep(0)
+		for handler in handlers[:2]:
+			self.assertEqual(bytes(handler.client.sent), frame(TEXT, "hello", mask=None) + frame(BINARY, b"bin", mask=None))
+		self.assertEqual(len(slow.send_queue), 1)
+
+		self.assertEqual(broadcast(handlers, "x", slow_consumer=SLOW_CONSUMER_CLOSE), 2)
+		self.assertTrue(slow.closed)
+		slow.send_lock.release()
+		slow._flush_send_queue()
+		self.assertEqual(
+			bytes(slow.client.sent),
+			frame(TEXT, "hello", mask=None) + frame(CLOSE, struct.pack("!H", 1008) + b"slow consumer", mask=None)
+		)
+
+	def test_deflate_negotiation(self):
+		negotiate = PerMessageDeflate.negotiate
+		self.assertEqual(negotiate(True, None), (None, None))
+		self.assertEqual(negotiate(True, "x-webkit-deflate-frame")[1], None)
+		deflate, response = negotiate(True, "permessage-deflate; client_max_window_bits")
+		self.assertEqual(response, "permessage-deflate")
+		self.assertEqual((deflate.window_bits, deflate.no_context_takeover), (15, False))
+
+		deflate, response = negotiate(
+			{"window_bits": 12, "no_context_takeover": True, "min_size": 10},
+			"permessage-deflate; server_max_window_bits=8, permessage-deflate; server_max_window_bits=10"
+		)
+		self.assertEqual(response, "permessage-deflate; server_no_context_takeover; server_max_window_bits=10")
+		self.assertEqual((deflate.window_bits, deflate.no_context_takeover, deflate.min_size), (10, True, 10))
+		# unknown and duplicate parameters decline the offer
+		self.assertEqual(negotiate(True, "permessage-deflate; foo")[1], None)
+		self.assertEqual(negotiate(True, "permessage-deflate; server_no_context_takeover; server_no_context_takeover")[1], None)
+
+	def test_deflate_messages(self):
+		handler = Handler(deflate={"min_size": 10})
+		handler.do_handshake({
+			"Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ==",
+			"Sec-WebSocket-Extensions": "permessage-deflate"
+		})
+		self.assertIn(b"Sec-WebSocket-Extensions: permessage-deflate\r\n\r\n", bytes(handler.client.sent))
+
+		# receive, whole and fragmented compressed messages, and an uncompressed one
+		text = "hello " * 100
+		compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+		compressed = compressor.compress(text.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+		handler._parse_data(frame(TEXT, compressed[:-4], rsv1=True))
+		compressed = compressor.compress(text.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+		handler._parse_data(
+			frame(TEXT, compressed[:5], fin=False, rsv1=True) + frame(PING, "p")
+			+ frame(STREAM, compressed[5:-4])
+		)
+		handler._parse_data(frame(BINARY, b"raw"))
+		self.assertEqual(handler.messages, [text, text, bytearray(b"raw")])
+		with self.assertRaises(Exception):
+			handler._parse_data(frame(PING, "p", rsv1=True))
+		with self.assertRaises(Exception):
+			Handler()._parse_data(frame(TEXT, compressed[:-4], rsv1=True))  # not negotiated
+
+		# send, small messages go uncompressed
+		decompressor = zlib.decompressobj(-15)
+		handler.client.sent = bytearray()
+		handler.send("small")
+		handler.send(text)
+		sent = bytes(handler.client.sent)
+		self.assertEqual(sent[:7], frame(TEXT, "small", mask=None))
+		self.assertEqual(sent[7] & 0x40, 0x40)
+		self.assertEqual(decompressor.decompress(sent[9:] + b"\x00\x00\xff\xff"), text.encode())
+
+	def test_broadcast_deflate(self):
+		text = "hello " * 100
+		shared = [Handler() for i in range(2)]
+		for handler in shared:
+			handler.deflate = PerMessageDeflate(no_context_takeover=True)
+		takeover = Handler()
+		takeover.deflate = PerMessageDeflate()
+		plain = Handler()
+		self.assertEqual(broadcast(shared + [takeover, plain], text), 4)
+		self.assertEqual(broadcast([takeover], text), 1)
+		gevent.sleep(0)
+		self.assertEqual(shared[0].client.sent, shared[1].client.sent)
+		self.assertEqual(bytes(plain.client.sent), frame(TEXT, text, mask=None))
+		decompressor = zlib.decompressobj(-15)
+		self.assertEqual(decompressor.decompress(bytes(shared[0].client.sent[2:]) + b"\x00\x00\xff\xff"), text.encode())
+		# second message with context takeover refers back to the first
+		sent = bytes(takeover.client.sent)
+		first_len = sent[1]
+		decompressor = zlib.decompressobj(-15)
+		self.assertEqual(decompressor.decompress(sent[2: 2 + first_len] + b"\x00\x00\xff\xff"), text.encode())
+		self.assertEqual(decompressor.decompress(sent[4 + first_len:] + b"\x00\x00\xff\xff"), text.encode())
+
+
+class TestWebsocketConnection(unittest.TestCase):
+	def test_batched_writes(self):
+		conn = WebsocketConnection(Handler(), "user")
+		conn.send("a")
+		self.assertEqual(conn.ws.client.num_sends, 1)
+		conn.lock.acquire()  # a write in progress
+		conn.send("b")
+		conn.send("c")
+		conn.lock.release()
+		conn.send("d")
+		# everything queued goes in one write
+		self.assertEqual(conn.ws.client.num_sends, 2)
+		self.assertEqual(
+			bytes(conn.ws.client.sent),
+			b"".join(frame(TEXT, x, mask=None) for x in "abcd")
+		)
+		self.assertEqual([x[2] for x in conn.msg_assumed_sent], list("abcd"))
+
+		# broadcast frames go through the same queue
+		self.assertEqual(broadcast([conn], "e"), 1)
+		gevent.sleep(0)
+		self.assertTrue(bytes(conn.ws.client.sent).endswith(frame(TEXT, "e", mask=None)))
+		self.assertEqual(len(conn.msg_assumed_sent), 4)
+
+	def test_queue_policies(self):
+		conn = WebsocketConnection(Handler(), "user", high_water=2, queue_policy=WS_QUEUE_DROP_OLDEST)
+		conn.lock.acquire()
+		for x in "abc":
+			conn.send(x, ref=x)
+		self.assertEqual([x[1] for x in conn.queue], ["b", "c"])  # oldest dropped
+		self.assertEqual(conn.dropped, 1)
+		self.assertFalse(conn.queue_frame(b"x"))  # slow for broadcasts
+
+		conn = WebsocketConnection(Handler(), "user", high_water=2, queue_policy=WS_QUEUE_COALESCE)
+		conn.lock.acquire()
+		conn.send("a1", ref="a")
+		conn.send("b1", ref="b")
+		conn.send("a2", ref="a")
+		self.assertEqual([x[1] for x in conn.queue], ["a2", "b1"])
+		conn.send("c1", ref="c")
+		self.assertEqual([x[1] for x in conn.queue], ["b1", "c1"])
+		conn.send("a3", ref="a")
+		conn.lock.release()
+		conn.send("b2", ref="b")
+		self.assertEqual(
+			bytes(conn.ws.client.sent),
+			b"".join(frame(TEXT, x, mask=None) for x in ["a3", "b2"])  # b1, c1 dropped at high water
+		)
+
+		# default, disconnects
+		conn = WebsocketConnection(Handler(), "user", high_water=1)
+		conn.lock.acquire()
+		conn.send("a")
+		with self.assertRaises(Exception):
+			conn.send("b")
+		self.assertTrue(conn.is_stale)
+		self.assertTrue(conn.ws.closed)
+
+	def test_deflate_order_with_broadcast(self):
+		handler = Handler()
+		handler.deflate = PerMessageDeflate(min_size=10)  # context takeover
+		conn = WebsocketConnection(handler, "user")
+		# similar messages, compressed ones refer back to the earlier ones
+		messages = ["hello world " * (2 + 3 * i) + "message {}".format(i) * (i + 1) for i in range(5)]
+		conn.send(messages[0])
+		conn.lock.acquire()  # a write in progress
+		conn.send(messages[1])
+		self.assertEqual(broadcast([conn], messages[2]), 1)
+		conn.send(messages[3])
+		conn.lock.release()
+		conn.send(messages[4])
+
+		# client inflates them in the order they arrive with one context
+		decompressor = zlib.decompressobj(-15)
+		received = []
+		sent = bytes(handler.client.sent)
+		pos = 0
+		while(pos < len(sent)):
+			self.assertEqual(sent[pos], 0x80 | 0x40 | TEXT)
+			length = sent[pos + 1]
+			received.append(
+				decompressor.decompress(sent[pos + 2: pos + 2 + length] + b"\x00\x00\xff\xff").decode()
+			)
+			pos += 2 + length
+		self.assertEqual(received, messages)
+
+	def test_assumed_sent_bound(self):
+		# counted as encoded frames, 2 bytes header + 4
+		conn = WebsocketConnection(Handler(), "user", max_assumed_sent_bytes=12)
+		for i in range(5):
+			conn.send("abcd")
+		self.assertEqual(len(conn.msg_assumed_sent), 2)
+		self.assertEqual(conn.msg_assumed_sent_bytes, 12)
+		conn.send("€" * 10)  # 30 bytes as utf-8
+		self.assertEqual(len(conn.msg_assumed_sent), 0)
+		self.assertEqual(conn.msg_assumed_sent_bytes, 0)
+
+
+class TestConnectionRegistry(unittest.TestCase):
+	def test_local_delivery(self):
+		registry = ConnectionRegistry()
+		alice = WebsocketConnection(Handler(), 1)
+		alice_phone = Handler()
+		bob = WebsocketConnection(Handler(), "bob")
+		registry.add(alice, rooms=["general"])
+		registry.add(alice_phone, user_id=1)
+		registry.add(bob, rooms=["general", "random"])
+
+		self.assertEqual(registry.send_to_user(1, "hi alice"), 2)
+		self.assertEqual(registry.publish("general", "hi all"), 2)
+		registry.leave(bob, "general")
+		self.assertEqual(registry.publish("general", "bye bob"), 1)
+		self.assertEqual(registry.publish("nobody", "x"), 0)
+		gevent.sleep(0)
+		self.assertEqual(
+			bytes(alice.ws.client.sent),
+			b"".join(frame(TEXT, x, mask=None) for x in ["hi alice", "hi all", "bye bob"])
+		)
+		self.assertEqual(bytes(alice_phone.client.sent), frame(TEXT, "hi alice", mask=None))
+		self.assertEqual(bytes(bob.ws.client.sent), frame(TEXT, "hi all", mask=None))
+
+		registry.remove(alice)
+		registry.remove(alice_phone)
+		registry.remove(bob)
+		self.assertEqual((registry.users, registry.rooms, registry.conn_rooms), ({}, {}, {}))
+
+	def test_removed_on_close(self):
+		registry = ConnectionRegistry()
+		alice = WebsocketConnection(Handler(), "alice")
+		bob = Handler()
+		registry.add(alice, rooms=["general"])
+		registry.add(bob, user_id="bob", rooms=["general", "random"])
+		alice.close()
+		self.assertEqual(registry.publish("general", "hi"), 1)
+		self.assertNotIn(alice, registry.conn_user)
+		self.assertEqual(registry.rooms, {"general": {bob}, "random": {bob}})
+		# peer going away, reader loop exits
+		bob.client.recv = lambda n: b""
+		bob.start_handling()
+		self.assertEqual(
+			(registry.users, registry.rooms, registry.conn_user, registry.conn_rooms),
+			({}, {}, {}, {})
+		)
+
+	def test_cross_worker_batches(self):
+		sent = []
+		fork.send_raw_multiproc = lambda channel, data: sent.append((channel, data))
+		try:
+			worker1 = ConnectionRegistry()
+			worker2 = ConnectionRegistry()
+			conn = Handler()
+			worker2.add(conn, user_id="u1", rooms=["r"])
+			# nobody local, still sent to other workers, in one frame per tick
+			self.assertEqual(worker1.send_to_user("u1", "a"), 0)
+			self.assertEqual(worker1.publish("r", b"\x00\x01", is_text=False), 0)
+			self.assertEqual(worker1.publish("r", "€"), 0)
+			gevent.sleep(0)
+			self.assertEqual(len(sent), 1)
+			self.assertEqual(sent[0][0], WS_REGISTRY_CHANNEL)
+			worker2.on_batch(memoryview(sent[0][1]))
+			gevent.sleep(0)
+			self.assertEqual(
+				bytes(conn.client.sent),
+				frame(TEXT, "a", mask=None) + frame(BINARY, b"\x00\x01", mask=None) + frame(TEXT, "€", mask=None)
+			)
+		finally:
+			fork.send_raw_multiproc = None
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,161 @@
+import timeit
+
+# micro benchmarks for the server hot paths
+# python tests/timeit_server.py
+
+routing_setup = '''
+import re
+from blaster.server import PathTree
+
+NUM_ROUTES = {num_routes}
+path_tree = PathTree()
+request_handlers = []
+for i in range(NUM_ROUTES):
+	route = "/api/v1/resource" + str(i) + "/{{item_id}}/details"
+	path_tree.add(route)["GET"] = route
+	regex = "^" + re.sub(r'\\{{([a-zA-Z_][a-zA-Z0-9_]*)\\}}', '(?P<\\\\g<1>>[^/]*)', route) + "$"
+	request_handlers.append((re.compile(regex), {{"GET": route}}))
+
+def linear_regex_scan(path):
+	for regex, method_handlers in request_handlers:
+		if((match := regex.match(path)) is not None):
+			if(handler := method_handlers.get("GET")):
+				return handler, match.groupdict()
+
+def path_tree_find(path):
+	path_params = {{}}
+	return path_tree.find(path, "GET", path_params), path_params
+
+last_route_path = "/api/v1/resource" + str(NUM_ROUTES - 1) + "/abcd/details"
+not_found_path = "/api/v1/not_found/abcd/details"
+'''
+
+for num_routes in (10, 100, 400):
+	setup = routing_setup.format(num_routes=num_routes)
+	print("routes:", num_routes)
+	print("  linear regex scan (last route):", min(timeit.repeat(stmt="linear_regex_scan(last_route_path)", setup=setup, repeat=5, number=10000)))
+	print("  path tree (last route):        ", min(timeit.repeat(stmt="path_tree_find(last_route_path)", setup=setup, repeat=5, number=10000)))
+	print("  linear regex scan (404):       ", min(timeit.repeat(stmt="linear_regex_scan(not_found_path)", setup=setup, repeat=5, number=10000)))
+	print("  path tree (404):               ", min(timeit.repeat(stmt="path_tree_find(not_found_path)", setup=setup, repeat=5, number=10000)))
+
+
+# what the server needs on every request: eager parse of all headers vs lazy lookups
+headers_setup = '''
+from blaster.server import Request, HeadersDict, parse_http_headers
+raw_headers = "\\r\\n".join([
+	"Host: localhost:8080", "User-Agent: Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/118.0",
+	"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+	"Accept-Language: en-US,en;q=0.5", "Accept-Encoding: gzip, deflate, br",
+	"Connection: keep-alive", "Cookie: session=abcdef0123456789; theme=dark",
+	"Upgrade-Insecure-Requests: 1", "Sec-Fetch-Dest: document", "Sec-Fetch-Mode: navigate",
+	"Cache-Control: max-age=0"
+])
+
+def eager():
+	headers = parse_http_headers(raw_headers, HeadersDict())
+	return headers.get("content-length"), headers.get("transfer-encoding"), headers.get("connection")
+
+def lazy():
+	req = Request(None)
+	req._raw_headers = raw_headers
+	return req._header("content-length"), req._header("transfer-encoding"), req._header("connection")
+'''
+print("request headers (content-length, transfer-encoding, connection)")
+print("  eager parse:", min(timeit.repeat(stmt="eager()", setup=headers_setup, repeat=5, number=10000)))
+print("  lazy lookup:", min(timeit.repeat(stmt="lazy()", setup=headers_setup, repeat=5, number=10000)))
+
+
+# per-arg generator closures vs one generated binder per handler
+binder_setup = '''
+from blaster.server import Request, build_arg_binder
+from blaster.tools import _OBJ_END_
+types = [int, str, float, bool, str] * 2
+arg_generators = [Request.arg_generator("p" + str(i), types[i], _OBJ_END_) for i in range({num_params})]
+binder = build_arg_binder(arg_generators, [])
+req = Request(None)
+req._query_string = "&".join("p" + str(i) + "=" + ("1" if types[i] is not str else "x") for i in range({num_params}))
+req._params
+
+def generators():
+	return [arg_generator(req) for arg_generator in arg_generators], {{}}
+'''
+for num_params in (5, 10):
+	setup = binder_setup.format(num_params=num_params)
+	print("handler with", num_params, "typed params")
+	print("  arg generators:", min(timeit.repeat(stmt="generators()", setup=setup, repeat=5, number=10000)))
+	print("  arg binder:    ", min(timeit.repeat(stmt="binder(req)", setup=setup, repeat=5, number=10000)))
+
+
+# json response body: str then encode vs json_encode(orjson when installed, batched lists)
+json_setup = '''
+import ujson
+from blaster.server import json_encode
+body = [{"id": i, "name": "item" + str(i), "tags": ["a", "b"], "score": i * 1.5} for i in range(10000)]
+'''
+print("json body, 10000 items")
+print("  dumps().encode():", min(timeit.repeat(stmt="ujson.dumps(body).encode()", setup=json_setup, repeat=5, number=20)))
+print("  json_encode():   ", min(timeit.repeat(stmt="json_encode(body)", setup=json_setup, repeat=5, number=20)))
+
+
+# websocket: parsing a 1MB masked binary message received in 8KB reads
+ws_setup = '''
+import os, struct
+from blaster.websocket.server import WebSocketServerHandler
+payload = os.urandom(1024 * 1024)
+mask = b"\\x01\\x02\\x03\\x04"
+masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+data = bytes([0x82, 0x80 | 127]) + struct.pack("!Q", len(payload)) + mask + masked
+reads = [data[i: i + 8192] for i in range(0, len(data), 8192)]
+handler = WebSocketServerHandler(None)
+def parse():
+	for read in reads:
+		handler._parse_data(read)
+'''
+print("websocket 1MB masked message:", min(timeit.repeat(stmt="parse()", setup=ws_setup, repeat=3, number=10)) / 10)
+
+
+# pipelined vs one request per round trip on a keep-alive connection
+import blaster  # noqa: E402
+import socket  # noqa: E402
+import gevent  # noqa: E402
+from blaster.server import App  # noqa: E402
+
+app = App()
+
+
+@app.route("/hello")
+def hello():
+	return "hello"
+
+
+app.start(port=8099)
+gevent.spawn(app.serve)
+gevent.sleep(0.1)
+
+NUM_REQUESTS = 100
+request = b"GET /hello HTTP/1.1\r\nHost: localhost\r\n\r\n"
+client_socket = socket.create_connection(("localhost", 8099))
+
+
+def read_responses(n):
+	response = b""
+	while(response.count(b"\r\n\r\nhello") < n):
+		response += client_socket.recv(65536)
+
+
+def one_request_per_round_trip():
+	for i in range(NUM_REQUESTS):
+		client_socket.sendall(request)
+		read_responses(1)
+
+
+def pipelined():
+	client_socket.sendall(request * NUM_REQUESTS)
+	read_responses(NUM_REQUESTS)
+
+
+print("100 requests on a keep-alive connection")
+print("  one request per round trip:", min(timeit.repeat(stmt="one_request_per_round_trip()", globals=globals(), repeat=3, number=10)))
+print("  pipelined:                 ", min(timeit.repeat(stmt="pipelined()", globals=globals(), repeat=3, number=10)))
+client_socket.close()
+app.stop()